@@ -1,16 +1,42 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, g, has_app_context, send_file
 from flask_cors import CORS
 from datetime import datetime, timedelta
 import sqlite3
 import os
+import re
+import sys
 import uuid
 import hashlib
+import random
+import time
+import threading
 from functools import wraps
 import json
 import requests
-import base64
-import io
-import mercadopago
+from migrations import run_migrations
+from blobstore import MEDIA_URL, store_blob, store_file, decode_data_uri, resolve_blob, make_private
+from variants import VariantCache, snap_width, srcset
+from images import DNI_MAX_SIZE, CATEGORY_MAX_SIZE, ImageError, ImagePool, ImagePoolBusy, process_upload, process_file, variant_file
+from uploads import (
+    CHUNK_SIZE, MAX_UPLOAD_SIZE, ChunkError,
+    part_path, create_part, write_chunk, file_sha256, remove_part
+)
+from availability import (
+    OPERATING_START, OPERATING_END, AvailabilityEngine,
+    block_range, expand_reservation_hours
+)
+from cache import VersionedCache, get_version, bump_version
+from wa_sender import WhatsAppSender
+from wa_inbox import Inbox
+from intents import (
+    PAYLOAD_MENU, PAYLOAD_PLANES, PAYLOAD_RESERVAR, PAYLOAD_UBICACION,
+    PAYLOAD_ECO, PAYLOAD_FULL, PAYLOAD_PAGO, PAYLOAD_DISPONIBILIDAD, build_router, normalize
+)
+from conversations import ConversationStore
+from broadcasts import DEFAULT_REMINDER, BroadcastRunner, create_broadcast, broadcast_progress, wa_phone
+from wa_media import MEDIA_TYPES, KIND_DNI, MediaError, MediaQueue, media_kind, download_media
+from payments import NOTIFICATION_TOPICS, PaymentSync, PreferenceQueue, make_sdk
+from catalog import RENTAL_TYPES, PAYMENT_METHODS, load_catalog, quote, quote_matrix
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
@@ -41,22 +67,82 @@ WA_PHONE_ID = CONFIG['WA_PHONE_ID']
 WA_VERIFY_TOKEN = CONFIG['WA_VERIFY_TOKEN']
 WA_VERSION = CONFIG['WA_VERSION']
 
-# Initialize Mercado Pago SDK
-sdk = mercadopago.SDK(CONFIG['MP_ACCESS_TOKEN'])
+# Initialize Mercado Pago SDK (pooled HTTP session, strict timeouts)
+sdk = make_sdk(CONFIG['MP_ACCESS_TOKEN'])
 
 # Database path
 DB_PATH = os.path.join(os.path.dirname(__file__), 'bicisi.db')
 
-# Operating hours
-OPERATING_START = 8
-OPERATING_END = 19
+# Connection tuning (applied to every connection)
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_SIZE_KB = 16384
 
-def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DB_PATH)
+def connect_db():
+    """Open a new connection with WAL and the tuned pragmas"""
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000)
     conn.row_factory = sqlite3.Row
+    # WAL lets readers run while a writer holds the lock; NORMAL sync is durable in WAL
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
     return conn
 
+# One long-lived connection per thread (waitress serves from a fixed pool)
+_thread_db = threading.local()
+
+def get_db():
+    """Get this thread's database connection, opening it on first use.
+
+    Connections are reused across requests so the pragmas above are paid
+    once per thread; a request's leftover transaction is rolled back on
+    teardown. Callers must not close it.
+    """
+    conn = getattr(_thread_db, 'conn', None)
+    if conn is None or _thread_db.path != DB_PATH:
+        conn = _thread_db.conn = connect_db()
+        _thread_db.path = DB_PATH
+    if has_app_context():
+        g.db = conn
+    return conn
+
+@app.teardown_appcontext
+def release_db(exc):
+    """Roll back anything the request left uncommitted"""
+    conn = g.pop('db', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+# Bounded retry for write transactions when SQLite reports SQLITE_BUSY
+WRITE_MAX_ATTEMPTS = 5
+WRITE_RETRY_BASE_DELAY = 0.05
+
+def write_transaction(fn, *args):
+    """Run fn(cursor, *args) inside one BEGIN IMMEDIATE transaction.
+
+    The write lock is taken up front, so reads done by fn can't be
+    invalidated by another writer before commit. Retries a bounded number
+    of times with jittered backoff if the database is busy/locked.
+    """
+    conn = get_db()
+    for attempt in range(WRITE_MAX_ATTEMPTS):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            result = fn(cursor, *args)
+            conn.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            busy = 'locked' in str(e) or 'busy' in str(e)
+            if not busy or attempt == WRITE_MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(WRITE_RETRY_BASE_DELAY * (2 ** attempt) * (0.5 + random.random()))
+        except Exception:
+            conn.rollback()
+            raise
+
 def hash_password(password):
     """Hash password with SHA256"""
     return hashlib.sha256(password.encode()).hexdigest()
@@ -66,71 +152,8 @@ def init_db():
     conn = get_db()
     cursor = conn.cursor()
     
-    # Create tables
-    cursor.executescript('''
-        -- Admin users table
-        CREATE TABLE IF NOT EXISTS admins (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        
-        -- Categories table
-        CREATE TABLE IF NOT EXISTS categories (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            description TEXT,
-            price_full_day INTEGER DEFAULT 0,
-            price_half_day INTEGER DEFAULT 0,
-            price_per_hour INTEGER DEFAULT 0,
-            stock INTEGER DEFAULT 0,
-            image TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        
-        -- Reservations table
-        CREATE TABLE IF NOT EXISTS reservations (
-            id TEXT PRIMARY KEY,
-            customer_name TEXT NOT NULL,
-            customer_phone TEXT NOT NULL,
-            customer_email TEXT,
-            customer_dni TEXT,
-            dni_photo TEXT,
-            rental_type TEXT NOT NULL,
-            start_date TEXT NOT NULL,
-            end_date TEXT,
-            start_hour INTEGER DEFAULT 8,
-            end_hour INTEGER DEFAULT 19,
-            payment_method TEXT NOT NULL,
-            pickup_location TEXT DEFAULT 'sucursal',
-            return_location TEXT DEFAULT 'sucursal',
-            total INTEGER DEFAULT 0,
-            deposit INTEGER DEFAULT 0,
-            status TEXT DEFAULT 'pending',
-            notes TEXT,
-            overridden_by TEXT,
-            overridden_at TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        
-        -- Reservation items table (many-to-many)
-        CREATE TABLE IF NOT EXISTS reservation_items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            reservation_id TEXT NOT NULL,
-            category_id TEXT NOT NULL,
-            quantity INTEGER DEFAULT 1,
-            FOREIGN KEY (reservation_id) REFERENCES reservations(id) ON DELETE CASCADE,
-            FOREIGN KEY (category_id) REFERENCES categories(id)
-        );
-        
-        -- Settings table
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        );
-    ''')
+    # Create or upgrade the schema (see migrations.py)
+    run_migrations(conn)
     
     # Check if admin exists, if not create default
     cursor.execute("SELECT COUNT(*) FROM admins")
@@ -153,6 +176,7 @@ def init_db():
             "INSERT INTO categories (id, name, description, price_full_day, price_half_day, price_per_hour, stock, image) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
             default_categories
         )
+        bump_version(cursor, 'catalog')
     
     # Check if settings exist, if not create defaults
     cursor.execute("SELECT COUNT(*) FROM settings")
@@ -169,64 +193,107 @@ def init_db():
             ('bank_holder', 'Lucas Brunazzi'),
         ]
         cursor.executemany("INSERT INTO settings (key, value) VALUES (?, ?)", default_settings)
+        bump_version(cursor, 'settings')
+    
+    # Backfill WhatsApp phones for reservations made before the column existed (or reset by a migration)
+    cursor.execute("SELECT id, customer_phone FROM reservations WHERE wa_phone IS NULL")
+    cursor.executemany(
+        "UPDATE reservations SET wa_phone = ? WHERE id = ?",
+        [(wa_phone(row['customer_phone']), row['id']) for row in cursor.fetchall()]
+    )
+    
+    # Backfill occupancy for databases created before the projection existed
+    cursor.execute("SELECT COUNT(*) FROM occupancy")
+    needs_occupancy = cursor.fetchone()[0] == 0
     
     conn.commit()
-    conn.close()
+    
+    if needs_occupancy:
+        rebuild_occupancy()
     
     # Run migration for existing images
     try:
         migrate_images_to_db()
+        protect_customer_media()
     except Exception as e:
         print(f"Migration error: {e}")
 
+# Rows moved per batch when extracting images into the blob store
+IMAGE_MIGRATION_BATCH = 50
+
 def migrate_images_to_db():
-    """Migrate existing file-based images to base64 in the database"""
+    """Move image files and base64 data URIs out of the tables into the blob store.
+
+    Rows end up holding a /media/ URL (/admin/media/ for DNI photos). Runs
+    on every start but only touches rows still pointing at /static/ files or
+    holding data URIs.
+    """
     conn = get_db()
     cursor = conn.cursor()
-    
-    # 1. Categories
-    cursor.execute("SELECT id, image FROM categories WHERE image LIKE '/static/%'")
-    categories = cursor.fetchall()
-    
-    for cat in categories:
-        local_path = cat['image']
-        # Convert /static/ to the actual static folder path
-        rel_path = local_path.lstrip('/')
-        # Use a safe join, assuming relative paths from project root or static folder
-        # In this project, app.py is in /reservas/, and static is there too.
-        full_path = os.path.join(os.path.dirname(__file__), rel_path)
-        
-        if os.path.exists(full_path):
-            with open(full_path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                ext = local_path.rsplit('.', 1)[-1].lower()
-                mime_type = f"image/{'jpeg' if ext == 'jpg' else ext}"
-                data_uri = f"data:{mime_type};base64,{encoded_string}"
-                
-                cursor.execute("UPDATE categories SET image = ? WHERE id = ?", (data_uri, cat['id']))
-                print(f"Migrated category image: {cat['id']}")
-
-    # 2. Reservations (DNI photos)
-    cursor.execute("SELECT id, dni_photo FROM reservations WHERE dni_photo LIKE '/static/%'")
-    reservations = cursor.fetchall()
-    
-    for res in reservations:
-        local_path = res['dni_photo']
-        rel_path = local_path.lstrip('/')
-        full_path = os.path.join(os.path.dirname(__file__), rel_path)
-        
-        if os.path.exists(full_path):
-            with open(full_path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                ext = local_path.rsplit('.', 1)[-1].lower()
-                mime_type = f"image/{'jpeg' if ext == 'jpg' else ext}"
-                data_uri = f"data:{mime_type};base64,{encoded_string}"
-                
-                cursor.execute("UPDATE reservations SET dni_photo = ? WHERE id = ?", (data_uri, res['id']))
-                print(f"Migrated reservation DNI photo: {res['id']}")
-                
-    conn.commit()
-    conn.close()
+    extracted = 0
+    
+    for table, column, store_inline, private in (
+        ('categories', 'image', store_category_data_uri, False),
+        ('reservations', 'dni_photo', lambda value: store_dni_data_uri(value)[0], True),
+    ):
+        last_id = ''
+        while True:
+            # Keyset batches keep memory flat even with thousands of photos
+            cursor.execute(f'''
+                SELECT id, {column} AS value FROM {table}
+                WHERE ({column} LIKE '/static/%' OR {column} LIKE 'data:%') AND id > ?
+                ORDER BY id LIMIT ?
+            ''', (last_id, IMAGE_MIGRATION_BATCH))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                value = row['value']
+                try:
+                    if value.startswith('data:'):
+                        url = store_inline(value)
+                    else:
+                        # Convert /static/ to the actual static folder path
+                        full_path = os.path.join(os.path.dirname(__file__), value.lstrip('/'))
+                        if not os.path.exists(full_path):
+                            continue
+                        with open(full_path, 'rb') as image_file:
+                            url = store_blob(image_file.read(), value.rsplit('.', 1)[-1].lower(), private=private)
+                except (ValueError, ImageError, ImagePoolBusy) as e:
+                    print(f"Skipping image of {table} {row['id']}: {e}")
+                    continue
+                cursor.execute(f"UPDATE {table} SET {column} = ? WHERE id = ?", (url, row['id']))
+                extracted += 1
+                print(f"Migrated {table} image: {row['id']} -> {url}")
+            conn.commit()
+            last_id = rows[-1]['id']
+    
+    if extracted:
+        # Give the space of the base64 payloads back to the filesystem
+        conn.execute("VACUUM")
+
+def protect_customer_media():
+    """Move DNI photos and WhatsApp attachments stored as public /media/ blobs into the private store"""
+    conn = get_db()
+    moved = 0
+    for table, key, columns in (
+        ('reservations', 'id', ('dni_photo', 'dni_thumb')),
+        ('upload_hashes', 'sha256', ('url', 'thumb_url')),
+        ('wa_media', 'media_id', ('url', 'thumb_url')),
+    ):
+        rows = conn.execute(
+            f"SELECT {key}, {', '.join(columns)} FROM {table} WHERE "
+            + " OR ".join(f"{column} LIKE '/media/%'" for column in columns)
+        ).fetchall()
+        for row in rows:
+            conn.execute(
+                f"UPDATE {table} SET {', '.join(f'{column} = ?' for column in columns)} WHERE {key} = ?",
+                [make_private(row[column]) for column in columns] + [row[key]]
+            )
+            moved += 1
+        conn.commit()
+    if moved:
+        print(f"Moved customer media of {moved} rows to the private store")
 
 def login_required(f):
     """Decorator for admin routes"""
@@ -237,20 +304,26 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def get_settings():
-    """Get all settings as dict with JSON fallback"""
-    conn = get_db()
-    cursor = conn.cursor()
+DEFAULT_MESSAGES_PATH = os.path.join(os.path.dirname(__file__), 'data', 'default_messages.json')
+
+def settings_key(cursor):
+    """Changes whenever admin_settings writes or default_messages.json is edited"""
+    try:
+        mtime = os.stat(DEFAULT_MESSAGES_PATH).st_mtime_ns
+    except OSError:
+        mtime = None
+    return DB_PATH, get_version(cursor, 'settings'), mtime
+
+def load_settings(cursor):
+    """Merge the settings table over the JSON defaults"""
     cursor.execute("SELECT key, value FROM settings")
     db_settings = {row['key']: row['value'] for row in cursor.fetchall()}
-    conn.close()
     
     # Load defaults from JSON
     defaults = {}
-    json_path = os.path.join(os.path.dirname(__file__), 'data', 'default_messages.json')
-    if os.path.exists(json_path):
+    if os.path.exists(DEFAULT_MESSAGES_PATH):
         try:
-            with open(json_path, 'r', encoding='utf-8') as f:
+            with open(DEFAULT_MESSAGES_PATH, 'r', encoding='utf-8') as f:
                 defaults = json.load(f)
         except Exception as e:
             print(f"Error loading default_messages.json: {e}")
@@ -263,6 +336,34 @@ def get_settings():
             
     return final_settings
 
+settings_cache = VersionedCache(settings_key, load_settings)
+
+def get_settings():
+    """Get all settings as dict with JSON fallback (cached; treat as read-only)"""
+    return settings_cache.get(get_db().cursor())
+
+# Seconds a worker may quote from its catalog snapshot before re-checking versions
+CATALOG_CHECK_INTERVAL = 2
+
+def catalog_key(cursor):
+    """Changes whenever categories or settings are written"""
+    return DB_PATH, get_version(cursor, 'catalog'), get_version(cursor, 'settings')
+
+catalog_cache = VersionedCache(
+    catalog_key,
+    lambda cursor: load_catalog(cursor, settings_cache.get(cursor)),
+    check_interval=CATALOG_CHECK_INTERVAL
+)
+
+def get_catalog():
+    """Price table snapshot (see catalog.py)"""
+    return catalog_cache.get(get_db().cursor())
+
+def catalog_changed(cursor):
+    """Record a categories write so every worker reloads its price table"""
+    bump_version(cursor, 'catalog')
+    catalog_cache.invalidate()
+
 @app.route('/api/admin/default-messages')
 def get_default_messages():
     """Endpoint for admin panel to get placeholders"""
@@ -280,9 +381,87 @@ def get_categories():
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM categories ORDER BY name")
     categories = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    for category in categories:
+        category['image_srcset'] = media_srcset(category['image'])
     return categories
 
+# ==================== OCCUPANCY ====================
+
+# Shared availability engine (see availability.py)
+engine = AvailabilityEngine()
+
+def apply_occupancy(cursor, reservation_id, sign):
+    """Add (sign=1) or remove (sign=-1) a reservation's hours in the occupancy table.
+
+    Must run on the same cursor/transaction as the reservation write.
+    """
+    cursor.execute(
+        "SELECT start_date, end_date, start_hour, end_hour FROM reservations WHERE id = ?",
+        (reservation_id,)
+    )
+    res = cursor.fetchone()
+    if not res:
+        return
+    cursor.execute(
+        "SELECT category_id, quantity FROM reservation_items WHERE reservation_id = ?",
+        (reservation_id,)
+    )
+    items = cursor.fetchall()
+    
+    hours = list(expand_reservation_hours(res['start_date'], res['end_date'], res['start_hour'], res['end_hour']))
+    cursor.executemany('''
+        INSERT INTO occupancy (category_id, date, hour, qty) VALUES (?, ?, ?, ?)
+        ON CONFLICT(category_id, date, hour) DO UPDATE SET qty = qty + excluded.qty
+    ''', [(item['category_id'], d, h, sign * item['quantity']) for item in items for d, h in hours])
+    if sign < 0:
+        cursor.executemany(
+            "DELETE FROM occupancy WHERE category_id = ? AND date BETWEEN ? AND ? AND qty <= 0",
+            [(item['category_id'], res['start_date'], res['end_date'] or res['start_date']) for item in items]
+        )
+
+def set_reservation_status(cursor, reservation_id, new_status, only_if=None):
+    """Change a reservation status keeping the occupancy table in sync.
+
+    If only_if is given the update only happens when the current status matches.
+    Returns the number of updated rows (0 or 1).
+    """
+    cursor.execute("SELECT status FROM reservations WHERE id = ?", (reservation_id,))
+    row = cursor.fetchone()
+    if not row or (only_if is not None and row['status'] != only_if):
+        return 0
+    old_status = row['status']
+    
+    cursor.execute("UPDATE reservations SET status = ? WHERE id = ?", (new_status, reservation_id))
+    updated = cursor.rowcount
+    if old_status == 'confirmed' and new_status != 'confirmed':
+        apply_occupancy(cursor, reservation_id, -1)
+    elif new_status == 'confirmed' and old_status != 'confirmed':
+        apply_occupancy(cursor, reservation_id, 1)
+    return updated
+
+def rebuild_occupancy():
+    """Recompute the occupancy table from scratch out of confirmed reservations"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM occupancy")
+    cursor.execute('''
+        SELECT r.start_date, r.end_date, r.start_hour, r.end_hour, ri.category_id, ri.quantity
+        FROM reservations r
+        JOIN reservation_items ri ON r.id = ri.reservation_id
+        WHERE r.status = 'confirmed'
+    ''')
+    totals = {}
+    for row in cursor.fetchall():
+        for d, h in expand_reservation_hours(row['start_date'], row['end_date'], row['start_hour'], row['end_hour']):
+            key = (row['category_id'], d, h)
+            totals[key] = totals.get(key, 0) + row['quantity']
+    cursor.executemany(
+        "INSERT INTO occupancy (category_id, date, hour, qty) VALUES (?, ?, ?, ?)",
+        [(*key, qty) for key, qty in totals.items()]
+    )
+    conn.commit()
+    return len(totals)
+
 # ==================== PUBLIC ROUTES ====================
 
 @app.route('/')
@@ -311,82 +490,12 @@ def api_get_settings():
     """Get settings"""
     return jsonify(get_settings())
 
-@app.route('/api/available-slots', methods=['POST'])
-def get_available_slots():
-    """Get available time slots for a specific date"""
-    data = request.json
-    date_str = data.get('date')
-    category_id = data.get('category_id')
-    quantity = data.get('quantity', 1)
-    
-    if not date_str:
-        return jsonify({"error": "Date required"}), 400
-    
-    try:
-        selected_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-    except:
-        return jsonify({"error": "Invalid date format"}), 400
-    
+def build_slots(selected_date, reserved_hours, max_stock, quantity):
+    """Build the hourly slot list for a date given the reserved qty per hour"""
     now = datetime.now()
     today = now.date()
     current_hour = now.hour
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Get category stock
-    cursor.execute("SELECT stock FROM categories WHERE id = ?", (category_id,))
-    row = cursor.fetchone()
-    max_stock = row['stock'] if row else 0
-    
-    # Get reservations that overlap with this date
-    # A reservation overlaps if start_date <= date_str AND end_date >= date_str
-    cursor.execute('''
-        SELECT r.start_date, r.end_date, r.start_hour, r.end_hour, ri.quantity 
-        FROM reservations r
-        JOIN reservation_items ri ON r.id = ri.reservation_id
-        WHERE ri.category_id = ? 
-        AND r.start_date <= ? 
-        AND r.end_date >= ?
-        AND r.status = 'confirmed'
-    ''', (category_id, date_str, date_str))
-    
-    reserved_hours = {}
-    for row in cursor.fetchall():
-        s_date = row['start_date']
-        e_date = row['end_date']
-        s_hour = row['start_hour']
-        e_hour = row['end_hour']
-        qty = row['quantity']
-        
-        # Calculate which hours are blocked on the REQUESTED date
-        # If it's an intermediate day, blocks everything
-        block_start = OPERATING_START
-        block_end = OPERATING_END
-        
-        if s_date == date_str and e_date == date_str:
-            # Single day reservation
-            block_start = max(OPERATING_START, s_hour - 1)
-            block_end = min(OPERATING_END, e_hour + 1)
-        elif s_date == date_str:
-            # First day of multi-day
-            block_start = max(OPERATING_START, s_hour - 1)
-            block_end = OPERATING_END
-        elif e_date == date_str:
-            # Last day of multi-day
-            block_start = OPERATING_START
-            block_end = min(OPERATING_END, e_hour + 1)
-        else:
-            # Middle of multi-day - blocks full range
-            block_start = OPERATING_START
-            block_end = OPERATING_END
-            
-        for h in range(block_start, block_end):
-            reserved_hours[h] = reserved_hours.get(h, 0) + qty
-    
-    conn.close()
-    
-    # Generate available slots
     slots = []
     for hour in range(OPERATING_START, OPERATING_END):
         available = True
@@ -412,217 +521,246 @@ def get_available_slots():
             "reason": reason,
             "remaining": max(0, remaining)
         })
+    return slots
+
+@app.route('/api/available-slots', methods=['POST'])
+def get_available_slots():
+    """Get available time slots for a specific date"""
+    data = request.json
+    date_str = data.get('date')
+    category_id = data.get('category_id')
+    quantity = data.get('quantity', 1)
+    
+    if not date_str:
+        return jsonify({"error": "Date required"}), 400
+    
+    try:
+        selected_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+    except:
+        return jsonify({"error": "Invalid date format"}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    # Get category stock
+    cursor.execute("SELECT stock FROM categories WHERE id = ?", (category_id,))
+    row = cursor.fetchone()
+    max_stock = row['stock'] if row else 0
+    
+    reserved_hours = engine.hourly_usage(cursor, category_id, date_str)
     
     return jsonify({
         "date": date_str,
-        "slots": slots,
+        "slots": build_slots(selected_date, reserved_hours, max_stock, quantity),
         "operating_hours": {"start": OPERATING_START, "end": OPERATING_END}
     })
 
-@app.route('/api/calculate-price', methods=['POST'])
-def calculate_price():
-    """Calculate reservation price"""
-    data = request.json
+# Max days a single batch availability request may cover
+MAX_AVAILABILITY_DAYS = 31
+
+@app.route('/api/availability', methods=['POST'])
+def get_availability_batch():
+    """Get hourly availability for several categories over a date range in one call"""
+    data = request.json or {}
+    start_str = data.get('start_date')
+    end_str = data.get('end_date') or start_str
     items = data.get('items', [])
-    rental_type = data.get('rental_type')
-    hours = data.get('hours', 0)
-    days = data.get('days', 1)
-    payment_method = data.get('payment_method', 'cash')
     
-    conn = get_db()
-    cursor = conn.cursor()
-    settings = get_settings()
+    if not start_str:
+        return jsonify({"error": "start_date required"}), 400
+    if not items:
+        return jsonify({"error": "items required"}), 400
     
-    total = 0
-    breakdown = []
+    try:
+        start_date = datetime.strptime(start_str, '%Y-%m-%d').date()
+        end_date = datetime.strptime(end_str, '%Y-%m-%d').date()
+    except:
+        return jsonify({"error": "Invalid date format"}), 400
     
-    for item in items:
-        cursor.execute("SELECT * FROM categories WHERE id = ?", (item['category_id'],))
-        category = cursor.fetchone()
-        if not category:
-            continue
-        
-        qty = item.get('quantity', 1)
-        
-        if rental_type == 'full_day':
-            price = category['price_full_day'] * qty * days
-            label = f"{category['name']} x{qty} - {days} día(s) completo(s)"
-        elif rental_type == 'half_day':
-            price = category['price_half_day'] * qty * days
-            label = f"{category['name']} x{qty} - {days} medio día(s)"
-        elif rental_type == 'hours':
-            # Cap hourly price at full day price
-            hourly_price = category['price_per_hour'] * qty * hours
-            max_daily_price = category['price_full_day'] * qty
-            if hourly_price > max_daily_price:
-                price = max_daily_price
-                label = f"{category['name']} x{qty} - {hours} hora(s) (Tope diario)"
-            else:
-                price = hourly_price
-                label = f"{category['name']} x{qty} - {hours} hora(s)"
-        else:
-            price = category['price_full_day'] * qty * days
-            label = f"{category['name']} x{qty} - {days} día(s)"
-        
-        total += price
-        breakdown.append({"label": label, "price": price})
+    num_days = (end_date - start_date).days + 1
+    if num_days < 1:
+        return jsonify({"error": "end_date must be after start_date"}), 400
+    if num_days > MAX_AVAILABILITY_DAYS:
+        return jsonify({"error": f"Rango máximo: {MAX_AVAILABILITY_DAYS} días"}), 400
     
-    conn.close()
+    quantities = {item['category_id']: item.get('quantity', 1) for item in items}
+    cat_ids = list(quantities)
+    placeholders = ', '.join('?' for _ in cat_ids)
     
-    # Add Modo FULL surcharge (online payment)
-    if payment_method == 'mercadopago':
-        breakdown.append({"label": "Modo FULL", "price": 10000})
-        total += 10000
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    cursor.execute(f"SELECT id, stock FROM categories WHERE id IN ({placeholders})", cat_ids)
+    stocks = {row['id']: row['stock'] for row in cursor.fetchall()}
     
-    # Add delivery fee if payment by transfer
-    delivery_fee = 0
-    if payment_method == 'transfer':
-        delivery_fee = int(settings.get('delivery_fee', 10000))
-        breakdown.append({"label": "Servicio de entrega/retiro", "price": delivery_fee})
-        total += delivery_fee
+    dates = [(start_date + timedelta(days=i)).isoformat() for i in range(num_days)]
+    # reserved[date][category_id][hour] = qty, one range read for the whole request
+    reserved = engine.usage(cursor, cat_ids, start_str, end_str)
     
-    deposit = int(total * 0.5)
+    days = []
+    for i, date_str in enumerate(dates):
+        day_categories = {}
+        for cat_id in cat_ids:
+            day_categories[cat_id] = {
+                "stock": stocks.get(cat_id, 0),
+                "quantity": quantities[cat_id],
+                "slots": build_slots(start_date + timedelta(days=i), reserved.get(date_str, {}).get(cat_id, {}), stocks.get(cat_id, 0), quantities[cat_id])
+            }
+        days.append({"date": date_str, "categories": day_categories})
     
     return jsonify({
-        "breakdown": breakdown,
-        "subtotal": total - delivery_fee,
-        "delivery_fee": delivery_fee,
-        "total": total,
-        "deposit": deposit
+        "start_date": start_str,
+        "end_date": end_str,
+        "days": days,
+        "operating_hours": {"start": OPERATING_START, "end": OPERATING_END}
     })
 
-@app.route('/api/reservations', methods=['POST'])
-def create_reservation():
-    """Create a new reservation"""
-    data = request.json
+@app.route('/api/availability/calendar')
+def get_availability_calendar():
+    """Per-day minimum remaining stock of a category for a whole month"""
+    category_id = request.args.get('category_id')
+    month = request.args.get('month')
+    quantity = request.args.get('quantity', 1, type=int)
     
-    required = ['items', 'rental_type', 'start_date', 'customer_name', 'customer_phone', 'payment_method']
-    for field in required:
-        if not data.get(field):
-            return jsonify({"error": f"Campo requerido: {field}"}), 400
-            
-    # Sanitize DNI (remove dots, hyphens, spaces)
-    if 'customer_dni' in data:
-        data['customer_dni'] = ''.join(filter(str.isdigit, str(data['customer_dni'])))
+    if not category_id or not month:
+        return jsonify({"error": "category_id and month (YYYY-MM) required"}), 400
+    
+    try:
+        first_day = datetime.strptime(month, '%Y-%m').date()
+    except:
+        return jsonify({"error": "Invalid month format"}), 400
+    last_day = (first_day + timedelta(days=32)).replace(day=1) - timedelta(days=1)
     
     conn = get_db()
     cursor = conn.cursor()
     
+    cursor.execute("SELECT stock FROM categories WHERE id = ?", (category_id,))
+    row = cursor.fetchone()
+    if not row:
+        return jsonify({"error": "Category not found"}), 404
+    max_stock = row['stock']
+    
+    # Peak usage and number of hours without room for quantity, per day,
+    # in one grouped range scan over the month
+    cursor.execute('''
+        SELECT date, MAX(qty) AS peak, SUM(qty > ?) AS full_hours
+        FROM occupancy
+        WHERE category_id = ? AND date BETWEEN ? AND ?
+        GROUP BY date
+    ''', (max_stock - quantity, category_id, first_day.isoformat(), last_day.isoformat()))
+    usage = {row['date']: (row['peak'], row['full_hours']) for row in cursor.fetchall()}
+    
+    today = datetime.now().date()
+    days = []
+    curr = first_day
+    while curr <= last_day:
+        date_str = curr.isoformat()
+        peak, full_hours = usage.get(date_str, (0, 0))
+        remaining = max(0, max_stock - peak)
+        days.append({
+            "date": date_str,
+            "min_remaining": remaining,
+            "partially_booked": remaining < quantity,
+            "fully_booked": quantity > max_stock or full_hours >= OPERATING_END - OPERATING_START,
+            "past": curr < today
+        })
+        curr += timedelta(days=1)
+    
+    return jsonify({
+        "category_id": category_id,
+        "month": month,
+        "stock": max_stock,
+        "days": days
+    })
+
+@app.route('/api/calculate-price', methods=['POST'])
+def calculate_price():
+    """Calculate reservation price"""
+    data = request.json
+    items = data.get('items', [])
+    rental_type = data.get('rental_type')
+    hours = data.get('hours', 0)
+    days = data.get('days', 1)
+    payment_method = data.get('payment_method', 'cash')
+    
+    # Priced from the in-memory catalog snapshot, no per-item queries
+    return jsonify(quote(get_catalog(), items, rental_type, hours, days, payment_method))
+
+@app.route('/api/quotes', methods=['POST'])
+def quotes():
+    """Price one cart for every rental type and payment method at once"""
+    data = request.json or {}
+    rental_types = data.get('rental_types') or RENTAL_TYPES
+    payment_methods = data.get('payment_methods') or PAYMENT_METHODS
+    if not set(rental_types) <= set(RENTAL_TYPES) or not set(payment_methods) <= set(PAYMENT_METHODS):
+        return jsonify({"error": "Invalid rental_types or payment_methods"}), 400
+    
+    # Without a duration the hourly price would be $0 and always "cheapest"
+    hours = data.get('hours') or 0
+    if not isinstance(hours, (int, float)) or hours <= 0:
+        if data.get('rental_types') and 'hours' in rental_types:
+            return jsonify({"error": "hours must be greater than 0 to quote 'hours'"}), 400
+        rental_types = [rt for rt in rental_types if rt != 'hours']
+    
+    matrix = quote_matrix(
+        get_catalog(), data.get('items', []), hours, data.get('days', 1),
+        rental_types, payment_methods
+    )
+    cheapest = min(
+        ({"rental_type": rt, "payment_method": pm, "total": q['total']} for rt, row in matrix.items() for pm, q in row.items()),
+        key=lambda option: option['total']
+    )
+    return jsonify({"quotes": matrix, "cheapest": cheapest})
+
+class BookingError(Exception):
+    """Booking rejected for a business reason (e.g. no stock left)"""
+
+def book_reservation(cursor, data):
+    """Check capacity and insert a public reservation; runs in write_transaction"""
+    start_date = data.get('start_date')
+    end_date = data.get('end_date', start_date)
+    
     # Check if there's an existing cash reservation that should be overridden
     if data.get('payment_method') == 'transfer':
         cursor.execute('''
-            SELECT id FROM reservations 
+            UPDATE reservations 
+            SET status = 'overridden', overridden_by = ?, overridden_at = ?
             WHERE payment_method = 'cash' 
             AND status = 'pending' 
             AND start_date = ?
-        ''', (data.get('start_date'),))
-        
-        for row in cursor.fetchall():
-            cursor.execute('''
-                UPDATE reservations 
-                SET status = 'overridden', overridden_by = ?, overridden_at = ?
-                WHERE id = ?
-            ''', (data.get('customer_phone'), datetime.now().isoformat(), row['id']))
-    
-    # --- Stock Availability Check ---
-    start_date_obj = datetime.strptime(data.get('start_date'), '%Y-%m-%d').date()
-    end_date_obj = datetime.strptime(data.get('end_date', data.get('start_date')), '%Y-%m-%d').date()
-    
-    # Iterate through each day of the reservation
-    curr_date = start_date_obj
-    while curr_date <= end_date_obj:
-        date_str = curr_date.isoformat()
-        
-        for item in data.get('items', []):
-            cat_id = item['category_id']
-            qty = item.get('quantity', 1)
-            
-            # Use same logic as get_available_slots but in-memory/in-loop
-            # We'll do a focused query for each item/day
-            cursor.execute("SELECT stock FROM categories WHERE id = ?", (cat_id,))
-            max_stock = cursor.fetchone()['stock']
-            
-            cursor.execute('''
-                SELECT r.start_date, r.end_date, r.start_hour, r.end_hour, ri.quantity 
-                FROM reservations r
-                JOIN reservation_items ri ON r.id = ri.reservation_id
-                WHERE ri.category_id = ? 
-                AND r.start_date <= ? 
-                AND r.end_date >= ?
-                AND r.status = 'confirmed'
-            ''', (cat_id, date_str, date_str))
-            
-            day_reserved = {}
-            for res_row in cursor.fetchall():
-                # Block logic (same as get_available_slots)
-                b_start, b_end = OPERATING_START, OPERATING_END
-                if res_row['start_date'] == date_str and res_row['end_date'] == date_str:
-                    b_start, b_end = max(OPERATING_START, res_row['start_hour'] - 1), min(OPERATING_END, res_row['end_hour'] + 1)
-                elif res_row['start_date'] == date_str:
-                    b_start, b_end = max(OPERATING_START, res_row['start_hour'] - 1), OPERATING_END
-                elif res_row['end_date'] == date_str:
-                    b_start, b_end = OPERATING_START, min(OPERATING_END, res_row['end_hour'] + 1)
-                
-                for h in range(b_start, b_end):
-                    day_reserved[h] = day_reserved.get(h, 0) + res_row['quantity']
-            
-            # Check requested range for THIS specific reservation
-            req_start = data.get('start_hour', OPERATING_START)
-            req_end = data.get('end_hour', OPERATING_END)
-            
-            # Adjust range for multi-day start/end
-            if curr_date == start_date_obj and curr_date == end_date_obj:
-                # Single day: use requested hours + 1 hr buffer
-                req_start = max(OPERATING_START, req_start - 1)
-                req_end = min(OPERATING_END, req_end + 1)
-            elif curr_date == start_date_obj:
-                # First day: starts at req_start - 1, ends at 19
-                req_start = max(OPERATING_START, req_start - 1)
-                req_end = OPERATING_END
-            elif curr_date == end_date_obj:
-                # Last day: starts at 8, ends at req_end + 1
-                req_start = OPERATING_START
-                req_end = min(OPERATING_END, req_end + 1)
-            else:
-                # Intermediate: full day
-                req_start, req_end = OPERATING_START, OPERATING_END
-                
-            now = datetime.now()
-            today = now.date()
-            current_hour = now.hour
-            
-            for h in range(req_start, req_end):
-                if (day_reserved.get(h, 0) + qty) > max_stock:
-                    conn.close()
-                    return jsonify({"error": f"Lo sentimos, no hay stock disponible de '{cat_id}' para el día {date_str} a las {h}:00. Probá con otra fecha o menos unidades."}), 400
-                # Check if hours already passed for today
-                if curr_date == today and h <= current_hour + 1:
-                    rental_type = data.get('rental_type', '')
-                    if rental_type in ('full_day', 'half_day'):
-                        conn.close()
-                        return jsonify({"error": f"Ya pasó el límite de horario para reservar '{rental_type.replace('_', ' ')}' en el día de hoy. Por favor, pedí por horas simples."}), 400
-                    
-        curr_date += timedelta(days=1)
-    # --- End Stock Check ---
-
+        ''', (data.get('customer_phone'), datetime.now().isoformat(), start_date))
+    
+    conflict = engine.first_conflict(
+        cursor, data.get('items', []), start_date, end_date,
+        data.get('start_hour', OPERATING_START), data.get('end_hour', OPERATING_END)
+    )
+    if conflict:
+        cat_id, date_str, hour = conflict
+        raise BookingError(f"Lo sentimos, no hay stock disponible de '{cat_id}' para el día {date_str} a las {hour}:00. Probá con otra fecha o menos unidades.")
+    
     # Create new reservation
     reservation_id = str(uuid.uuid4())
+    status = 'confirmed' if data.get('payment_method') == 'transfer' else ('pending_payment' if data.get('payment_method') == 'mercadopago' else 'pending')
+    # The checkout preference is created afterwards by mp_preferences
+    mp_status = 'pending' if data.get('payment_method') == 'mercadopago' and data.get('deposit', 0) > 0 else None
     cursor.execute('''
         INSERT INTO reservations (
-            id, customer_name, customer_phone, customer_email, customer_dni, dni_photo,
+            id, customer_name, customer_phone, wa_phone, customer_email, customer_dni, dni_photo, dni_thumb,
             rental_type, start_date, end_date, start_hour, end_hour,
-            payment_method, pickup_location, return_location, total, deposit, status, notes
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            payment_method, pickup_location, return_location, total, deposit, status, notes, mp_status
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     ''', (
         reservation_id,
         data.get('customer_name'),
         data.get('customer_phone'),
+        wa_phone(data.get('customer_phone')),
         data.get('customer_email', ''),
         data.get('customer_dni', ''),
         data.get('dni_photo', ''),
+        data.get('dni_thumb', ''),
         data.get('rental_type'),
-        data.get('start_date'),
-        data.get('end_date', data.get('start_date')),
+        start_date,
+        end_date,
         data.get('start_hour', OPERATING_START),
         data.get('end_hour', OPERATING_END),
         data.get('payment_method'),
@@ -630,91 +768,118 @@ def create_reservation():
         data.get('return_location', 'sucursal'),
         data.get('total', 0),
         data.get('deposit', 0),
-        'confirmed' if data.get('payment_method') == 'transfer' else ('pending_payment' if data.get('payment_method') == 'mercadopago' else 'pending'),
-        data.get('notes', '')
+        status,
+        data.get('notes', ''),
+        mp_status
     ))
     
     # Add reservation items
-    for item in data.get('items', []):
-        cursor.execute('''
-            INSERT INTO reservation_items (reservation_id, category_id, quantity)
-            VALUES (?, ?, ?)
-        ''', (reservation_id, item['category_id'], item.get('quantity', 1)))
-    
-    # Build MP preference using the already-calculated deposit (50% of total)
-    # This avoids the previous bug where days/hours were not factored in
-    preference_items = []
-    if data.get('payment_method') == 'mercadopago':
-        deposit_amount = data.get('deposit', 0)
-        if deposit_amount > 0:
-            preference_items.append({
-                "title": "Seña (50%) - Reserva BiciSí",
-                "quantity": 1,
-                "unit_price": float(deposit_amount),
-                "currency_id": "ARS"
-            })
+    cursor.executemany('''
+        INSERT INTO reservation_items (reservation_id, category_id, quantity)
+        VALUES (?, ?, ?)
+    ''', [(reservation_id, item['category_id'], item.get('quantity', 1)) for item in data.get('items', [])])
+    
+    if status == 'confirmed':
+        apply_occupancy(cursor, reservation_id, 1)
+    return reservation_id
 
-    conn.commit()
-    conn.close()
-    
-    # Create Mercado Pago Preference if applicable
-    init_point = None
-    if data.get('payment_method') == 'mercadopago' and preference_items:
-        preference_data = {
-            "items": preference_items,
-            "payer": {
-                "name": data.get('customer_name'),
-                "email": data.get('customer_email', 'test_user@test.com'),
-                "phone": {
-                    "area_code": "",
-                    "number": data.get('customer_phone')
-                },
-                "identification": {
-                    "type": "DNI",
-                    "number": data.get('customer_dni')
-                }
-            },
-            "back_urls": {
-                "success": f"https://bicisi.com.ar/reserva?status=success&reservation_id={reservation_id}",
-                "failure": f"https://bicisi.com.ar/reserva?status=failure&reservation_id={reservation_id}",
-                "pending": f"https://bicisi.com.ar/reserva?status=pending&reservation_id={reservation_id}"
-            },
-            "auto_return": "approved",
-            "notification_url": "https://bicisi.com.ar/api/mp-webhook",
-            "external_reference": reservation_id,
-            "statement_descriptor": "BICISI RESERVA"
-        }
-        
-        try:
-            print(f"DEBUG: Creating MP preference with data: {json.dumps(preference_data, indent=2)}", flush=True)
-            print(f"DEBUG: PUBLIC_URL (hardcoded check) is: https://bicisi.com.ar", flush=True)
-            
-            preference_response = sdk.preference().create(preference_data)
-            preference = preference_response["response"]
+@app.route('/api/reservations', methods=['POST'])
+def create_reservation():
+    """Create a new reservation"""
+    data = request.json
+    
+    required = ['items', 'rental_type', 'start_date', 'customer_name', 'customer_phone', 'payment_method']
+    for field in required:
+        if not data.get(field):
+            return jsonify({"error": f"Campo requerido: {field}"}), 400
             
-            if "init_point" not in preference:
-                raise Exception(f"MP Error: {json.dumps(preference)}")
-                
-            # Use sandbox_init_point if using TEST credentials
-            if CONFIG['MP_ACCESS_TOKEN'].startswith('TEST'):
-                init_point = preference.get("sandbox_init_point", preference["init_point"])
-            else:
-                init_point = preference["init_point"]
-                
-        except Exception as e:
-            print(f"Error creating MP preference: {e}")
-            return jsonify({"error": f"Error creating payment preference: {str(e)}"}), 500
+    # Sanitize DNI (remove dots, hyphens, spaces)
+    if 'customer_dni' in data:
+        data['customer_dni'] = ''.join(filter(str.isdigit, str(data['customer_dni'])))
+    
+    # Inline data URI photos are processed like /api/upload-dni; the row keeps the URLs
+    try:
+        data['dni_photo'], thumb_url = store_dni_data_uri(data.get('dni_photo', ''))
+    except ImagePoolBusy as e:
+        print(f"Image pool busy: {e}")
+        return image_pool_busy_response()
+    except (ValueError, ImageError):
+        return jsonify({"error": "Formato de imagen no válido"}), 400
+    if thumb_url:
+        data['dni_thumb'] = thumb_url
+    
+    start_date = data.get('start_date')
+    end_date = data.get('end_date', start_date)
+    start_hour = data.get('start_hour', OPERATING_START)
+    end_hour = data.get('end_hour', OPERATING_END)
+    
+    # Full/half day bookings can't start inside today's logistics window
+    now = datetime.now()
+    today_str = now.date().isoformat()
+    rental_type = data.get('rental_type', '')
+    if rental_type in ('full_day', 'half_day') and start_date <= today_str <= end_date:
+        if block_range(start_date, end_date, start_hour, end_hour, today_str)[0] <= now.hour + 1:
+            return jsonify({"error": f"Ya pasó el límite de horario para reservar '{rental_type.replace('_', ' ')}' en el día de hoy. Por favor, pedí por horas simples."}), 400
+    
+    try:
+        reservation_id = write_transaction(book_reservation, data)
+    except BookingError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # The Mercado Pago link is created in the background; the page polls checkout_url for it
+    checkout_url = None
+    if data.get('payment_method') == 'mercadopago' and data.get('deposit', 0) > 0:
+        mp_preferences.submit(reservation_id)
+        checkout_url = url_for('reservation_checkout', reservation_id=reservation_id)
     
     return jsonify({
         "success": True,
         "reservation_id": reservation_id,
         "message": "Reserva creada exitosamente",
-        "init_point": init_point
+        "checkout_url": checkout_url
     })
 
+# Checkout preferences are created by background workers (see payments.py)
+mp_preferences = PreferenceQueue(
+    get_db, sdk, CONFIG['PUBLIC_URL'], sandbox=CONFIG['MP_ACCESS_TOKEN'].startswith('TEST')
+)
+
+@app.route('/api/reservations/<reservation_id>/checkout', methods=['GET', 'POST'])
+def reservation_checkout(reservation_id):
+    """Mercado Pago link of a reservation: {status: pending|ready|error, init_point}; POST queues it again"""
+    conn = get_db()
+    row = conn.execute(
+        "SELECT status, mp_status, mp_init_point FROM reservations WHERE id = ?", (reservation_id,)
+    ).fetchone()
+    if not row or not row['mp_status']:
+        return jsonify({"error": "Reserva no encontrada"}), 404
+    mp_status = row['mp_status']
+    
+    if request.method == 'POST' and mp_status != 'ready' and row['status'] == 'pending_payment':
+        if mp_status == 'error':
+            conn.execute("UPDATE reservations SET mp_status = 'pending', mp_error = NULL WHERE id = ?", (reservation_id,))
+            conn.commit()
+            mp_status = 'pending'
+        if not mp_preferences.submit(reservation_id):
+            return jsonify({"error": "Servidor ocupado, reintentá en unos segundos"}), 503, {'Retry-After': '5'}
+    
+    return jsonify({"status": mp_status, "init_point": row['mp_init_point'] if mp_status == 'ready' else None})
+
+# Image decode/encode runs in worker processes (see images.ImagePool)
+image_pool = ImagePool()
+IMAGE_RETRY_AFTER = 5
+
+def image_pool_busy_response():
+    """503 telling the client when to retry an upload"""
+    return (
+        jsonify({"error": "Estamos procesando muchas imágenes. Probá de nuevo en unos segundos."}),
+        503,
+        {'Retry-After': str(IMAGE_RETRY_AFTER)}
+    )
+
 @app.route('/api/upload-dni', methods=['POST'])
 def upload_dni_photo():
-    """Public endpoint to upload DNI photo and return as base64 data URI"""
+    """Public endpoint to upload a DNI photo; returns /admin/media/ URLs of the photo and its thumbnail"""
     if 'image' not in request.files:
         return jsonify({"error": "No se proporcionó imagen"}), 400
     
@@ -729,27 +894,270 @@ def upload_dni_photo():
     
     # Read file data
     image_data = file.read()
+    sha256 = hashlib.sha256(image_data).hexdigest()
     
-    # Convert HEIC/HEIF to JPEG server-side
-    if ext in ['heic', 'heif']:
-        try:
-            import pillow_heif
-            from PIL import Image
-            pillow_heif.register_heif_opener()
-            img = Image.open(io.BytesIO(image_data))
-            buf = io.BytesIO()
-            img.convert('RGB').save(buf, format='JPEG', quality=85)
-            image_data = buf.getvalue()
-            ext = 'jpeg'
-        except Exception as e:
-            print(f"Error converting HEIC: {e}")
-            return jsonify({"error": "Error al procesar imagen HEIC. Intenta convertirla a JPG."}), 400
+    # Same photo uploaded before: reuse the processed result
+    done = processed_upload(get_db().cursor(), sha256)
+    if done:
+        return jsonify(done)
     
-    base64_encoded = base64.b64encode(image_data).decode('utf-8')
-    mime_type = f"image/{'jpeg' if ext == 'jpg' else ext}"
-    data_uri = f"data:{mime_type};base64,{base64_encoded}"
+    try:
+        return jsonify(process_dni_photo(sha256, process_upload, image_data))
+    except ImagePoolBusy as e:
+        print(f"Image pool busy: {e}")
+        return image_pool_busy_response()
+    except ImageError as e:
+        print(f"Error processing DNI photo: {e}")
+        return jsonify({"error": "No se pudo procesar la imagen. Intenta con una foto JPG o PNG."}), 400
+
+# ==================== RESUMABLE UPLOADS ====================
+
+# Unfinished upload sessions are dropped after this long
+UPLOAD_TTL_HOURS = 24
+
+def processed_upload(cursor, sha256):
+    """URLs of an already processed DNI upload with this SHA-256, or None"""
+    cursor.execute("SELECT url, thumb_url FROM upload_hashes WHERE sha256 = ?", (sha256,))
+    row = cursor.fetchone()
+    return {"success": True, "url": row['url'], "thumb_url": row['thumb_url']} if row else None
+
+def process_dni_photo(sha256, fn, *args):
+    """Run fn(*args, DNI_MAX_SIZE, True) in the image pool, store the blobs and remember them by sha256.
     
-    return jsonify({"success": True, "url": data_uri})
+    Strips EXIF, downscales and recompresses (HEIC included), plus a
+    thumbnail for the admin list. Raises ImagePoolBusy or ImageError.
+    """
+    (photo, photo_ext), (thumb, thumb_ext) = image_pool.run(fn, *args, DNI_MAX_SIZE, True)
+    result = {
+        "success": True,
+        "url": store_blob(photo, photo_ext, private=True),
+        "thumb_url": store_blob(thumb, thumb_ext, private=True)
+    }
+    conn = get_db()
+    conn.execute(
+        "INSERT OR IGNORE INTO upload_hashes (sha256, url, thumb_url) VALUES (?, ?, ?)",
+        (sha256, result['url'], result['thumb_url'])
+    )
+    conn.commit()
+    return result
+
+def store_dni_data_uri(value):
+    """(url, thumb_url) of a DNI photo sent inline as a data URI, processed like /api/upload-dni.
+    
+    Other values pass through as (value, None). Raises ValueError,
+    ImageError or ImagePoolBusy.
+    """
+    data = decode_data_uri(value)
+    if data is None:
+        return value, None
+    sha256 = hashlib.sha256(data).hexdigest()
+    result = processed_upload(get_db().cursor(), sha256) or process_dni_photo(sha256, process_upload, data)
+    return result['url'], result['thumb_url']
+
+def store_category_data_uri(value):
+    """/media/ URL of a category image sent inline as a data URI, processed like /api/admin/upload-image.
+    
+    Other values pass through. Raises ValueError, ImageError or ImagePoolBusy.
+    """
+    data = decode_data_uri(value)
+    if data is None:
+        return value
+    (image, image_ext), _ = image_pool.run(process_upload, data, CATEGORY_MAX_SIZE)
+    return store_blob(image, image_ext)
+
+def expire_uploads(cursor):
+    """Drop upload sessions older than UPLOAD_TTL_HOURS with their partial files"""
+    cursor.execute(
+        "SELECT id FROM uploads WHERE created_at < datetime('now', ?)",
+        (f'-{UPLOAD_TTL_HOURS} hours',)
+    )
+    expired = [row['id'] for row in cursor.fetchall()]
+    for upload_id in expired:
+        remove_part(upload_id)
+    cursor.executemany("DELETE FROM uploads WHERE id = ?", [(upload_id,) for upload_id in expired])
+
+@app.route('/api/uploads', methods=['POST'])
+def start_upload():
+    """Start or resume a chunked DNI upload: {size, sha256} of the whole file"""
+    data = request.json or {}
+    sha256 = str(data.get('sha256', '')).lower()
+    size = data.get('size')
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256) or not isinstance(size, int) or not 0 < size <= MAX_UPLOAD_SIZE:
+        return jsonify({"error": "sha256 and size (max 16MB) required"}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    # Same photo already processed: nothing left to upload
+    done = processed_upload(cursor, sha256)
+    if done:
+        return jsonify(dict(done, complete=True))
+    
+    expire_uploads(cursor)
+    
+    # Resume an unfinished session for the same file (e.g. after a page reload)
+    cursor.execute(
+        "SELECT id, received FROM uploads WHERE sha256 = ? AND size = ? AND status = 'uploading'",
+        (sha256, size)
+    )
+    row = cursor.fetchone()
+    if row and os.path.exists(part_path(row['id'])):
+        upload_id, received = row['id'], row['received']
+    else:
+        if row:
+            cursor.execute("DELETE FROM uploads WHERE id = ?", (row['id'],))
+        upload_id, received = str(uuid.uuid4()), 0
+        create_part(upload_id)
+        cursor.execute("INSERT INTO uploads (id, sha256, size) VALUES (?, ?, ?)", (upload_id, sha256, size))
+    conn.commit()
+    
+    return jsonify({
+        "complete": False,
+        "upload_id": upload_id,
+        "size": size,
+        "received": received,
+        "chunk_size": CHUNK_SIZE
+    })
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'PUT'])
+def upload_chunk(upload_id):
+    """Report progress, or write the request body as the chunk at ?offset="""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT size, received, status FROM uploads WHERE id = ?", (upload_id,))
+    row = cursor.fetchone()
+    if not row:
+        return jsonify({"error": "Upload not found"}), 404
+    
+    if request.method == 'GET':
+        return jsonify({"size": row['size'], "received": row['received']})
+    if row['status'] != 'uploading':
+        return jsonify({"error": "Upload already finalized"}), 409
+    
+    offset = request.args.get('offset', type=int)
+    if offset is None or offset < 0:
+        return jsonify({"error": "offset required"}), 400
+    if offset > row['received']:
+        # A gap: tell the client where to continue from
+        return jsonify({"error": "Chunk out of order", "received": row['received']}), 409
+    
+    # Chunks are written in place, so a retried chunk just rewrites the same bytes
+    try:
+        written = write_chunk(upload_id, offset, request.stream, row['size'])
+    except ChunkError:
+        return jsonify({"error": "Chunk exceeds upload size"}), 400
+    except FileNotFoundError:
+        return jsonify({"error": "Upload not found"}), 404
+    
+    received = max(row['received'], offset + written)
+    cursor.execute("UPDATE uploads SET received = MAX(received, ?) WHERE id = ?", (received, upload_id))
+    conn.commit()
+    return jsonify({"size": row['size'], "received": received})
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """Verify the SHA-256 of a complete upload and process it like /api/upload-dni"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT sha256, size, received FROM uploads WHERE id = ?", (upload_id,))
+    row = cursor.fetchone()
+    if not row:
+        return jsonify({"error": "Upload not found"}), 404
+    if row['received'] < row['size']:
+        return jsonify({"error": "Upload incomplete", "received": row['received']}), 409
+    
+    # Only one finalize reads the part file; a repeat gets the stored result
+    cursor.execute("UPDATE uploads SET status = 'finalizing' WHERE id = ? AND status = 'uploading'", (upload_id,))
+    claimed = cursor.rowcount
+    conn.commit()
+    if not claimed:
+        done = processed_upload(cursor, row['sha256'])
+        if done:
+            return jsonify(done)
+        return jsonify({"error": "Upload already being processed"}), 409
+    
+    path = part_path(upload_id)
+    if file_sha256(path) != row['sha256']:
+        remove_part(upload_id)
+        cursor.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+        conn.commit()
+        return jsonify({"error": "La foto llegó dañada. Volvé a subirla."}), 400
+    
+    try:
+        result = process_dni_photo(row['sha256'], process_file, path)
+    except ImagePoolBusy as e:
+        # Keep the session so finalize can simply be retried
+        print(f"Image pool busy: {e}")
+        cursor.execute("UPDATE uploads SET status = 'uploading' WHERE id = ?", (upload_id,))
+        conn.commit()
+        return image_pool_busy_response()
+    except ImageError as e:
+        print(f"Error processing DNI photo: {e}")
+        result = None
+    
+    remove_part(upload_id)
+    if result:
+        # Kept until it expires so a repeated finalize can be answered
+        cursor.execute("UPDATE uploads SET status = 'done' WHERE id = ?", (upload_id,))
+    else:
+        cursor.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+    conn.commit()
+    if not result:
+        return jsonify({"error": "No se pudo procesar la imagen. Intenta con una foto JPG o PNG."}), 400
+    return jsonify(result)
+
+# Blobs are content-addressed, so a URL's bytes never change
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
+# Resized WebP copies for ?w= requests
+variant_cache = VariantCache()
+
+@app.template_global()
+def media_srcset(url):
+    """srcset for a /media/ image URL, or '' for anything else"""
+    return srcset(url) if url and url.startswith(MEDIA_URL) else ''
+
+@app.template_global()
+def media_src(url, width):
+    """URL of a /media/ image resized to width; other URLs pass through"""
+    return f"{url}?w={width}" if url and url.startswith(MEDIA_URL) else url
+
+@app.route('/media/<name>')
+def serve_media(name):
+    """Stream a blob (or its ?w= width variant) with immutable caching headers"""
+    blob = resolve_blob(name)
+    if not blob:
+        return jsonify({"error": "Not found"}), 404
+    path, mime_type = blob
+    etag = name.split('.')[0]
+    
+    max_age = MEDIA_MAX_AGE
+    width = request.args.get('w', type=int)
+    if width and width > 0 and mime_type.startswith('image/') and mime_type != 'image/gif':
+        width = snap_width(width)
+        try:
+            path = variant_cache.get(name, width, lambda: image_pool.run(variant_file, blob[0], width))
+            mime_type, etag = 'image/webp', f"{etag}-{width}"
+        except (ImagePoolBusy, ImageError) as e:
+            # The original still renders fine, just heavier; don't let it stick to the variant URL
+            print(f"Image variant {name}?w={width} unavailable: {e}")
+            max_age = 60
+    
+    response = send_file(path, mimetype=mime_type, etag=etag, conditional=True)
+    response.headers['Cache-Control'] = f'public, max-age={max_age}' + (', immutable' if max_age == MEDIA_MAX_AGE else '')
+    return response
+
+@app.route('/admin/media/<name>')
+@login_required
+def serve_private_media(name):
+    """Stream a customer document (DNI photo, WhatsApp attachment); never cached outside the browser session"""
+    blob = resolve_blob(name, private=True)
+    if not blob:
+        return jsonify({"error": "Not found"}), 404
+    path, mime_type = blob
+    response = send_file(path, mimetype=mime_type)
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
 
 # ==================== ADMIN ROUTES ====================
 
@@ -781,7 +1189,6 @@ def admin_login():
             (username, hash_password(password))
         )
         admin = cursor.fetchone()
-        conn.close()
         
         if admin:
             session['admin_logged_in'] = True
@@ -817,6 +1224,13 @@ def admin_categories():
     
     data = request.json
     new_id = str(uuid.uuid4())
+    try:
+        image = store_category_data_uri(data.get('image', '/static/images/default-bike.jpg'))
+    except ImagePoolBusy as e:
+        print(f"Image pool busy: {e}")
+        return image_pool_busy_response()
+    except (ValueError, ImageError):
+        return jsonify({"error": "Formato de imagen no válido"}), 400
     
     cursor.execute('''
         INSERT INTO categories (id, name, description, price_full_day, price_half_day, price_per_hour, stock, image)
@@ -829,11 +1243,11 @@ def admin_categories():
         data.get('price_half_day', 0),
         data.get('price_per_hour', 0),
         data.get('stock', 0),
-        data.get('image', '/static/images/default-bike.jpg')
+        image
     ))
+    catalog_changed(cursor)
     
     conn.commit()
-    conn.close()
     
     return jsonify({"success": True, "id": new_id})
 
@@ -845,12 +1259,25 @@ def admin_category_detail(category_id):
     cursor = conn.cursor()
     
     if request.method == 'DELETE':
-        cursor.execute("DELETE FROM categories WHERE id = ?", (category_id,))
+        try:
+            cursor.execute("DELETE FROM categories WHERE id = ?", (category_id,))
+        except sqlite3.IntegrityError:
+            # foreign_keys=ON: reservation_items still point at this category
+            conn.rollback()
+            return jsonify({"error": "No se puede eliminar una categoría con reservas asociadas"}), 400
+        catalog_changed(cursor)
         conn.commit()
-        conn.close()
         return jsonify({"success": True})
     
     data = request.json
+    try:
+        image = store_category_data_uri(data.get('image'))
+    except ImagePoolBusy as e:
+        print(f"Image pool busy: {e}")
+        return image_pool_busy_response()
+    except (ValueError, ImageError):
+        return jsonify({"error": "Formato de imagen no válido"}), 400
+    
     cursor.execute('''
         UPDATE categories SET
             name = ?, description = ?, price_full_day = ?, price_half_day = ?,
@@ -863,19 +1290,44 @@ def admin_category_detail(category_id):
         data.get('price_half_day'),
         data.get('price_per_hour'),
         data.get('stock'),
-        data.get('image'),
+        image,
         datetime.now().isoformat(),
         category_id
     ))
+    catalog_changed(cursor)
     
     conn.commit()
-    conn.close()
     return jsonify({"success": True})
 
+# Admin reservation list paging
+ADMIN_PAGE_SIZE = 50
+ADMIN_MAX_PAGE_SIZE = 200
+ADMIN_LIST_COLUMNS = ', '.join(f"r.{column}" for column in (
+    'id', 'customer_name', 'customer_phone', 'customer_email', 'customer_dni', 'dni_thumb',
+    'rental_type', 'start_date', 'end_date', 'start_hour', 'end_hour',
+    'payment_method', 'pickup_location', 'return_location', 'total', 'deposit',
+    'status', 'notes', 'created_at'
+))
+
+def fetch_reservation_items(cursor, reservation_ids):
+    """Items of several reservations in one query, as {reservation_id: [item, ...]}"""
+    items = {}
+    if not reservation_ids:
+        return items
+    cursor.execute(f'''
+        SELECT ri.*, c.name as category_name
+        FROM reservation_items ri
+        JOIN categories c ON ri.category_id = c.id
+        WHERE ri.reservation_id IN ({', '.join('?' * len(reservation_ids))})
+    ''', reservation_ids)
+    for item in cursor.fetchall():
+        items.setdefault(item['reservation_id'], []).append(dict(item))
+    return items
+
 @app.route('/api/admin/reservations', methods=['GET', 'POST'])
 @login_required
 def admin_reservations():
-    """Get all reservations or create a new one as admin without limits"""
+    """List reservations page by page or create a new one as admin without limits"""
     conn = get_db()
     cursor = conn.cursor()
     
@@ -883,20 +1335,41 @@ def admin_reservations():
         data = request.json
         reservation_id = str(uuid.uuid4())
         
+        # No stock checks here, but every item must name an existing category
+        items = data.get('items', [])
+        category_ids = {item.get('category_id') for item in items}
+        cursor.execute(
+            f"SELECT id FROM categories WHERE id IN ({', '.join('?' * len(category_ids))})",
+            list(category_ids)
+        )
+        unknown = category_ids - {row['id'] for row in cursor.fetchall()}
+        if unknown:
+            return jsonify({"error": f"Categoría no encontrada: {', '.join(sorted(map(str, unknown)))}"}), 400
+        
+        try:
+            dni_photo, dni_thumb = store_dni_data_uri(data.get('dni_photo', ''))
+        except ImagePoolBusy as e:
+            print(f"Image pool busy: {e}")
+            return image_pool_busy_response()
+        except (ValueError, ImageError):
+            return jsonify({"error": "Formato de imagen no válido"}), 400
+        
         # Insert without stock validations
         cursor.execute('''
             INSERT INTO reservations (
-                id, customer_name, customer_phone, customer_email, customer_dni, dni_photo,
+                id, customer_name, customer_phone, wa_phone, customer_email, customer_dni, dni_photo, dni_thumb,
                 rental_type, start_date, end_date, start_hour, end_hour,
                 payment_method, pickup_location, return_location, total, deposit, status, notes
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             reservation_id,
             data.get('customer_name', 'Admin Reservation'),
             data.get('customer_phone', ''),
+            wa_phone(data.get('customer_phone', '')),
             data.get('customer_email', ''),
             data.get('customer_dni', ''),
-            data.get('dni_photo', ''),
+            dni_photo,
+            dni_thumb or data.get('dni_thumb', ''),
             data.get('rental_type', 'full_day'),
             data.get('start_date', datetime.now().strftime('%Y-%m-%d')),
             data.get('end_date', data.get('start_date', datetime.now().strftime('%Y-%m-%d'))),
@@ -912,80 +1385,102 @@ def admin_reservations():
         ))
         
         # Add reservation items
-        for item in data.get('items', []):
+        for item in items:
             cursor.execute('''
                 INSERT INTO reservation_items (reservation_id, category_id, quantity)
                 VALUES (?, ?, ?)
             ''', (reservation_id, item['category_id'], item.get('quantity', 1)))
-            
+        
+        apply_occupancy(cursor, reservation_id, 1)
         conn.commit()
-        conn.close()
         return jsonify({"success": True, "reservation_id": reservation_id, "message": "Reserva admin creada exitosamente"})
     
     
-    cursor.execute('''
-        SELECT r.*, GROUP_CONCAT(c.name || ' x' || ri.quantity, ', ') as items_str
-        FROM reservations r
-        LEFT JOIN reservation_items ri ON r.id = ri.reservation_id
-        LEFT JOIN categories c ON ri.category_id = c.id
-        WHERE r.status != 'pending_payment'
-        GROUP BY r.id
-        ORDER BY r.created_at DESC
-    ''')
+    # Newest first, one page at a time: ?status=&from=&to=&cursor=&limit=
+    filters = ["r.status != 'pending_payment'"]
+    params = []
+    if request.args.get('status'):
+        filters.append("r.status = ?")
+        params.append(request.args['status'])
+    if request.args.get('from'):
+        filters.append("r.start_date >= ?")
+        params.append(request.args['from'])
+    if request.args.get('to'):
+        filters.append("r.start_date <= ?")
+        params.append(request.args['to'])
+    if request.args.get('cursor'):
+        # Opaque "created_at|id" of the last row of the previous page
+        created_at, _, last_id = request.args['cursor'].partition('|')
+        filters.append("(r.created_at, r.id) < (?, ?)")
+        params += [created_at, last_id]
+    try:
+        limit = min(max(int(request.args.get('limit', ADMIN_PAGE_SIZE)), 1), ADMIN_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
     
-    reservations = []
-    for row in cursor.fetchall():
-        res = dict(row)
-        # Get items separately for detailed view
-        cursor.execute('''
-            SELECT ri.*, c.name as category_name
-            FROM reservation_items ri
-            JOIN categories c ON ri.category_id = c.id
-            WHERE ri.reservation_id = ?
-        ''', (res['id'],))
-        res['items'] = [dict(item) for item in cursor.fetchall()]
-        reservations.append(res)
-    
-    conn.close()
-    return jsonify(reservations)
-
-@app.route('/api/admin/reservations/<reservation_id>', methods=['PUT', 'DELETE'])
+    # The DNI photo is left out of the list; GET /api/admin/reservations/<id> has it
+    cursor.execute(f'''
+        SELECT {ADMIN_LIST_COLUMNS}, r.dni_photo != '' AS has_dni_photo
+        FROM reservations r
+        WHERE {' AND '.join(filters)}
+        ORDER BY r.created_at DESC, r.id DESC
+        LIMIT ?
+    ''', params + [limit + 1])
+    rows = cursor.fetchall()
+    page = [dict(row) for row in rows[:limit]]
+    
+    # Items of the whole page in one query
+    items = fetch_reservation_items(cursor, [res['id'] for res in page])
+    for res in page:
+        res['has_dni_photo'] = bool(res['has_dni_photo'])
+        res['items'] = items.get(res['id'], [])
+    
+    next_cursor = f"{page[-1]['created_at']}|{page[-1]['id']}" if len(rows) > limit else None
+    return jsonify({"reservations": page, "next_cursor": next_cursor})
+
+@app.route('/api/admin/reservations/<reservation_id>', methods=['GET', 'PUT', 'DELETE'])
 @login_required
 def admin_reservation_detail(reservation_id):
-    """Update or delete a reservation"""
+    """Get (with DNI photo), update or delete a reservation"""
     conn = get_db()
     cursor = conn.cursor()
     
+    if request.method == 'GET':
+        cursor.execute("SELECT * FROM reservations WHERE id = ?", (reservation_id,))
+        row = cursor.fetchone()
+        if not row:
+            return jsonify({"error": "Reservation not found"}), 404
+        res = dict(row)
+        res['items'] = fetch_reservation_items(cursor, [reservation_id]).get(reservation_id, [])
+        cursor.execute('''
+            SELECT kind, mime_type, url, thumb_url, created_at FROM wa_media
+            WHERE reservation_id = ? AND status = 'done'
+            ORDER BY created_at
+        ''', (reservation_id,))
+        res['attachments'] = [dict(r) for r in cursor.fetchall()]
+        return jsonify(res)
+    
     if request.method == 'DELETE':
+        set_reservation_status(cursor, reservation_id, 'deleted')
         cursor.execute("DELETE FROM reservation_items WHERE reservation_id = ?", (reservation_id,))
         cursor.execute("DELETE FROM reservations WHERE id = ?", (reservation_id,))
         conn.commit()
-        conn.close()
         return jsonify({"success": True})
     
     data = request.json
-    updates = []
-    params = []
     
     if 'status' in data:
-        updates.append("status = ?")
-        params.append(data['status'])
+        set_reservation_status(cursor, reservation_id, data['status'])
     if 'notes' in data:
-        updates.append("notes = ?")
-        params.append(data['notes'])
-    
-    if updates:
-        params.append(reservation_id)
-        cursor.execute(f"UPDATE reservations SET {', '.join(updates)} WHERE id = ?", params)
-        conn.commit()
+        cursor.execute("UPDATE reservations SET notes = ? WHERE id = ?", (data['notes'], reservation_id))
+    conn.commit()
     
-    conn.close()
     return jsonify({"success": True})
 
 @app.route('/api/admin/upload-image', methods=['POST'])
 @login_required
 def upload_image():
-    """Upload category image and return as base64 data URI"""
+    """Upload category image and return its /media/ URL"""
     if 'image' not in request.files:
         return jsonify({"error": "No image provided"}), 400
     
@@ -1001,26 +1496,17 @@ def upload_image():
     # Read file data
     image_data = file.read()
     
-    # Convert HEIC/HEIF to JPEG server-side
-    if ext in ['heic', 'heif']:
-        try:
-            import pillow_heif
-            from PIL import Image
-            pillow_heif.register_heif_opener()
-            img = Image.open(io.BytesIO(image_data))
-            buf = io.BytesIO()
-            img.convert('RGB').save(buf, format='JPEG', quality=85)
-            image_data = buf.getvalue()
-            ext = 'jpeg'
-        except Exception as e:
-            print(f"Error converting HEIC: {e}")
-            return jsonify({"error": "Error al procesar imagen HEIC. Intenta convertirla a JPG."}), 400
-    
-    base64_encoded = base64.b64encode(image_data).decode('utf-8')
-    mime_type = f"image/{'jpeg' if ext == 'jpg' else ext}"
-    data_uri = f"data:{mime_type};base64,{base64_encoded}"
+    # Strip EXIF, downscale and recompress (HEIC included)
+    try:
+        (image, image_ext), _ = image_pool.run(process_upload, image_data, CATEGORY_MAX_SIZE)
+    except ImagePoolBusy as e:
+        print(f"Image pool busy: {e}")
+        return image_pool_busy_response()
+    except ImageError as e:
+        print(f"Error processing category image: {e}")
+        return jsonify({"error": "No se pudo procesar la imagen. Intenta con una foto JPG o PNG."}), 400
     
-    return jsonify({"success": True, "url": data_uri})
+    return jsonify({"success": True, "url": store_blob(image, image_ext)})
 
 @app.route('/api/admin/stats')
 @login_required
@@ -1031,38 +1517,20 @@ def admin_stats():
     
     today = datetime.now().date().isoformat()
     
-    cursor.execute("SELECT COUNT(*) as total FROM reservations WHERE status != 'pending_payment'")
-    total = cursor.fetchone()['total']
-    
-    cursor.execute("SELECT COUNT(*) as count FROM reservations WHERE status = 'pending'")
-    pending = cursor.fetchone()['count']
-    
-    cursor.execute("SELECT COUNT(*) as count FROM reservations WHERE status = 'confirmed'")
-    confirmed = cursor.fetchone()['count']
-    
-    cursor.execute("SELECT COUNT(*) as count FROM reservations WHERE start_date = ? AND status != 'pending_payment'", (today,))
-    today_count = cursor.fetchone()['count']
-    
-    cursor.execute("SELECT COALESCE(SUM(total), 0) as revenue FROM reservations WHERE status = 'confirmed'")
-    revenue = cursor.fetchone()['revenue']
-    
-    cursor.execute("SELECT COALESCE(SUM(stock), 0) as stock FROM categories")
-    stock = cursor.fetchone()['stock']
-    
-    cursor.execute("SELECT COUNT(*) as count FROM categories")
-    cat_count = cursor.fetchone()['count']
-    
-    conn.close()
-    
-    return jsonify({
-        "total_reservations": total,
-        "pending": pending,
-        "confirmed": confirmed,
-        "today": today_count,
-        "total_revenue": revenue,
-        "total_stock": stock,
-        "categories_count": cat_count
-    })
+    # One pass over the daily_stats rollup (kept up to date by triggers)
+    cursor.execute('''
+        SELECT
+            COALESCE(SUM(CASE WHEN status != 'pending_payment' THEN reservations END), 0) AS total_reservations,
+            COALESCE(SUM(CASE WHEN status = 'pending' THEN reservations END), 0) AS pending,
+            COALESCE(SUM(CASE WHEN status = 'confirmed' THEN reservations END), 0) AS confirmed,
+            COALESCE(SUM(CASE WHEN date = ? AND status != 'pending_payment' THEN reservations END), 0) AS today,
+            COALESCE(SUM(CASE WHEN status = 'confirmed' THEN revenue END), 0) AS total_revenue,
+            (SELECT COALESCE(SUM(stock), 0) FROM categories) AS total_stock,
+            (SELECT COUNT(*) FROM categories) AS categories_count
+        FROM daily_stats
+    ''', (today,))
+    
+    return jsonify(dict(cursor.fetchone()))
 
 @app.route('/api/admin/default-messages')
 @login_required
@@ -1086,7 +1554,6 @@ def admin_settings():
         # This allows the frontend to show placeholders for the rest
         cursor.execute("SELECT key, value FROM settings")
         db_settings = {row['key']: row['value'] for row in cursor.fetchall()}
-        conn.close()
         return jsonify(db_settings)
     
     data = request.json
@@ -1095,9 +1562,10 @@ def admin_settings():
             "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
             (key, str(value))
         )
+    # Invalidates the settings cache of every worker
+    bump_version(cursor, 'settings')
     
     conn.commit()
-    conn.close()
     return jsonify({"success": True})
 
 @app.route('/api/admin/change-password', methods=['POST'])
@@ -1117,43 +1585,29 @@ def change_password():
         (hash_password(new_password), session.get('admin_username', 'admin'))
     )
     conn.commit()
-    conn.close()
     
     return jsonify({"success": True, "message": "Contraseña actualizada"})
 
-# WhatsApp Payloads
-PAYLOAD_MENU = "MENU_PRINCIPAL"
-PAYLOAD_PLANES = "VER_PLANES"
-PAYLOAD_RESERVAR = "COMO_RESERVAR"
-PAYLOAD_UBICACION = "VER_UBICACION"
-PAYLOAD_ECO = "DETALLE_ECO"
-PAYLOAD_FULL = "DETALLE_FULL"
-PAYLOAD_PAGO = "DATOS_PAGO"
-
-def send_whatsapp_message(to, data):
-    url = f"https://graph.facebook.com/{WA_VERSION}/{WA_PHONE_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {WA_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to,
-        "recipient_type": "individual",
-    }
-    payload.update(data)
-    
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"Error enviando mensaje: {e}")
-        if 'response' in locals() and response is not None:
-             print(f"Detalle error Facebook: {response.text}")
-
-def send_wa_text(to, text):
+# Outbound messages go through a background queue (see wa_sender.py)
+wa_sender = WhatsAppSender(f"https://graph.facebook.com/{WA_VERSION}/{WA_PHONE_ID}/messages", WA_TOKEN)
+
+def send_whatsapp_message(to, data, callback=None):
+    """Queue a message for the WhatsApp Cloud API; returns False if the queue is full"""
+    queued = wa_sender.send(to, data, callback)
+    if queued:
+        # A bot reply went out: the inbox must not run this message again
+        wa_inbox.replied()
+    return queued
+
+@app.route('/api/admin/whatsapp-metrics')
+@login_required
+def whatsapp_metrics():
+    """Outbound WhatsApp queue counters and inbound queue depth"""
+    return jsonify(dict(wa_sender.stats(), inbox=wa_inbox.stats()))
+
+def send_wa_text(to, text, callback=None):
     data = {"type": "text", "text": {"body": text}}
-    send_whatsapp_message(to, data)
+    return send_whatsapp_message(to, data, callback)
 
 def send_wa_buttons(to, text, buttons):
     action_buttons = []
@@ -1170,7 +1624,194 @@ def send_wa_buttons(to, text, buttons):
             "action": {"buttons": action_buttons}
         }
     }
-    send_whatsapp_message(to, data)
+    return send_whatsapp_message(to, data)
+
+# Keyword router, rebuilt whenever the settings change (see intents.py)
+intent_router_cache = VersionedCache(settings_key, lambda cursor: build_router(settings_cache.get(cursor)))
+
+def get_intent_router():
+    """Intent router compiled from the current settings"""
+    return intent_router_cache.get(get_db().cursor())
+
+MAIN_MENU_BUTTONS = [
+    (PAYLOAD_PLANES, "Ver Planes 🚲"),
+    (PAYLOAD_RESERVAR, "Cómo Reservar 📝"),
+    (PAYLOAD_UBICACION, "Ubicación 📍")
+]
+
+def wa_menu(sender, settings):
+    welcome_text = settings.get('msg_welcome', '¡Hola! Bienvenidos a BiciSí.')
+    send_wa_buttons(sender, welcome_text, MAIN_MENU_BUTTONS)
+
+def wa_planes(sender, settings):
+    text = settings.get('msg_planes', 'Nuestros planes...')
+    buttons = [
+        (PAYLOAD_ECO, "Más sobre ECO"),
+        (PAYLOAD_FULL, "Más sobre FULL"),
+        (PAYLOAD_RESERVAR, "Quiero Reservar")
+    ]
+    send_wa_buttons(sender, text, buttons)
+
+def wa_eco(sender, settings):
+    text = settings.get('msg_eco', 'Detalle ECO...')
+    buttons = [(PAYLOAD_RESERVAR, "Reservar ECO"), (PAYLOAD_PLANES, "Ver otras opciones")]
+    send_wa_buttons(sender, text, buttons)
+
+def wa_full(sender, settings):
+    text = settings.get('msg_full', 'Detalle FULL...')
+    buttons = [(PAYLOAD_RESERVAR, "Reservar FULL"), (PAYLOAD_PLANES, "Ver otras opciones")]
+    send_wa_buttons(sender, text, buttons)
+
+def wa_reservar(sender, settings):
+    # URL base para links
+    base_url = CONFIG.get('PUBLIC_URL', 'http://localhost:5001')
+    link_text = settings.get('msg_reserva', 'Link de reserva: {url}/reserva').replace('{url}', base_url)
+    send_wa_text(sender, link_text)
+    buttons = [
+        (PAYLOAD_PLANES, "Ver Planes 🚲"),
+        (PAYLOAD_DISPONIBILIDAD, "Disponibilidad 📅"),
+        (PAYLOAD_UBICACION, "Ubicación 📍")
+    ]
+    send_wa_buttons(sender, "¿Te gustaría consultar algo más?", buttons)
+
+def wa_pago(sender, settings):
+    header = settings.get('msg_pago_header', '🏦 *Datos Bancarios para la Seña:*')
+    text = (
+        f"{header}\n\n"
+        f"🔹 *Banco:* {settings.get('bank_name', 'Francés BBVA')}\n"
+        f"🔹 *Titular:* {settings.get('bank_holder', 'Lucas Brunazzi')}\n"
+        f"🔹 *Alias:* {settings.get('bank_alias', 'BICISI.26')}\n"
+        f"🔹 *CBU:* {settings.get('bank_cbu', '0170274540000002278483')}\n"
+        f"🔹 *Cuenta:* {settings.get('bank_account', '274-22784/8')}\n\n"
+        "⚠️ *Importante:* Envía el comprobante por aquí para agendar tu bici."
+    )
+    send_wa_text(sender, text)
+
+def wa_ubicacion(sender, settings):
+    text = settings.get('msg_ubicacion', 'Nuestra ubicación...')
+    send_wa_buttons(sender, text, [(PAYLOAD_MENU, "Volver al Menú")])
+
+def wa_default(sender, settings):
+    default_text = settings.get('msg_default', 'No entendí tu mensaje.')
+    buttons = [(PAYLOAD_MENU, "Ir al Menú"), (PAYLOAD_RESERVAR, "Ayuda / Reservar")]
+    send_wa_buttons(sender, default_text, buttons)
+
+def wa_custom(sender, settings, intent):
+    """Intents added from settings (kw_<intent>) answer with msg_<intent>"""
+    text = settings.get(f'msg_{intent}')
+    if not text:
+        return wa_default(sender, settings)
+    send_wa_buttons(sender, text, [(PAYLOAD_MENU, "Volver al Menú")])
+
+# ==================== WHATSAPP AVAILABILITY FLOW ====================
+
+# Where each sender is in a multi-step flow (see conversations.py)
+conversations = ConversationStore(get_db)
+
+# Flow-only buttons (not intents: they only mean something mid-flow)
+PAYLOAD_CONFIRMAR = "CONFIRMAR_RESERVA"
+PAYLOAD_CANCELAR = "CANCELAR_CONSULTA"
+
+WA_MAX_QUANTITY = 20
+
+WA_DATE = re.compile(r'(\d{1,2})[/-](\d{1,2})(?:[/-](\d{2,4}))?')
+
+def parse_wa_date(text):
+    """Date from 'hoy', 'mañana', 'pasado mañana' or dd/mm[/yyyy]; None if invalid or past"""
+    text = normalize(text)
+    today = datetime.now().date()
+    if 'pasado manana' in text:
+        return today + timedelta(days=2)
+    if 'manana' in text:
+        return today + timedelta(days=1)
+    if 'hoy' in text:
+        return today
+    match = WA_DATE.search(text)
+    if not match:
+        return None
+    day, month, year = match.groups()
+    year = int(year) + 2000 if year and len(year) == 2 else int(year or today.year)
+    try:
+        date = datetime(year, int(month), int(day)).date()
+    except ValueError:
+        return None
+    if date < today and not match.group(3):
+        # "15/01" in December means next January
+        date = date.replace(year=date.year + 1)
+    return date if date >= today else None
+
+def wa_disponibilidad(sender, settings):
+    conversations.set(sender, 'fecha')
+    send_wa_text(sender, "📅 ¿Para qué fecha querés las bicis? (ej: 15/01, hoy o mañana)")
+
+def wa_step_fecha(sender, settings, text, payload, data):
+    date = parse_wa_date(text)
+    if not date:
+        conversations.set(sender, 'fecha')
+        send_wa_text(sender, "No entendí la fecha 🤔 Escribila como día/mes, por ejemplo 15/01.")
+        return
+    conversations.set(sender, 'cantidad', {"date": date.isoformat()})
+    send_wa_text(sender, f"🚲 ¿Cuántas bicis necesitás para el {date.strftime('%d/%m')}?")
+
+def wa_step_cantidad(sender, settings, text, payload, data):
+    match = re.search(r'\d+', text)
+    quantity = int(match.group()) if match else 0
+    if not 0 < quantity <= WA_MAX_QUANTITY:
+        conversations.set(sender, 'cantidad', data)
+        send_wa_text(sender, f"Decime un número de bicis entre 1 y {WA_MAX_QUANTITY}.")
+        return
+    
+    date_str = data['date']
+    cursor = get_db().cursor()
+    lines = []
+    any_free = False
+    for category_id, row in get_catalog().prices.items():
+        free = row.stock - engine.max_usage(cursor, category_id, date_str, date_str, OPERATING_START, OPERATING_END)
+        any_free = any_free or free >= quantity
+        lines.append(f"{'✅' if free >= quantity else '❌'} {row.name}: {max(free, 0)} disponibles")
+    day = datetime.strptime(date_str, '%Y-%m-%d').strftime('%d/%m')
+    text = f"📋 *Disponibilidad para el {day}* ({quantity} unidad/es, día completo):\n\n" + "\n".join(sorted(lines))
+    
+    if any_free:
+        conversations.set(sender, 'confirmar', dict(data, quantity=quantity))
+        buttons = [(PAYLOAD_CONFIRMAR, "Sí, reservar ✅"), (PAYLOAD_CANCELAR, "No, gracias")]
+        send_wa_buttons(sender, text + "\n\n¿Querés reservar?", buttons)
+    else:
+        conversations.clear(sender)
+        buttons = [(PAYLOAD_DISPONIBILIDAD, "Otra fecha 📅"), (PAYLOAD_MENU, "Volver al Menú")]
+        send_wa_buttons(sender, text + "\n\nNo nos alcanza para esa fecha 😔", buttons)
+
+def wa_step_confirmar(sender, settings, text, payload, data):
+    reply = normalize(text)
+    if payload == PAYLOAD_CONFIRMAR or reply in ('si', 'dale', 'ok'):
+        conversations.clear(sender)
+        wa_reservar(sender, settings)
+    elif payload == PAYLOAD_CANCELAR or reply in ('no', 'no gracias'):
+        conversations.clear(sender)
+        wa_menu(sender, settings)
+    else:
+        conversations.set(sender, 'confirmar', data)
+        buttons = [(PAYLOAD_CONFIRMAR, "Sí, reservar ✅"), (PAYLOAD_CANCELAR, "No, gracias")]
+        send_wa_buttons(sender, "¿Querés reservar para esa fecha?", buttons)
+
+# Flow step -> handler of the sender's next message
+WA_STEPS = {
+    'fecha': wa_step_fecha,
+    'cantidad': wa_step_cantidad,
+    'confirmar': wa_step_confirmar,
+}
+
+# Flujo de conversación: intent -> respuesta
+WA_FLOWS = {
+    'menu': wa_menu,
+    'planes': wa_planes,
+    'eco': wa_eco,
+    'full': wa_full,
+    'disponibilidad': wa_disponibilidad,
+    'reservar': wa_reservar,
+    'pago': wa_pago,
+    'ubicacion': wa_ubicacion,
+}
 
 def handle_wa_message(sender, message_body, message_type):
     msg_text = ""
@@ -1178,7 +1819,7 @@ def handle_wa_message(sender, message_body, message_type):
     settings = get_settings()
     
     if message_type == "text":
-        msg_text = message_body["text"]["body"].lower().strip()
+        msg_text = message_body["text"]["body"]
         print(f"📩 {sender} escribió: {msg_text}")
     elif message_type == "interactive":
         type_interactive = message_body["interactive"]["type"]
@@ -1187,80 +1828,30 @@ def handle_wa_message(sender, message_body, message_type):
             title = message_body["interactive"]["button_reply"]["title"]
             msg_text = title
             print(f"🔘 {sender} tocó botón: {title} (ID: {payload})")
-
-    # URL base para links
-    base_url = CONFIG.get('PUBLIC_URL', 'http://localhost:5001')
-
-    # Flujo de conversación
-    if payload == PAYLOAD_MENU or any(x in msg_text for x in ["hola", "buen dia", "buenas", "inicio", "menu"]):
-        welcome_text = settings.get('msg_welcome', '¡Hola! Bienvenidos a BiciSí.')
-        buttons = [
-            (PAYLOAD_PLANES, "Ver Planes 🚲"),
-            (PAYLOAD_RESERVAR, "Cómo Reservar 📝"),
-            (PAYLOAD_UBICACION, "Ubicación 📍")
-        ]
-        send_wa_buttons(sender, welcome_text, buttons)
-        return
-
-    if payload == PAYLOAD_PLANES or "planes" in msg_text or "precio" in msg_text:
-        text = settings.get('msg_planes', 'Nuestros planes...')
-        buttons = [
-            (PAYLOAD_ECO, "Más sobre ECO"),
-            (PAYLOAD_FULL, "Más sobre FULL"),
-            (PAYLOAD_RESERVAR, "Quiero Reservar")
-        ]
-        send_wa_buttons(sender, text, buttons)
-        return
-
-    if payload == PAYLOAD_ECO:
-        text = settings.get('msg_eco', 'Detalle ECO...')
-        buttons = [(PAYLOAD_RESERVAR, "Reservar ECO"), (PAYLOAD_PLANES, "Ver otras opciones")]
-        send_wa_buttons(sender, text, buttons)
-        return
-
-    if payload == PAYLOAD_FULL:
-        text = settings.get('msg_full', 'Detalle FULL...')
-        buttons = [(PAYLOAD_RESERVAR, "Reservar FULL"), (PAYLOAD_PLANES, "Ver otras opciones")]
-        send_wa_buttons(sender, text, buttons)
-        return
-
-    if payload == PAYLOAD_RESERVAR or "reservar" in msg_text:
-        link_text = settings.get('msg_reserva', 'Link de reserva: {url}/reserva').replace('{url}', base_url)
-        send_wa_text(sender, link_text)
-        
-        menu_text = "¿Te gustaría consultar algo más?"
-        buttons = [
-            (PAYLOAD_PLANES, "Ver Planes 🚲"),
-            (PAYLOAD_RESERVAR, "Cómo Reservar 📝"),
-            (PAYLOAD_UBICACION, "Ubicación 📍")
-        ]
-        send_wa_buttons(sender, menu_text, buttons)
+    elif message_type in MEDIA_TYPES:
+        media = message_body[message_type]
+        print(f"📎 {sender} envió {message_type}: {media.get('caption', '')}")
+        wa_media_queue.add(media["id"], sender, media_kind(media.get('caption')), media.get('mime_type', ''))
         return
-
-    if payload == PAYLOAD_PAGO or "cbu" in msg_text or "alias" in msg_text or "pago" in msg_text:
-        header = settings.get('msg_pago_header', '🏦 *Datos Bancarios para la Seña:*')
-        text = (
-            f"{header}\n\n"
-            f"🔹 *Banco:* {settings.get('bank_name', 'Francés BBVA')}\n"
-            f"🔹 *Titular:* {settings.get('bank_holder', 'Lucas Brunazzi')}\n"
-            f"🔹 *Alias:* {settings.get('bank_alias', 'BICISI.26')}\n"
-            f"🔹 *CBU:* {settings.get('bank_cbu', '0170274540000002278483')}\n"
-            f"🔹 *Cuenta:* {settings.get('bank_account', '274-22784/8')}\n\n"
-            "⚠️ *Importante:* Envía el comprobante por aquí para agendar tu bici."
-        )
-        send_wa_text(sender, text)
-        return
-
-    if payload == PAYLOAD_UBICACION or "donde estan" in msg_text:
-        text = settings.get('msg_ubicacion', 'Nuestra ubicación...')
-        buttons = [(PAYLOAD_MENU, "Volver al Menú")]
-        send_wa_buttons(sender, text, buttons)
-        return
-
-    # Respuesta por defecto
-    default_text = settings.get('msg_default', 'No entendí tu mensaje.')
-    buttons = [(PAYLOAD_MENU, "Ir al Menú"), (PAYLOAD_RESERVAR, "Ayuda / Reservar")]
-    send_wa_buttons(sender, default_text, buttons)
+    
+    router = get_intent_router()
+    intent = router.route(msg_text, payload)
+    
+    # Mid-flow, the message answers the current step unless it's a menu button or a greeting
+    step, data = conversations.get(sender)
+    if step in WA_STEPS:
+        if payload not in router.payloads and intent != 'menu':
+            WA_STEPS[step](sender, settings, msg_text, payload, data)
+            return
+        conversations.clear(sender)
+    
+    if intent in WA_FLOWS:
+        WA_FLOWS[intent](sender, settings)
+    elif intent:
+        wa_custom(sender, settings, intent)
+    else:
+        # Respuesta por defecto
+        wa_default(sender, settings)
 
 @app.route("/webhook", methods=["GET"])
 def wa_verify():
@@ -1273,135 +1864,208 @@ def wa_verify():
         return challenge, 200
     return "Forbidden", 403
 
+# ==================== WHATSAPP MEDIA ====================
+
+WA_GRAPH_URL = f"https://graph.facebook.com/{WA_VERSION}"
+
+def process_wa_media(row):
+    """MediaQueue handler: download a photo/PDF, store it and attach it to the sender's last reservation"""
+    media_id, sender = row['media_id'], row['sender']
+    part = "wa-" + re.sub(r'\W', '', media_id)
+    create_part(part)
+    try:
+        mime_type = download_media(wa_sender.session, WA_GRAPH_URL, media_id, part_path(part)) or row['mime_type']
+        if mime_type.startswith('image/'):
+            try:
+                (photo, photo_ext), (thumb, thumb_ext) = image_pool.run(process_file, part_path(part), DNI_MAX_SIZE, True)
+            except ImageError as e:
+                raise MediaError(str(e))
+            url, thumb_url = store_blob(photo, photo_ext, private=True), store_blob(thumb, thumb_ext, private=True)
+        elif mime_type == 'application/pdf':
+            url, thumb_url = store_file(part_path(part), 'pdf', private=True), None
+        else:
+            raise MediaError(f"unsupported type: {mime_type}")
+    finally:
+        remove_part(part)
+    
+    conn = get_db()
+    reservation = conn.execute('''
+        SELECT id, dni_photo FROM reservations
+        WHERE wa_phone = ?
+        ORDER BY created_at DESC LIMIT 1
+    ''', (sender,)).fetchone()
+    if reservation is None:
+        send_wa_text(sender, "📎 ¡Recibimos tu archivo! No encontramos una reserva con este número; te vamos a contactar para asociarlo.")
+        return {"url": url, "thumb_url": thumb_url, "mime_type": mime_type}
+    
+    if row['kind'] == KIND_DNI and thumb_url and not reservation['dni_photo']:
+        conn.execute(
+            "UPDATE reservations SET dni_photo = ?, dni_thumb = ? WHERE id = ?",
+            (url, thumb_url, reservation['id'])
+        )
+        conn.commit()
+    what = "la foto de tu DNI" if row['kind'] == KIND_DNI else "el comprobante"
+    send_wa_text(sender, f"✅ ¡Recibimos {what}! Ya quedó asociado a tu reserva.")
+    return {"url": url, "thumb_url": thumb_url, "mime_type": mime_type, "reservation_id": reservation['id']}
+
+# Photos and documents are downloaded by background workers (see wa_media.py)
+wa_media_queue = MediaQueue(get_db, process_wa_media)
+
+def handle_inbox_message(sender, msg):
+    """Inbox handler: run the bot on one stored webhook message"""
+    handle_wa_message(sender, msg, msg["type"])
+
+# Inbound messages are stored first and answered by background workers (see wa_inbox.py)
+wa_inbox = Inbox(get_db, handle_inbox_message)
+
 @app.route("/webhook", methods=["POST"])
 def wa_receive():
-    """WhatsApp webhook receive messages"""
-    data = request.get_json()
-
+    """WhatsApp webhook: store incoming messages and acknowledge right away"""
+    data = request.get_json(silent=True) or {}
+    
+    messages = []
     try:
         if data.get("object") == "whatsapp_business_account":
             for entry in data.get("entry", []):
                 for change in entry.get("changes", []):
-                    value = change.get("value", {})
-                    if "messages" in value:
-                        for msg in value["messages"]:
-                            sender = msg["from"]
-                            msg_type = msg["type"]
-                            handle_wa_message(sender, msg, msg_type)
-
+                    messages.extend(change.get("value", {}).get("messages", []))
+    except (AttributeError, TypeError) as e:
+        # Malformed payload: retrying it won't help, so don't ask Meta to
+        print(f"Webhook con formato inesperado: {e}")
         return jsonify(status="ok"), 200
+    
+    messages = [msg for msg in messages if isinstance(msg, dict) and msg.get("id") and msg.get("from")]
+    if messages:
+        try:
+            wa_inbox.add(messages)
+        except sqlite3.Error as e:
+            # Not stored: let Meta redeliver
+            print(f"Error guardando mensajes del webhook: {e}")
+            return jsonify(status="error"), 500
+    
+    return jsonify(status="ok"), 200
+
+# ==================== REMINDER BROADCASTS ====================
+
+# Reminders go out through the WhatsApp queue (see broadcasts.py)
+broadcast_runner = BroadcastRunner(get_db, send_wa_text)
+
+def start_reminders(target_date):
+    """Snapshot the reminders for a date and start sending them; returns the broadcast id"""
+    template = get_settings().get('msg_recordatorio') or DEFAULT_REMINDER
+    broadcast_id = write_transaction(create_broadcast, target_date, template)
+    broadcast_runner.start(broadcast_id)
+    return broadcast_id
+
+def resume_broadcasts():
+    """Restart broadcasts interrupted by a crash or restart"""
+    cursor = get_db().cursor()
+    cursor.execute("SELECT id FROM broadcasts WHERE status = 'running'")
+    for row in cursor.fetchall():
+        broadcast_runner.start(row['id'])
 
-    except Exception as e:
-        print(f"Error en webhook: {e}")
-        return jsonify(status="error"), 400
+@app.route('/api/admin/broadcasts/reminders', methods=['POST'])
+@login_required
+def admin_send_reminders():
+    """Send reminders to confirmed reservations starting on a date (default: tomorrow)"""
+    data = request.json or {}
+    target_date = data.get('date') or (datetime.now().date() + timedelta(days=1)).isoformat()
+    try:
+        datetime.strptime(target_date, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({"error": "Fecha inválida"}), 400
+    
+    broadcast_id = start_reminders(target_date)
+    return jsonify(broadcast_progress(get_db().cursor(), broadcast_id))
+
+@app.route('/api/admin/broadcasts/<broadcast_id>')
+@login_required
+def admin_broadcast_progress(broadcast_id):
+    """Progress of a broadcast"""
+    progress = broadcast_progress(get_db().cursor(), broadcast_id)
+    if not progress:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify(progress)
 
 # ==================== MERCADO PAGO WEBHOOK ====================
 
+def confirm_mp_payment(reservation_id):
+    """Confirm a reservation still waiting for its Mercado Pago payment; True if it was"""
+    return bool(write_transaction(set_reservation_status, reservation_id, 'confirmed', 'pending_payment'))
+
+# Notifications are checked and payments reconciled in the background (see payments.py)
+mp_sync = PaymentSync(get_db, sdk, confirm_mp_payment)
+
 @app.route('/api/mp-webhook', methods=['GET', 'POST'])
 def mp_webhook():
-    """Receive MercadoPago IPN/Webhook notifications"""
+    """Receive MercadoPago IPN/Webhook notifications: record them and acknowledge right away"""
     # GET = MP verifying the webhook URL is reachable
     if request.method == 'GET':
         return jsonify({"status": "ok"}), 200
     
+    # MP sends either query params or JSON body (newer webhook format)
+    body = request.get_json(silent=True) or {}
+    topic = request.args.get('topic') or request.args.get('type') or body.get('type', body.get('topic', ''))
+    resource_id = (request.args.get('id') or request.args.get('data.id')
+                   or (body.get('data') or {}).get('id') or body.get('resource', ''))
+    
+    # We only care about payment notifications
+    if topic not in NOTIFICATION_TOPICS or not resource_id:
+        return jsonify({"status": "ignored"}), 200
+    
     try:
-        # MP sends either query params or JSON body
-        topic = request.args.get('topic') or request.args.get('type')
-        resource_id = request.args.get('id')
-        
-        # Also check JSON body (newer webhook format)
-        body = request.get_json(silent=True) or {}
-        if not topic:
-            topic = body.get('type', body.get('topic', ''))
-        if not resource_id:
-            resource_id = body.get('data', {}).get('id', body.get('resource', ''))
-        
-        print(f"MP WEBHOOK: topic={topic}, id={resource_id}, body={json.dumps(body)}", flush=True)
-        
-        # We only care about payment notifications
-        if topic not in ('payment', 'merchant_order'):
-            return jsonify({"status": "ignored"}), 200
-        
-        if topic == 'payment' and resource_id:
-            # Query MP API to get payment details
-            payment_response = sdk.payment().get(resource_id)
-            payment = payment_response.get('response', {})
-            
-            payment_status = payment.get('status')
-            external_ref = payment.get('external_reference')
-            
-            print(f"MP WEBHOOK: payment_status={payment_status}, external_ref={external_ref}", flush=True)
-            
-            if payment_status == 'approved' and external_ref:
-                conn = get_db()
-                cursor = conn.cursor()
-                cursor.execute(
-                    'UPDATE reservations SET status = ? WHERE id = ? AND status = ?',
-                    ('confirmed', external_ref, 'pending_payment')
-                )
-                updated = cursor.rowcount
-                conn.commit()
-                conn.close()
-                print(f"MP WEBHOOK: Reservation {external_ref} confirmed (rows updated: {updated})", flush=True)
-        
-        elif topic == 'merchant_order' and resource_id:
-            # For merchant_order, check if all payments are approved
-            # Extract ID from resource URL if needed
-            order_id = resource_id.split('/')[-1] if '/' in str(resource_id) else resource_id
-            order_response = sdk.merchant_order().get(order_id)
-            order = order_response.get('response', {})
-            
-            external_ref = order.get('external_reference')
-            payments = order.get('payments', [])
-            
-            total_paid = sum(p.get('total_paid_amount', 0) for p in payments if p.get('status') == 'approved')
-            order_total = order.get('total_amount', 0)
-            
-            print(f"MP WEBHOOK: order total={order_total}, paid={total_paid}, ref={external_ref}", flush=True)
-            
-            if total_paid >= order_total and external_ref:
-                conn = get_db()
-                cursor = conn.cursor()
-                cursor.execute(
-                    'UPDATE reservations SET status = ? WHERE id = ? AND status = ?',
-                    ('confirmed', external_ref, 'pending_payment')
-                )
-                updated = cursor.rowcount
-                conn.commit()
-                conn.close()
-                print(f"MP WEBHOOK: Reservation {external_ref} confirmed via merchant_order (rows updated: {updated})", flush=True)
-        
-        return jsonify({"status": "ok"}), 200
-        
-    except Exception as e:
+        queued = mp_sync.notify(topic, resource_id)
+    except sqlite3.Error as e:
+        # Not stored: let MP deliver it again
         print(f"MP WEBHOOK ERROR: {e}", flush=True)
-        # Always return 200 to MP so it doesn't keep retrying
-        return jsonify({"status": "error", "detail": str(e)}), 200
+        return jsonify({"status": "error"}), 500
+    
+    print(f"MP WEBHOOK: topic={topic}, id={resource_id}, {'queued' if queued else 'repeat'}", flush=True)
+    return jsonify({"status": "ok"}), 200
 
 # ==================== MAIN ====================
 
 @app.route('/api/reservations/<reservation_id>/confirm_payment', methods=['POST'])
 def confirm_reservation_payment(reservation_id):
-    print(f"DEBUG: Attempting to confirm payment for reservation {reservation_id}", flush=True)
-    conn = get_db()
-    cursor = conn.cursor()
-    
+    """Confirm a reservation coming back from Mercado Pago; only while it waits for its payment"""
     try:
-        cursor.execute('UPDATE reservations SET status = ? WHERE id = ?', ('confirmed', reservation_id))
-        conn.commit()
-        print(f"DEBUG: Successfully confirmed reservation {reservation_id}", flush=True)
-        return jsonify({"success": True, "message": "Pago confirmado exitosamente"})
-    except Exception as e:
-        print(f"DEBUG: Error confirming reservation {reservation_id}: {e}", flush=True)
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+        confirmed = confirm_mp_payment(reservation_id)
+    except sqlite3.Error as e:
+        print(f"Error confirming reservation {reservation_id}: {e}", flush=True)
+        return jsonify({"error": "No se pudo confirmar la reserva"}), 500
+    
+    if not confirmed:
+        row = get_db().execute("SELECT status FROM reservations WHERE id = ?", (reservation_id,)).fetchone()
+        if not row:
+            return jsonify({"error": "Reserva no encontrada"}), 404
+        return jsonify({"error": "La reserva no está pendiente de pago", "status": row['status']}), 409
+    return jsonify({"success": True, "message": "Pago confirmado exitosamente"})
 
 if __name__ == '__main__':
     init_db()
     
+    if len(sys.argv) > 1 and sys.argv[1] == 'rebuild-occupancy':
+        print(f"✅ Ocupación recalculada: {rebuild_occupancy()} franjas horarias")
+        sys.exit(0)
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'send-reminders':
+        # For a scheduled task: python app.py send-reminders [YYYY-MM-DD]
+        target_date = sys.argv[2] if len(sys.argv) > 2 else (datetime.now().date() + timedelta(days=1)).isoformat()
+        broadcast_runner.start(start_reminders(target_date)).join()
+        sys.exit(0)
+    
     port = CONFIG.get('PORT', 5001)
     debug_mode = CONFIG.get('DEBUG', True)
+    
+    # Answer WhatsApp messages, finish broadcasts and payment work left pending by the last run.
+    # Only in the process that serves requests: the debug reloader's parent just watches files
+    if not debug_mode or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        wa_inbox.start()
+        wa_media_queue.start()
+        resume_broadcasts()
+        mp_preferences.resume()
+        # Also reconciles pending_payment reservations every few minutes
+        mp_sync.start()
     public_url = CONFIG.get('PUBLIC_URL', f"http://localhost:{port}")
 
     print("\n🚲 BiciSí - Sistema Unificado (PROD READY)")
@@ -0,0 +1,134 @@
+"""Availability engine shared by the slots, bot and booking endpoints.
+
+Every question is answered from the occupancy table: reserved quantity per
+(category, date, hour), kept in step with confirmed reservations inside
+each reservation write (see apply_occupancy in app.py). Its primary key is
+the interval index, so "max concurrent usage over [start, end)" is one
+range read whose cost depends on the hours asked about, not on how many
+bookings overlap them, and nothing has to be rebuilt after a write.
+"""
+from datetime import datetime, timedelta
+
+# Operating hours
+OPERATING_START = 8
+OPERATING_END = 19
+
+
+def block_range(s_date, e_date, s_hour, e_hour, date_str):
+    """Return the (start, end) hours a reservation blocks on date_str.
+
+    Includes the 1-hour logistics buffer before pickup and after return.
+    Intermediate days of a multi-day reservation block the full range.
+    """
+    if s_date == date_str and e_date == date_str:
+        # Single day reservation
+        return max(OPERATING_START, s_hour - 1), min(OPERATING_END, e_hour + 1)
+    if s_date == date_str:
+        # First day of multi-day
+        return max(OPERATING_START, s_hour - 1), OPERATING_END
+    if e_date == date_str:
+        # Last day of multi-day
+        return OPERATING_START, min(OPERATING_END, e_hour + 1)
+    # Middle of multi-day - blocks full range
+    return OPERATING_START, OPERATING_END
+
+
+def expand_reservation_hours(start_date, end_date, start_hour, end_hour):
+    """Yield (date, hour) for every hour a reservation blocks, day by day"""
+    end_date = end_date or start_date
+    curr = datetime.strptime(start_date, '%Y-%m-%d').date()
+    last = datetime.strptime(end_date, '%Y-%m-%d').date()
+    while curr <= last:
+        date_str = curr.isoformat()
+        block_start, block_end = block_range(start_date, end_date, start_hour, end_hour, date_str)
+        for h in range(block_start, block_end):
+            yield date_str, h
+        curr += timedelta(days=1)
+
+
+class AvailabilityEngine:
+    """Occupancy queries; stateless, so one instance serves every thread"""
+
+    def hourly_usage(self, cursor, category_id, date_str):
+        """Reserved quantity per hour on a date as {hour: qty}"""
+        cursor.execute(
+            "SELECT hour, qty FROM occupancy WHERE category_id = ? AND date = ?",
+            (category_id, date_str)
+        )
+        return {row['hour']: row['qty'] for row in cursor.fetchall()}
+
+    def usage(self, cursor, category_ids, start_date, end_date):
+        """Reserved quantity over a date range as {date: {category_id: {hour: qty}}}"""
+        placeholders = ', '.join('?' for _ in category_ids)
+        cursor.execute(f'''
+            SELECT category_id, date, hour, qty FROM occupancy
+            WHERE category_id IN ({placeholders}) AND date BETWEEN ? AND ?
+        ''', (*category_ids, start_date, end_date))
+        usage = {}
+        for row in cursor.fetchall():
+            usage.setdefault(row['date'], {}).setdefault(row['category_id'], {})[row['hour']] = row['qty']
+        return usage
+
+    def max_usage(self, cursor, category_id, start_date, end_date, start_hour, end_hour):
+        """Max concurrent reserved quantity over the hours a booking would block"""
+        end_date = end_date or start_date
+        first_hour, last_hour = booking_hours(start_date, end_date, start_hour, end_hour)
+        cursor.execute('''
+            SELECT MAX(qty) FROM occupancy
+            WHERE category_id = ? AND date BETWEEN ? AND ?
+            AND (date > ? OR hour >= ?)
+            AND (date < ? OR hour < ?)
+        ''', (category_id, start_date, end_date, start_date, first_hour, end_date, last_hour))
+        return cursor.fetchone()[0] or 0
+
+    def first_conflict(self, cursor, items, start_date, end_date, start_hour, end_hour):
+        """Set-based stock check of a booking's items.
+
+        Returns (category_id, date, hour) of the first hour where the
+        requested quantity doesn't fit, or None. Call it inside the booking
+        transaction.
+        """
+        end_date = end_date or start_date
+        quantities = {}
+        for item in items:
+            quantities[item['category_id']] = quantities.get(item['category_id'], 0) + item.get('quantity', 1)
+        first_hour, last_hour = booking_hours(start_date, end_date, start_hour, end_hour)
+        
+        requested = ', '.join('(?, ?)' for _ in quantities)
+        params = [v for pair in quantities.items() for v in pair]
+        
+        # Requests larger than the stock fail even where nothing is booked yet
+        cursor.execute(f'''
+            WITH req(category_id, qty) AS (VALUES {requested})
+            SELECT req.category_id FROM req
+            LEFT JOIN categories c ON c.id = req.category_id
+            WHERE req.qty > COALESCE(c.stock, 0)
+            LIMIT 1
+        ''', params)
+        row = cursor.fetchone()
+        if row:
+            return row[0], start_date, first_hour
+        
+        cursor.execute(f'''
+            WITH req(category_id, qty) AS (VALUES {requested})
+            SELECT o.category_id, o.date, o.hour
+            FROM req
+            JOIN categories c ON c.id = req.category_id
+            JOIN occupancy o ON o.category_id = req.category_id
+            WHERE o.date BETWEEN ? AND ?
+            AND (o.date > ? OR o.hour >= ?)
+            AND (o.date < ? OR o.hour < ?)
+            AND o.qty + req.qty > c.stock
+            ORDER BY o.date, o.hour
+            LIMIT 1
+        ''', (*params, start_date, end_date, start_date, first_hour, end_date, last_hour))
+        row = cursor.fetchone()
+        return tuple(row) if row else None
+
+
+def booking_hours(start_date, end_date, start_hour, end_hour):
+    """First blocked hour on the start date and end of the blocked range on the end date"""
+    return (
+        block_range(start_date, end_date, start_hour, end_hour, start_date)[0],
+        block_range(start_date, end_date, start_hour, end_hour, end_date)[1],
+    )
@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import app
+
+# Benchmark parameters
+DURATION = 3.0
+READER_THREADS = 8
+TEST_DATE = "2099-12-24"
+
+def legacy_get_db():
+    """The old connection layer: a brand new default connection per call"""
+    conn = sqlite3.connect(app.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def fresh_db():
+    """Create a new database with whichever get_db is active"""
+    app.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app.init_db()
+
+def run_for(fn, threads=1):
+    """Call fn() from `threads` threads for DURATION seconds, return calls/s"""
+    counts = [0] * threads
+    deadline = time.perf_counter() + DURATION
+
+    def worker(i):
+        while time.perf_counter() < deadline:
+            fn()
+            counts[i] += 1
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return sum(counts) / DURATION
+
+def bench(label):
+    client = app.app.test_client()
+    slots = {"date": TEST_DATE, "category_id": "cat-aluminio", "quantity": 1}
+    stop = threading.Event()
+
+    def writer():
+        """Keep a writer busy so readers contend with it"""
+        conn = sqlite3.connect(app.DB_PATH, timeout=30)
+        while not stop.is_set():
+            conn.execute("UPDATE settings SET value = value WHERE key = 'business_name'")
+            conn.commit()
+        conn.close()
+
+    results = {
+        "landing (/)": run_for(lambda: client.get('/')),
+        "available-slots": run_for(lambda: client.post('/api/available-slots', json=slots)),
+    }
+    background = threading.Thread(target=writer)
+    background.start()
+    try:
+        results[f"available-slots, {READER_THREADS} readers + writer"] = run_for(
+            lambda: app.app.test_client().post('/api/available-slots', json=slots), READER_THREADS
+        )
+    finally:
+        stop.set()
+        background.join()
+
+    print(f"--- {label} ---")
+    for name, rps in results.items():
+        print(f"{name:45s} {rps:8.1f} req/s")
+    return results
+
+if __name__ == "__main__":
+    current_get_db = app.get_db
+
+    app.get_db = legacy_get_db
+    try:
+        fresh_db()
+        before = bench("Connection per call, rollback journal")
+    except sqlite3.OperationalError as e:
+        print(f"❌ Legacy mode failed under contention: {e}")
+        sys.exit(1)
+    finally:
+        app.get_db = current_get_db
+
+    fresh_db()
+    after = bench("Connection per thread, WAL + pragmas")
+
+    print("\n--- Speedup ---")
+    for name in after:
+        print(f"{name:45s} x{after[name] / before[name]:.2f}")
@@ -0,0 +1,62 @@
+import os
+import statistics
+import tempfile
+import time
+
+import app
+from catalog import Catalog, PriceRow, quote
+
+# Benchmark parameters
+QUOTES = 20000
+CART = [
+    {"category_id": "cat-aluminio", "quantity": 2},
+    {"category_id": "cat-sillita", "quantity": 1},
+    {"category_id": "cat-remolque", "quantity": 1},
+]
+
+def legacy_quote(items, rental_type, hours, days, payment_method):
+    """The old I/O pattern: settings table + JSON file, then one SELECT per item"""
+    cursor = app.get_db().cursor()
+    settings = app.load_settings(cursor)
+    prices = {}
+    for item in items:
+        cursor.execute("SELECT * FROM categories WHERE id = ?", (item['category_id'],))
+        row = cursor.fetchone()
+        if row:
+            prices[row['id']] = PriceRow(
+                row['name'], row['price_per_hour'], row['price_half_day'],
+                row['price_full_day'], row['price_full_day'], row['stock']
+            )
+    catalog = Catalog(prices, int(settings.get('delivery_fee', 10000)))
+    return quote(catalog, items, rental_type, hours, days, payment_method)
+
+def cached_quote(items, rental_type, hours, days, payment_method):
+    """What /api/calculate-price does now"""
+    return quote(app.get_catalog(), items, rental_type, hours, days, payment_method)
+
+def measure(fn):
+    """Per-call latency in microseconds over QUOTES calls"""
+    samples = []
+    for n in range(QUOTES):
+        started = time.perf_counter()
+        fn(CART, 'hours', n % 12, 1, 'transfer')
+        samples.append((time.perf_counter() - started) * 1e6)
+    samples.sort()
+    return {
+        "p50": statistics.median(samples),
+        "p99": samples[int(len(samples) * 0.99)],
+        "quotes/s": QUOTES / (sum(samples) / 1e6),
+    }
+
+if __name__ == "__main__":
+    app.DB_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app.init_db()
+    assert legacy_quote(CART, 'hours', 3, 1, 'transfer') == cached_quote(CART, 'hours', 3, 1, 'transfer')
+
+    results = {"per-item queries": measure(legacy_quote), "catalog snapshot": measure(cached_quote)}
+    print(f"--- {QUOTES} quotes of a {len(CART)}-item cart ---")
+    for name, r in results.items():
+        print(f"{name:20s} p50 {r['p50']:8.1f} µs   p99 {r['p99']:8.1f} µs   {r['quotes/s']:10.0f} quotes/s")
+
+    speedup = results["catalog snapshot"]["quotes/s"] / results["per-item queries"]["quotes/s"]
+    print(f"\nSpeedup: x{speedup:.1f}")
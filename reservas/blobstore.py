@@ -0,0 +1,135 @@
+"""Content-addressed store for uploaded images (and PDF receipts).
+
+Blobs live on disk as data/blobs/<first 2 hex>/<sha256>.<ext> and rows only
+keep their /media/ URL. Identical uploads hash to the same file, so a photo
+is stored once no matter how many rows point at it.
+
+Customer documents (DNI photos, WhatsApp attachments) are stored with
+private=True under data/private and get an /admin/media/ URL instead, so
+the public /media/ route can never serve them.
+"""
+import base64
+import binascii
+import hashlib
+import os
+import re
+import uuid
+
+BLOB_DIR = os.path.join(os.path.dirname(__file__), 'data', 'blobs')
+MEDIA_URL = '/media/'
+PRIVATE_BLOB_DIR = os.path.join(os.path.dirname(__file__), 'data', 'private')
+PRIVATE_MEDIA_URL = '/admin/media/'
+
+# Stored formats (extension -> mime type)
+MIME_TYPES = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'gif': 'image/gif',
+    'pdf': 'application/pdf',
+}
+
+BLOB_NAME = re.compile(r'^[0-9a-f]{64}\.(jpeg|png|webp|gif|pdf)$')
+
+
+def sniff_ext(data, fallback):
+    """Extension for image bytes from their magic number"""
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:5] == b'%PDF-':
+        return 'pdf'
+    return 'jpeg' if fallback == 'jpg' else fallback
+
+
+def blob_path(name, private=False):
+    """On-disk path of a blob name"""
+    return os.path.join(PRIVATE_BLOB_DIR if private else BLOB_DIR, name[:2], name)
+
+
+def blob_url(name, private=False):
+    """URL a blob is served from"""
+    return (PRIVATE_MEDIA_URL if private else MEDIA_URL) + name
+
+
+def store_blob(data, ext='jpeg', private=False):
+    """Store image bytes and return their URL (deduplicated by content)"""
+    ext = sniff_ext(data, ext)
+    if ext not in MIME_TYPES:
+        raise ValueError(f"Unsupported image format: {ext}")
+    name = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+    path = blob_path(name, private)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            # Another worker stored the same content first (Windows keeps it locked)
+            os.remove(tmp)
+            if not os.path.exists(path):
+                raise
+    return blob_url(name, private)
+
+
+def store_file(path, ext, private=False):
+    """Move a file into the store (no copy in memory) and return its URL"""
+    if ext not in MIME_TYPES:
+        raise ValueError(f"Unsupported format: {ext}")
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(block)
+    name = f"{digest.hexdigest()}.{ext}"
+    target = blob_path(name, private)
+    if os.path.exists(target):
+        os.remove(path)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+    return blob_url(name, private)
+
+
+def make_private(url):
+    """Move a public /media/ blob into the private store and return its new URL.
+
+    Any other value (already private, external, empty) passes through.
+    """
+    name = url[len(MEDIA_URL):] if url and url.startswith(MEDIA_URL) else None
+    if not name or not BLOB_NAME.match(name):
+        return url
+    source, target = blob_path(name), blob_path(name, private=True)
+    if os.path.exists(source):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+    return blob_url(name, private=True)
+
+
+def decode_data_uri(value):
+    """Bytes of a data:image/...;base64 value, or None for any other value"""
+    if not value or not value.startswith('data:'):
+        return None
+    header, _, payload = value.partition(',')
+    if not header[len('data:'):].startswith('image/'):
+        raise ValueError("Invalid data URI: not an image")
+    try:
+        return base64.b64decode(payload, validate=True)
+    except binascii.Error as e:
+        raise ValueError(f"Invalid data URI: {e}")
+
+
+def resolve_blob(name, private=False):
+    """(path, mime type) of a stored blob, or None if the name is invalid or missing"""
+    if not BLOB_NAME.match(name):
+        return None
+    path = blob_path(name, private)
+    if not os.path.exists(path):
+        return None
+    return path, MIME_TYPES[name.rsplit('.', 1)[1]]
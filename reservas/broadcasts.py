@@ -0,0 +1,248 @@
+"""Reminder broadcasts to customers with a reservation on a given date.
+
+A broadcast first snapshots its recipients (one rendered message per
+confirmed reservation) into broadcast_recipients, then sends them through
+the WhatsApp queue with at most BROADCAST_CONCURRENCY messages in flight.
+Every recipient is claimed ('pending' -> 'sending', a conditional update)
+before its message is queued, so it's sent at most once even when two
+processes run the same broadcast. The runner owning a broadcast refreshes
+its heartbeat; another runner takes over only once it goes quiet, and
+only then marks recipients caught mid-send as failed ('interrupted')
+instead of retrying them.
+"""
+import re
+import threading
+import time
+import uuid
+
+# Messages of one broadcast queued or in flight at once
+BROADCAST_CONCURRENCY = 5
+
+# Wait before re-queuing when the outbound queue is full
+QUEUE_FULL_WAIT = 2
+
+# Seconds between heartbeats of a running broadcast, and silence after which its runner is presumed dead
+HEARTBEAT_INTERVAL = 10
+STALE_AFTER = 60
+
+DEFAULT_REMINDER = (
+    "¡Hola {nombre}! 👋 Te recordamos tu reserva en *BiciSí* para el {fecha} "
+    "a las {hora} hs. 🚲\n\n¡Te esperamos!"
+)
+
+
+def wa_phone(phone):
+    """Customer phone as WhatsApp wants it: digits only, Argentine mobiles as 549 + area code + number.
+
+    Accepts the usual ways of writing one: with or without +54/0054 and the
+    mobile 9, a trunk 0 before the area code, and the 15 after it
+    ("0351 15-557-5810", "+54 351 5575810" and "3515575810" are all
+    5493515575810).
+    """
+    digits = re.sub(r'\D', '', phone or '')
+    if not digits:
+        return digits
+    if digits.startswith('00'):
+        digits = digits[2:]
+    # No Argentine area code starts with 5 or 9, so these are country and mobile prefixes
+    if digits.startswith('54'):
+        digits = digits[2:]
+        if digits.startswith('9'):
+            digits = digits[1:]
+    national = digits.lstrip('0')
+    if len(national) == 12:
+        # Area code (11 is the only 2-digit one, the rest have 3 or 4) + 15 + number
+        for area in ((2,) if national.startswith('11') else (3, 4)):
+            if national[area:area + 2] == '15':
+                national = national[:area] + national[area + 2:]
+                break
+    return '549' + national
+
+
+def render_reminder(template, row):
+    """Fill {nombre}, {fecha} and {hora} for one reservation"""
+    year, month, day = row['start_date'].split('-')
+    return (template
+            .replace('{nombre}', row['customer_name'].split()[0] if row['customer_name'].strip() else '')
+            .replace('{fecha}', f"{day}/{month}")
+            .replace('{hora}', f"{row['start_hour'] or 0:02d}:00"))
+
+
+def create_broadcast(cursor, target_date, template):
+    """Snapshot the reminders for target_date and return the broadcast id.
+
+    There is one reminder broadcast per date: calling this again only adds
+    reservations confirmed since, so nobody is messaged twice. Must run
+    inside a write transaction.
+    """
+    cursor.execute(
+        "SELECT id FROM broadcasts WHERE kind = 'reminder' AND target_date = ?", (target_date,)
+    )
+    row = cursor.fetchone()
+    if row:
+        broadcast_id = row['id']
+    else:
+        broadcast_id = str(uuid.uuid4())
+        cursor.execute(
+            "INSERT INTO broadcasts (id, kind, target_date) VALUES (?, 'reminder', ?)",
+            (broadcast_id, target_date)
+        )
+    cursor.execute('''
+        SELECT id, customer_name, customer_phone, start_date, start_hour
+        FROM reservations
+        WHERE status = 'confirmed' AND start_date = ?
+    ''', (target_date,))
+    cursor.executemany(
+        "INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, reservation_id, phone, message) VALUES (?, ?, ?, ?)",
+        [
+            (broadcast_id, row['id'], wa_phone(row['customer_phone']), render_reminder(template, row))
+            for row in cursor.fetchall()
+        ]
+    )
+    cursor.execute(
+        "UPDATE broadcasts SET total = (SELECT COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ?) WHERE id = ?",
+        (broadcast_id, broadcast_id)
+    )
+    return broadcast_id
+
+
+def broadcast_progress(cursor, broadcast_id):
+    """Broadcast row plus recipient counts by status, or None"""
+    cursor.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    cursor.execute(
+        "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status",
+        (broadcast_id,)
+    )
+    return dict(row, counts={status: count for status, count in cursor.fetchall()})
+
+
+class BroadcastRunner:
+    """Sends the pending recipients of broadcasts in background threads.
+
+    send(phone, text, callback) must queue a WhatsApp text and return False
+    if it could not be queued; callback(ok, detail) reports the outcome.
+    """
+
+    def __init__(self, connect, send, concurrency=BROADCAST_CONCURRENCY):
+        self.connect = connect
+        self.send = send
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._running = {}
+
+    def start(self, broadcast_id):
+        """Run (or resume) a broadcast in the background; returns its thread"""
+        with self._lock:
+            thread = self._running.get(broadcast_id)
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self.run, args=(broadcast_id,), name=f"broadcast-{broadcast_id[:8]}", daemon=True)
+                self._running[broadcast_id] = thread
+                thread.start()
+            return thread
+
+    def _mark(self, broadcast_id, reservation_id, status, error=None):
+        conn = self.connect()
+        conn.execute('''
+            UPDATE broadcast_recipients SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE broadcast_id = ? AND reservation_id = ?
+        ''', (status, error, broadcast_id, reservation_id))
+        conn.commit()
+
+    def _claim(self, conn, broadcast_id, owner):
+        """Take the broadcast unless a live runner has it; True if we own it now"""
+        now = time.time()
+        claimed = conn.execute('''
+            UPDATE broadcasts SET status = 'running', owner = ?, heartbeat = ?
+            WHERE id = ? AND (status != 'running' OR owner IS NULL OR heartbeat < ?)
+        ''', (owner, now, broadcast_id, now - STALE_AFTER)).rowcount
+        conn.commit()
+        return bool(claimed)
+
+    def _beat(self, conn, broadcast_id, owner):
+        """Refresh our heartbeat; False if another runner took the broadcast over"""
+        beat = conn.execute(
+            "UPDATE broadcasts SET heartbeat = ? WHERE id = ? AND owner = ?",
+            (time.time(), broadcast_id, owner)
+        ).rowcount
+        conn.commit()
+        return bool(beat)
+
+    def _acquire(self, slots, conn, broadcast_id, owner):
+        """Wait for a free slot, beating meanwhile; False if we lost the broadcast"""
+        while not slots.acquire(timeout=HEARTBEAT_INTERVAL):
+            if not self._beat(conn, broadcast_id, owner):
+                return False
+        return True
+
+    def run(self, broadcast_id):
+        """Send every pending recipient, then record the totals"""
+        conn = self.connect()
+        owner = uuid.uuid4().hex
+        while not self._claim(conn, broadcast_id, owner):
+            if not conn.execute("SELECT 1 FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone():
+                return
+            # Another runner has it: wait until it finishes or goes quiet, then pick up what's left
+            time.sleep(HEARTBEAT_INTERVAL)
+        
+        # Queued by a runner that died: we can't know if it went out, so don't send it again
+        conn.execute('''
+            UPDATE broadcast_recipients SET status = 'failed', error = 'interrupted'
+            WHERE broadcast_id = ? AND status = 'sending'
+        ''', (broadcast_id,))
+        conn.commit()
+        pending = conn.execute('''
+            SELECT reservation_id, phone, message FROM broadcast_recipients
+            WHERE broadcast_id = ? AND status = 'pending'
+        ''', (broadcast_id,)).fetchall()
+
+        slots = threading.BoundedSemaphore(self.concurrency)
+
+        def finished(reservation_id, ok, detail):
+            try:
+                self._mark(broadcast_id, reservation_id, 'sent' if ok else 'failed', None if ok else str(detail)[:500])
+            finally:
+                slots.release()
+
+        last_beat = time.time()
+        for row in pending:
+            if not self._acquire(slots, conn, broadcast_id, owner):
+                print(f"📣 Recordatorios {broadcast_id[:8]}: otro proceso tomó el envío")
+                return
+            if time.time() - last_beat > HEARTBEAT_INTERVAL:
+                if not self._beat(conn, broadcast_id, owner):
+                    return
+                last_beat = time.time()
+            # Claim the recipient; skip it if someone else already did
+            claimed = conn.execute('''
+                UPDATE broadcast_recipients SET status = 'sending', updated_at = CURRENT_TIMESTAMP
+                WHERE broadcast_id = ? AND reservation_id = ? AND status = 'pending'
+            ''', (broadcast_id, row['reservation_id'])).rowcount
+            conn.commit()
+            if not claimed:
+                slots.release()
+                continue
+            if not row['phone']:
+                self._mark(broadcast_id, row['reservation_id'], 'failed', 'no phone')
+                slots.release()
+                continue
+            callback = lambda ok, detail, reservation_id=row['reservation_id']: finished(reservation_id, ok, detail)
+            while not self.send(row['phone'], row['message'], callback):
+                time.sleep(QUEUE_FULL_WAIT)
+                self._beat(conn, broadcast_id, owner)
+
+        # Wait for the last messages in flight
+        for _ in range(self.concurrency):
+            if not self._acquire(slots, conn, broadcast_id, owner):
+                return
+
+        conn.execute('''
+            UPDATE broadcasts SET status = 'done', finished_at = CURRENT_TIMESTAMP,
+                sent = (SELECT COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'sent'),
+                failed = (SELECT COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'failed')
+            WHERE id = ? AND owner = ?
+        ''', (broadcast_id, broadcast_id, broadcast_id, owner))
+        conn.commit()
+        print(f"📣 Recordatorios {broadcast_id[:8]} enviados")
@@ -0,0 +1,61 @@
+"""In-process caches invalidated through the data_versions table.
+
+Writers bump a data_versions row (see bump_version) in the same
+transaction as their change, so every worker process notices the new
+version on its next read and reloads.
+"""
+import threading
+import time
+
+
+def get_version(cursor, name):
+    """Read a row of the data_versions table (0 if never bumped)"""
+    cursor.execute("SELECT version FROM data_versions WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def bump_version(cursor, name):
+    """Increment a data_versions row inside the caller's transaction"""
+    cursor.execute('''
+        INSERT INTO data_versions (name, version) VALUES (?, 1)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1
+    ''', (name,))
+
+
+class VersionedCache:
+    """A value built by loader(cursor), rebuilt whenever key(cursor) changes.
+
+    key should be cheap (a data_versions lookup, a file mtime). With a
+    check_interval the key is only re-read that often, trading a bounded
+    staleness window for no I/O at all on hot paths; invalidate() forces the
+    next get() to check right away.
+    """
+
+    def __init__(self, key, loader, check_interval=0):
+        self._key = key
+        self._loader = loader
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._state = (None, None)
+        self._checked_at = 0
+
+    def get(self, cursor):
+        """Return the cached value, reloading it if its key changed"""
+        current_key, value = self._state
+        if self._check_interval and time.monotonic() - self._checked_at < self._check_interval:
+            if current_key is not None:
+                return value
+        key = self._key(cursor)
+        if key == current_key:
+            self._checked_at = time.monotonic()
+            return value
+        with self._lock:
+            if key != self._state[0]:
+                self._state = (key, self._loader(cursor))
+            self._checked_at = time.monotonic()
+            return self._state[1]
+
+    def invalidate(self):
+        """Make the next get() re-check the key"""
+        self._checked_at = 0
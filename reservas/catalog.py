@@ -0,0 +1,126 @@
+"""Catalog snapshot and price table used to quote without database I/O.
+
+The snapshot holds one PriceRow per category plus the delivery fee, and is
+rebuilt when the 'catalog' or 'settings' data version changes.
+"""
+from collections import namedtuple
+
+# Online payment (Mercado Pago) surcharge
+MODO_FULL_SURCHARGE = 10000
+DEFAULT_DELIVERY_FEE = 10000
+
+# Deposit charged up front, as a fraction of the total
+DEPOSIT_RATE = 0.5
+
+# Scenarios compared by quote_matrix (transfer = delivery, mercadopago = Modo FULL)
+RENTAL_TYPES = ('hours', 'half_day', 'full_day')
+PAYMENT_METHODS = ('cash', 'transfer', 'mercadopago')
+
+# Per-category prices; an hourly rental never costs more than daily_cap
+PriceRow = namedtuple('PriceRow', 'name hour half_day full_day daily_cap stock')
+
+Catalog = namedtuple('Catalog', 'prices delivery_fee')
+
+
+def load_catalog(cursor, settings):
+    """Build the price table from the categories table"""
+    cursor.execute('''
+        SELECT id, name, price_per_hour, price_half_day, price_full_day, stock
+        FROM categories
+    ''')
+    prices = {
+        row['id']: PriceRow(
+            row['name'], row['price_per_hour'], row['price_half_day'],
+            row['price_full_day'], row['price_full_day'], row['stock']
+        )
+        for row in cursor.fetchall()
+    }
+    return Catalog(prices, int(settings.get('delivery_fee', DEFAULT_DELIVERY_FEE)))
+
+
+def line_price(row, qty, rental_type, hours, days):
+    """(price, label) of one cart line"""
+    if rental_type == 'full_day':
+        return row.full_day * qty * days, f"{row.name} x{qty} - {days} día(s) completo(s)"
+    if rental_type == 'half_day':
+        return row.half_day * qty * days, f"{row.name} x{qty} - {days} medio día(s)"
+    if rental_type == 'hours':
+        # Cap hourly price at full day price
+        hourly_price = row.hour * qty * hours
+        max_daily_price = row.daily_cap * qty
+        if hourly_price > max_daily_price:
+            return max_daily_price, f"{row.name} x{qty} - {hours} hora(s) (Tope diario)"
+        return hourly_price, f"{row.name} x{qty} - {hours} hora(s)"
+    return row.full_day * qty * days, f"{row.name} x{qty} - {days} día(s)"
+
+
+def resolve_cart(catalog, items):
+    """[(PriceRow, qty)] of a cart, skipping unknown category_ids"""
+    return [
+        (catalog.prices[item['category_id']], item.get('quantity', 1))
+        for item in items
+        if item['category_id'] in catalog.prices
+    ]
+
+
+def price_lines(lines, rental_type, hours, days):
+    """(subtotal, breakdown) of resolved cart lines for one rental type"""
+    breakdown = []
+    subtotal = 0
+    for row, qty in lines:
+        price, label = line_price(row, qty, rental_type, hours, days)
+        subtotal += price
+        breakdown.append({"label": label, "price": price})
+    return subtotal, breakdown
+
+
+def add_payment(catalog, subtotal, breakdown, payment_method):
+    """Apply the payment method surcharges to a priced cart"""
+    total = subtotal
+    breakdown = list(breakdown)
+
+    # Add Modo FULL surcharge (online payment)
+    if payment_method == 'mercadopago':
+        breakdown.append({"label": "Modo FULL", "price": MODO_FULL_SURCHARGE})
+        total += MODO_FULL_SURCHARGE
+
+    # Add delivery fee if payment by transfer
+    delivery_fee = 0
+    if payment_method == 'transfer':
+        delivery_fee = catalog.delivery_fee
+        breakdown.append({"label": "Servicio de entrega/retiro", "price": delivery_fee})
+        total += delivery_fee
+
+    return {
+        "breakdown": breakdown,
+        "subtotal": total - delivery_fee,
+        "delivery_fee": delivery_fee,
+        "total": total,
+        "deposit": int(total * DEPOSIT_RATE)
+    }
+
+
+def quote(catalog, items, rental_type, hours=0, days=1, payment_method='cash'):
+    """Price a cart: breakdown, subtotal, delivery fee, total and deposit.
+
+    Items with an unknown category_id are skipped.
+    """
+    subtotal, breakdown = price_lines(resolve_cart(catalog, items), rental_type, hours, days)
+    return add_payment(catalog, subtotal, breakdown, payment_method)
+
+
+def quote_matrix(catalog, items, hours=0, days=1, rental_types=RENTAL_TYPES, payment_methods=PAYMENT_METHODS):
+    """Quotes for every rental type and payment method as {rental_type: {payment_method: quote}}.
+
+    The cart is resolved once and priced once per rental type; payment
+    methods only add their surcharges on top.
+    """
+    lines = resolve_cart(catalog, items)
+    matrix = {}
+    for rental_type in rental_types:
+        subtotal, breakdown = price_lines(lines, rental_type, hours, days)
+        matrix[rental_type] = {
+            payment_method: add_payment(catalog, subtotal, breakdown, payment_method)
+            for payment_method in payment_methods
+        }
+    return matrix
@@ -0,0 +1,84 @@
+"""Per-sender conversation state for the WhatsApp bot.
+
+Each phone has at most one state: the step of the flow it is in and the
+data collected so far. Reads are served from an in-memory LRU; writes go
+through to the conversations table, so a restart only costs one primary
+key lookup per returning sender. States untouched for CONVERSATION_TTL
+seconds are forgotten.
+"""
+from collections import OrderedDict
+import json
+import threading
+import time
+
+# Seconds of silence after which a conversation starts over
+CONVERSATION_TTL = 30 * 60
+
+# Conversations kept in memory
+CONVERSATION_CACHE_SIZE = 1000
+
+# Expired rows are purged after this many writes
+PURGE_EVERY = 200
+
+
+class ConversationStore:
+    """LRU + TTL cache of {phone: (step, data)} backed by SQLite.
+
+    connect() must return a sqlite3 connection usable from the calling
+    thread. A phone's messages are handled one at a time (see wa_inbox), so
+    there is no read-modify-write race on a single conversation.
+    """
+
+    def __init__(self, connect, ttl=CONVERSATION_TTL, capacity=CONVERSATION_CACHE_SIZE):
+        self.connect = connect
+        self.ttl = ttl
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()   # phone -> (step, data, updated_at); step None = no conversation
+        self._writes = 0
+
+    def _remember(self, phone, entry):
+        with self._lock:
+            self._cache[phone] = entry
+            self._cache.move_to_end(phone)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def get(self, phone):
+        """(step, data) of the sender's conversation, or (None, {})"""
+        with self._lock:
+            entry = self._cache.get(phone)
+            if entry is not None:
+                self._cache.move_to_end(phone)
+        if entry is None:
+            row = self.connect().execute(
+                "SELECT step, data, updated_at FROM conversations WHERE phone = ?", (phone,)
+            ).fetchone()
+            entry = (row['step'], json.loads(row['data']), row['updated_at']) if row else (None, {}, 0)
+            self._remember(phone, entry)
+        step, data, updated_at = entry
+        if step is None or time.time() - updated_at > self.ttl:
+            return None, {}
+        return step, dict(data)
+
+    def set(self, phone, step, data=None):
+        """Move the sender to step, keeping data for the next steps"""
+        data = data or {}
+        now = time.time()
+        conn = self.connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO conversations (phone, step, data, updated_at) VALUES (?, ?, ?, ?)",
+            (phone, step, json.dumps(data), now)
+        )
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            conn.execute("DELETE FROM conversations WHERE updated_at < ?", (now - self.ttl,))
+        conn.commit()
+        self._remember(phone, (step, data, now))
+
+    def clear(self, phone):
+        """End the sender's conversation"""
+        conn = self.connect()
+        conn.execute("DELETE FROM conversations WHERE phone = ?", (phone,))
+        conn.commit()
+        self._remember(phone, (None, {}, 0))
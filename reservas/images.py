@@ -0,0 +1,169 @@
+"""Upload pipeline: decode (HEIC included), strip metadata, downscale, recompress.
+
+Every uploaded photo is re-encoded from pixels only, so EXIF (GPS, device,
+timestamps) never reaches the blob store. Opaque images become JPEG; images
+with transparency become WebP so category PNGs keep their alpha.
+"""
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import io
+import os
+import threading
+
+from PIL import Image, ImageOps
+
+# Largest side kept for each kind of upload (DNI photos stay legible for ID checks)
+DNI_MAX_SIZE = (1600, 1600)
+CATEGORY_MAX_SIZE = (1600, 1600)
+THUMB_SIZE = (320, 320)
+
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+THUMB_QUALITY = 70
+VARIANT_QUALITY = 78
+
+# Refuse decompression bombs well before they exhaust memory
+Image.MAX_IMAGE_PIXELS = 60_000_000
+
+# Process pool for decode/encode: workers, jobs running + waiting, seconds per job
+POOL_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+POOL_QUEUE_LIMIT = POOL_WORKERS * 4
+POOL_TIMEOUT = 30
+
+_heif_registered = False
+
+
+class ImageError(Exception):
+    """The upload is not an image we can decode"""
+
+
+class ImagePoolBusy(Exception):
+    """The image pool is full or a job timed out; the client should retry later"""
+
+
+def register_heif():
+    """Teach Pillow to open HEIC/HEIF (iPhone photos); a no-op after the first call"""
+    global _heif_registered
+    if not _heif_registered:
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+        _heif_registered = True
+
+
+def open_image(data, max_size):
+    """Decode image bytes, upright and at most max_size"""
+    register_heif()
+    try:
+        img = Image.open(io.BytesIO(data))
+        # JPEGs can decode straight at a reduced scale, much cheaper than resizing after
+        img.draft('RGB', (max_size[0] * 2, max_size[1] * 2))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail(max_size, Image.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageError(str(e))
+    return img
+
+
+def has_alpha(img):
+    """True if the image has a transparency channel or key"""
+    return img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+
+
+def encode(img):
+    """Re-encode pixels only (no EXIF/ICC/XMP); return (bytes, ext)"""
+    buf = io.BytesIO()
+    if has_alpha(img):
+        img.convert('RGBA').save(buf, format='WEBP', quality=WEBP_QUALITY, method=4)
+        return buf.getvalue(), 'webp'
+    img.convert('RGB').save(buf, format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return buf.getvalue(), 'jpeg'
+
+
+def thumbnail(img):
+    """Small WebP preview for list views; return (bytes, ext)"""
+    thumb = img.copy()
+    thumb.thumbnail(THUMB_SIZE, Image.LANCZOS)
+    buf = io.BytesIO()
+    thumb.convert('RGBA' if has_alpha(thumb) else 'RGB').save(buf, format='WEBP', quality=THUMB_QUALITY)
+    return buf.getvalue(), 'webp'
+
+
+def process_upload(data, max_size, with_thumb=False):
+    """Run the pipeline on uploaded bytes.
+
+    Returns ((bytes, ext), (thumb_bytes, ext) or None).
+    """
+    img = open_image(data, max_size)
+    return encode(img), (thumbnail(img) if with_thumb else None)
+
+
+def process_file(path, max_size, with_thumb=False):
+    """process_upload on a file, read inside the worker instead of pickled over"""
+    with open(path, 'rb') as f:
+        return process_upload(f.read(), max_size, with_thumb)
+
+
+def variant_file(path, width):
+    """WebP of a stored image scaled down (never up) to width; return bytes"""
+    with open(path, 'rb') as f:
+        img = open_image(f.read(), (width, width * 4))
+    buf = io.BytesIO()
+    img.convert('RGBA' if has_alpha(img) else 'RGB').save(buf, format='WEBP', quality=VARIANT_QUALITY, method=4)
+    return buf.getvalue()
+
+
+class ImagePool:
+    """Bounded ProcessPoolExecutor for CPU-bound image work.
+
+    Keeps Pillow decode/encode off the few waitress request threads. At most
+    queue_limit jobs may be running or waiting; beyond that (or past the
+    timeout) run() raises ImagePoolBusy instead of queueing more. Each worker
+    registers the HEIF opener once, in its initializer. workers=0 runs jobs
+    inline.
+    """
+
+    def __init__(self, workers=POOL_WORKERS, queue_limit=POOL_QUEUE_LIMIT, timeout=POOL_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=register_heif)
+            return self._executor
+
+    def _reset(self, executor):
+        """Drop a broken executor so the next job starts a fresh one"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def run(self, fn, *args):
+        """Run fn(*args) in the pool and return its result"""
+        if not self._slots.acquire(blocking=False):
+            raise ImagePoolBusy("image queue full")
+        if not self.workers:
+            try:
+                return fn(*args)
+            finally:
+                self._slots.release()
+        executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._reset(executor)
+            raise ImagePoolBusy("image workers restarting")
+        # The slot frees when the job really ends, even if we stop waiting on it
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise ImagePoolBusy("image job timed out")
+        except BrokenProcessPool:
+            self._reset(executor)
+            raise ImagePoolBusy("image worker crashed")
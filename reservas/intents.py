@@ -0,0 +1,97 @@
+"""Intent router for the WhatsApp bot.
+
+Keywords come from settings (comma-separated kw_<intent> values, with
+defaults in default_messages.json) and are compiled into one regex over
+accent-free, lowercased text, so a message is classified in a single scan
+no matter how many keywords there are. Button payloads map straight to
+their intent. Any kw_<name> setting outside the built-in intents defines a
+new intent answered with the msg_<name> text, with no code changes.
+"""
+import re
+import unicodedata
+
+# WhatsApp button payloads
+PAYLOAD_MENU = "MENU_PRINCIPAL"
+PAYLOAD_PLANES = "VER_PLANES"
+PAYLOAD_RESERVAR = "COMO_RESERVAR"
+PAYLOAD_UBICACION = "VER_UBICACION"
+PAYLOAD_ECO = "DETALLE_ECO"
+PAYLOAD_FULL = "DETALLE_FULL"
+PAYLOAD_PAGO = "DATOS_PAGO"
+PAYLOAD_DISPONIBILIDAD = "CONSULTAR_DISPONIBILIDAD"
+
+# Built-in intents in priority order: (intent, button payload)
+INTENTS = (
+    ('menu', PAYLOAD_MENU),
+    ('planes', PAYLOAD_PLANES),
+    ('eco', PAYLOAD_ECO),
+    ('full', PAYLOAD_FULL),
+    ('disponibilidad', PAYLOAD_DISPONIBILIDAD),
+    ('reservar', PAYLOAD_RESERVAR),
+    ('pago', PAYLOAD_PAGO),
+    ('ubicacion', PAYLOAD_UBICACION),
+)
+
+KEYWORDS_PREFIX = 'kw_'
+
+
+def normalize(text):
+    """Lowercase, strip accents and collapse whitespace ("Ubicación" -> "ubicacion")"""
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.split())
+
+
+def custom_payload(intent):
+    """Button payload of a settings-defined intent"""
+    return f"INTENT_{intent.upper()}"
+
+
+class IntentRouter:
+    """Classifies a message by button payload, else by its keywords.
+
+    intents is [(intent, payload or None, [keywords])] in priority order;
+    when several intents' keywords appear, the earliest intent wins.
+    """
+
+    def __init__(self, intents):
+        self.intents = [intent for intent, _, _ in intents]
+        self.payloads = {payload: intent for intent, payload, _ in intents if payload}
+        self._keywords = {}
+        for priority, (intent, _, keywords) in enumerate(intents):
+            for keyword in map(normalize, keywords):
+                if keyword:
+                    self._keywords.setdefault(keyword, (priority, intent))
+        # Inside a lookahead every position reports its best keyword (highest
+        # priority, then longest), so an overlapping lower-priority keyword
+        # can't consume the text of a higher-priority one
+        alternatives = sorted(self._keywords, key=lambda keyword: (self._keywords[keyword][0], -len(keyword)))
+        self._pattern = re.compile(f"(?=({'|'.join(map(re.escape, alternatives))}))") if alternatives else None
+
+    def route(self, text, payload=''):
+        """Intent name for a message, or None"""
+        if payload in self.payloads:
+            return self.payloads[payload]
+        if not self._pattern or not text:
+            return None
+        found = [self._keywords[m.group(1)] for m in self._pattern.finditer(normalize(text))]
+        return min(found)[1] if found else None
+
+
+def parse_keywords(value):
+    """Comma-separated keywords from a settings value"""
+    return [keyword.strip() for keyword in (value or '').split(',') if keyword.strip()]
+
+
+def build_router(settings):
+    """Router for the built-in intents plus every extra kw_<name> setting"""
+    builtin = {intent for intent, _ in INTENTS}
+    intents = [
+        (intent, payload, parse_keywords(settings.get(KEYWORDS_PREFIX + intent)))
+        for intent, payload in INTENTS
+    ]
+    for key in sorted(settings):
+        intent = key[len(KEYWORDS_PREFIX):]
+        if key.startswith(KEYWORDS_PREFIX) and intent not in builtin:
+            intents.append((intent, custom_payload(intent), parse_keywords(settings[key])))
+    return IntentRouter(intents)
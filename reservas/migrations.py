@@ -0,0 +1,348 @@
+"""Versioned schema migrations, applied in order at startup by init_db.
+
+Each migration is (version, description, sql) and runs once, inside its own
+transaction, together with its row in the schema_version table. Never edit
+an applied migration; append a new one instead.
+"""
+import sqlite3
+
+MIGRATIONS = [
+    (1, "Base schema", '''
+        -- Admin users table
+        CREATE TABLE IF NOT EXISTS admins (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        
+        -- Categories table
+        CREATE TABLE IF NOT EXISTS categories (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT,
+            price_full_day INTEGER DEFAULT 0,
+            price_half_day INTEGER DEFAULT 0,
+            price_per_hour INTEGER DEFAULT 0,
+            stock INTEGER DEFAULT 0,
+            image TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        
+        -- Reservations table
+        CREATE TABLE IF NOT EXISTS reservations (
+            id TEXT PRIMARY KEY,
+            customer_name TEXT NOT NULL,
+            customer_phone TEXT NOT NULL,
+            customer_email TEXT,
+            customer_dni TEXT,
+            dni_photo TEXT,
+            rental_type TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT,
+            start_hour INTEGER DEFAULT 8,
+            end_hour INTEGER DEFAULT 19,
+            payment_method TEXT NOT NULL,
+            pickup_location TEXT DEFAULT 'sucursal',
+            return_location TEXT DEFAULT 'sucursal',
+            total INTEGER DEFAULT 0,
+            deposit INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'pending',
+            notes TEXT,
+            overridden_by TEXT,
+            overridden_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        
+        -- Reservation items table (many-to-many)
+        CREATE TABLE IF NOT EXISTS reservation_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            reservation_id TEXT NOT NULL,
+            category_id TEXT NOT NULL,
+            quantity INTEGER DEFAULT 1,
+            FOREIGN KEY (reservation_id) REFERENCES reservations(id) ON DELETE CASCADE,
+            FOREIGN KEY (category_id) REFERENCES categories(id)
+        );
+        
+        -- Settings table
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        
+        -- Hourly occupancy projection of confirmed reservations (see apply_occupancy)
+        CREATE TABLE IF NOT EXISTS occupancy (
+            category_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            qty INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (category_id, date, hour)
+        ) WITHOUT ROWID;
+        
+        -- Change counters used to invalidate in-process caches across workers
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+    '''),
+    (2, "Covering indexes for availability, booking and admin queries", '''
+        -- Reservations by status and start date (overlap checks, overrides, stats)
+        CREATE INDEX IF NOT EXISTS idx_reservations_status_dates
+            ON reservations (status, start_date, end_date, start_hour, end_hour, id);
+        
+        -- Confirmed reservations still running from a date on (engine refresh)
+        CREATE INDEX IF NOT EXISTS idx_reservations_status_end
+            ON reservations (status, end_date, start_date, start_hour, end_hour, id);
+        
+        -- Items of a category, and the category/quantity of each reservation
+        CREATE INDEX IF NOT EXISTS idx_reservation_items_category
+            ON reservation_items (category_id, reservation_id, quantity);
+        CREATE INDEX IF NOT EXISTS idx_reservation_items_reservation
+            ON reservation_items (reservation_id, category_id, quantity);
+    '''),
+    (3, "Indexes for the paginated admin reservation list", '''
+        -- Newest-first keyset pagination, with and without a status filter
+        CREATE INDEX IF NOT EXISTS idx_reservations_created
+            ON reservations (created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_reservations_status_created
+            ON reservations (status, created_at, id);
+    '''),
+    (4, "Daily reservation stats rollup", '''
+        -- Reservation count and revenue per start date and status
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            date TEXT NOT NULL,
+            status TEXT NOT NULL,
+            reservations INTEGER NOT NULL DEFAULT 0,
+            revenue INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (date, status)
+        ) WITHOUT ROWID;
+        
+        INSERT INTO daily_stats (date, status, reservations, revenue)
+        SELECT start_date, COALESCE(status, ''), COUNT(*), COALESCE(SUM(total), 0)
+        FROM reservations
+        GROUP BY start_date, COALESCE(status, '');
+        
+        -- Kept in step with every write to reservations, in the same transaction
+        CREATE TRIGGER IF NOT EXISTS daily_stats_insert AFTER INSERT ON reservations
+        BEGIN
+            INSERT INTO daily_stats (date, status, reservations, revenue)
+            VALUES (NEW.start_date, COALESCE(NEW.status, ''), 1, COALESCE(NEW.total, 0))
+            ON CONFLICT(date, status) DO UPDATE SET
+                reservations = reservations + 1,
+                revenue = revenue + excluded.revenue;
+        END;
+        
+        CREATE TRIGGER IF NOT EXISTS daily_stats_delete AFTER DELETE ON reservations
+        BEGIN
+            UPDATE daily_stats
+            SET reservations = reservations - 1, revenue = revenue - COALESCE(OLD.total, 0)
+            WHERE date = OLD.start_date AND status = COALESCE(OLD.status, '');
+            DELETE FROM daily_stats
+            WHERE date = OLD.start_date AND status = COALESCE(OLD.status, '') AND reservations = 0;
+        END;
+        
+        CREATE TRIGGER IF NOT EXISTS daily_stats_update AFTER UPDATE OF start_date, status, total ON reservations
+        BEGIN
+            UPDATE daily_stats
+            SET reservations = reservations - 1, revenue = revenue - COALESCE(OLD.total, 0)
+            WHERE date = OLD.start_date AND status = COALESCE(OLD.status, '');
+            DELETE FROM daily_stats
+            WHERE date = OLD.start_date AND status = COALESCE(OLD.status, '') AND reservations = 0;
+            INSERT INTO daily_stats (date, status, reservations, revenue)
+            VALUES (NEW.start_date, COALESCE(NEW.status, ''), 1, COALESCE(NEW.total, 0))
+            ON CONFLICT(date, status) DO UPDATE SET
+                reservations = reservations + 1,
+                revenue = revenue + excluded.revenue;
+        END;
+    '''),
+    (5, "DNI photo thumbnails", '''
+        -- /media/ URL of the small preview shown in the admin list
+        ALTER TABLE reservations ADD COLUMN dni_thumb TEXT;
+    '''),
+    (6, "Resumable uploads and upload dedupe", '''
+        -- Chunked upload sessions (bytes live in data/uploads/<id>.part)
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_uploads_sha256 ON uploads (sha256, size);
+        
+        -- Processed result of every DNI upload, by SHA-256 of the original file
+        CREATE TABLE IF NOT EXISTS upload_hashes (
+            sha256 TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            thumb_url TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    '''),
+    (7, "Durable inbound WhatsApp queue", '''
+        -- Webhook messages, deduplicated by WhatsApp message id (see wa_inbox.py)
+        CREATE TABLE IF NOT EXISTS wa_inbox (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id TEXT NOT NULL UNIQUE,
+            sender TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL NOT NULL DEFAULT 0,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_wa_inbox_status ON wa_inbox (status, seq);
+    '''),
+    (8, "WhatsApp conversation state", '''
+        -- Current flow step and collected data per sender (see conversations.py)
+        CREATE TABLE IF NOT EXISTS conversations (
+            phone TEXT PRIMARY KEY,
+            step TEXT NOT NULL,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_at);
+    '''),
+    (9, "Reminder broadcasts", '''
+        -- One reminder broadcast per target date (see broadcasts.py)
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            target_date TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            UNIQUE (kind, target_date)
+        );
+        
+        -- Rendered message and delivery state per reservation
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id TEXT NOT NULL,
+            reservation_id TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (broadcast_id, reservation_id),
+            FOREIGN KEY (broadcast_id) REFERENCES broadcasts(id) ON DELETE CASCADE
+        );
+    '''),
+    (10, "WhatsApp media attachments", '''
+        -- Customer phone in WhatsApp form (549...), to find a sender's reservations
+        ALTER TABLE reservations ADD COLUMN wa_phone TEXT;
+        CREATE INDEX IF NOT EXISTS idx_reservations_wa_phone ON reservations (wa_phone, created_at);
+        
+        -- Photos/documents sent to the bot: download queue and reservation attachments (see wa_media.py)
+        CREATE TABLE IF NOT EXISTS wa_media (
+            media_id TEXT PRIMARY KEY,
+            sender TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            mime_type TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL NOT NULL DEFAULT 0,
+            error TEXT,
+            reservation_id TEXT,
+            url TEXT,
+            thumb_url TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_wa_media_status ON wa_media (status, created_at);
+        CREATE INDEX IF NOT EXISTS idx_wa_media_reservation ON wa_media (reservation_id);
+    '''),
+    (11, "Mercado Pago preferences created in the background", '''
+        -- Checkout preference of a Mercado Pago booking: pending -> ready | error (see payments.py)
+        ALTER TABLE reservations ADD COLUMN mp_status TEXT;
+        ALTER TABLE reservations ADD COLUMN mp_init_point TEXT;
+        ALTER TABLE reservations ADD COLUMN mp_preference_id TEXT;
+        ALTER TABLE reservations ADD COLUMN mp_error TEXT;
+    '''),
+    (12, "Idempotent Mercado Pago notifications", '''
+        -- One row per notified resource; repeats are skipped (see payments.PaymentSync)
+        CREATE TABLE IF NOT EXISTS mp_notifications (
+            topic TEXT NOT NULL,
+            resource_id TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL NOT NULL DEFAULT 0,
+            error TEXT,
+            reservation_id TEXT,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP,
+            PRIMARY KEY (topic, resource_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_mp_notifications_status ON mp_notifications (status, received_at);
+    '''),
+    (13, "Broadcast runner ownership", '''
+        -- Runner sending a broadcast and its last sign of life (see broadcasts.py)
+        ALTER TABLE broadcasts ADD COLUMN owner TEXT;
+        ALTER TABLE broadcasts ADD COLUMN heartbeat REAL;
+    '''),
+    (14, "Drop the engine refresh index", '''
+        -- Availability reads the occupancy table now; nothing queries by end date
+        DROP INDEX IF EXISTS idx_reservations_status_end;
+    '''),
+    (15, "Upload session state and expiry index", '''
+        -- uploading -> finalizing -> done; finalize claims the session with a conditional update
+        ALTER TABLE uploads ADD COLUMN status TEXT NOT NULL DEFAULT 'uploading';
+        
+        -- Expired sessions are looked up by age on every new upload
+        CREATE INDEX IF NOT EXISTS idx_uploads_created ON uploads (created_at);
+    '''),
+    (16, "Renormalize WhatsApp phones", '''
+        -- Recomputed by init_db with the wa_phone that handles 15 and a missing mobile 9
+        UPDATE reservations SET wa_phone = NULL;
+    '''),
+]
+
+
+def split_statements(script):
+    """Split a SQL script into complete statements"""
+    statements = []
+    buf = ''
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            statements.append(buf.strip())
+            buf = ''
+    return statements
+
+
+def current_version(conn):
+    """Highest applied migration version (0 for a fresh database)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def run_migrations(conn):
+    """Apply pending migrations. Safe to call from several processes at once."""
+    current_version(conn)
+    conn.commit()
+    for version, description, sql in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Re-check under the write lock: another worker may have applied it
+            if current_version(conn) >= version:
+                conn.rollback()
+                continue
+            for statement in split_statements(sql):
+                conn.execute(statement)
+            conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            conn.commit()
+            print(f"Migración {version} aplicada: {description}")
+        except Exception:
+            conn.rollback()
+            raise
@@ -0,0 +1,372 @@
+"""Mercado Pago: checkout preferences and payment notifications, off the request path.
+
+create_reservation only stores the reservation with mp_status 'pending';
+a small bounded thread pool calls the preferences API with a strict
+timeout and writes the init_point (or the error) on the reservation row,
+which the booking page polls. Every SDK call shares one keep-alive HTTP
+session instead of opening a new connection per request.
+
+Webhook notifications are recorded once per (topic, resource id) in
+mp_notifications and checked against the API by a background worker;
+the same worker periodically searches recent approved payments, so a
+lost notification never leaves a paid booking unconfirmed.
+"""
+from datetime import datetime, timedelta, timezone
+import queue
+import threading
+import time
+
+import mercadopago
+import requests
+from mercadopago.config import RequestOptions
+from mercadopago.http import HttpClient
+from requests.adapters import HTTPAdapter
+
+# Preference workers and preferences waiting for one at most
+MP_WORKERS = 4
+MP_QUEUE_LIMIT = 100
+
+# Seconds to connect / wait for each response; connection failures retried once
+MP_TIMEOUT = 8.0
+MP_CONNECT_RETRIES = 1
+
+DEPOSIT_TITLE = "Seña (50%) - Reserva BiciSí"
+
+# Notification topics we act on; tries per notification and retry delay base in seconds
+NOTIFICATION_TOPICS = ('payment', 'merchant_order')
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_DELAY = 30
+
+# Reconciliation: how often, how far back, and the payments search page size/limit
+SWEEP_INTERVAL = 5 * 60
+SWEEP_FIRST_DELAY = 30
+SWEEP_WINDOW_DAYS = 3
+SWEEP_PAGE_SIZE = 100
+SWEEP_MAX_PAGES = 10
+
+# Processed notifications are forgotten after this many days
+NOTIFICATION_RETENTION_DAYS = 30
+
+
+class PooledHttpClient(HttpClient):
+    """SDK transport over one pooled requests.Session (the stock client opens one per call)"""
+
+    def __init__(self, pool_size=MP_WORKERS * 2, connect_retries=MP_CONNECT_RETRIES):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=connect_retries)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, maxretries=None, **kwargs):
+        # Retry policy lives in the adapter; drop the SDK's per-call knobs
+        kwargs.pop('retry_on', None)
+        kwargs.pop('backoff_factor', None)
+        api_result = self.session.request(method, url, **kwargs)
+        response = {"status": api_result.status_code, "response": None}
+        if api_result.status_code != 204 and api_result.content:
+            try:
+                response["response"] = api_result.json()
+            except ValueError:
+                response["response"] = {"message": api_result.text[:500]}
+        return response
+
+
+def make_sdk(access_token, timeout=MP_TIMEOUT):
+    """Mercado Pago SDK on the pooled client with a strict per-call timeout"""
+    return mercadopago.SDK(
+        access_token,
+        http_client=PooledHttpClient(),
+        request_options=RequestOptions(connection_timeout=timeout),
+    )
+
+
+def build_preference(row, public_url):
+    """Checkout preference charging a reservation's deposit, or None if there's nothing to charge"""
+    if not row['deposit'] or row['deposit'] <= 0:
+        return None
+    back_url = f"{public_url}/reserva?reservation_id={row['id']}&status="
+    return {
+        "items": [{
+            "title": DEPOSIT_TITLE,
+            "quantity": 1,
+            "unit_price": float(row['deposit']),
+            "currency_id": "ARS"
+        }],
+        "payer": {
+            "name": row['customer_name'],
+            "email": row['customer_email'] or 'test_user@test.com',
+            "phone": {"area_code": "", "number": row['customer_phone']},
+            "identification": {"type": "DNI", "number": row['customer_dni']}
+        },
+        "back_urls": {
+            "success": back_url + "success",
+            "failure": back_url + "failure",
+            "pending": back_url + "pending"
+        },
+        "auto_return": "approved",
+        "notification_url": f"{public_url}/api/mp-webhook",
+        "external_reference": row['id'],
+        "statement_descriptor": "BICISI RESERVA"
+    }
+
+
+class PreferenceQueue:
+    """Creates checkout preferences for reservations in worker threads.
+
+    submit(reservation_id) returns False when MP_QUEUE_LIMIT preferences
+    are already waiting; the reservation then keeps mp_status 'pending'
+    until resume() (at startup) or a client retry queues it again.
+    """
+
+    def __init__(self, connect, sdk, public_url, sandbox=False, workers=MP_WORKERS, queue_limit=MP_QUEUE_LIMIT):
+        self.connect = connect
+        self.sdk = sdk
+        self.public_url = public_url
+        self.sandbox = sandbox
+        self.workers = workers
+        self._queue = queue.Queue(queue_limit)
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """Start the workers (once)"""
+        with self._lock:
+            if self._threads:
+                return
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"mp-preference-{n}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def submit(self, reservation_id):
+        """Queue a reservation's preference (once); False if the queue is full"""
+        self.start()
+        with self._lock:
+            if reservation_id in self._queued:
+                return True
+            try:
+                self._queue.put_nowait(reservation_id)
+            except queue.Full:
+                return False
+            self._queued.add(reservation_id)
+        return True
+
+    def resume(self):
+        """Queue the preferences left pending by the last run"""
+        rows = self.connect().execute(
+            "SELECT id FROM reservations WHERE mp_status = 'pending' AND status = 'pending_payment'"
+        ).fetchall()
+        return sum(self.submit(row['id']) for row in rows)
+
+    def _store(self, reservation_id, status, init_point=None, preference_id=None, error=None):
+        conn = self.connect()
+        conn.execute('''
+            UPDATE reservations SET mp_status = ?, mp_init_point = ?, mp_preference_id = ?, mp_error = ?
+            WHERE id = ?
+        ''', (status, init_point, preference_id, error, reservation_id))
+        conn.commit()
+
+    def create(self, reservation_id):
+        """Call the preferences API for one reservation and store the outcome"""
+        row = self.connect().execute("SELECT * FROM reservations WHERE id = ?", (reservation_id,)).fetchone()
+        if row is None or row['mp_status'] != 'pending':
+            return
+        try:
+            preference_data = build_preference(row, self.public_url)
+            if preference_data is None:
+                raise ValueError("no deposit to charge")
+            preference = self.sdk.preference().create(preference_data)["response"] or {}
+            if "init_point" not in preference:
+                raise ValueError(f"MP error: {preference.get('message', preference)}")
+        except Exception as e:
+            print(f"Error creating MP preference for {reservation_id}: {e}")
+            self._store(reservation_id, 'error', error=str(e)[:500])
+            return
+        # Use sandbox_init_point with TEST credentials
+        init_point = preference.get("sandbox_init_point", preference["init_point"]) if self.sandbox else preference["init_point"]
+        self._store(reservation_id, 'ready', init_point, preference.get("id"))
+
+    def _work(self):
+        while True:
+            reservation_id = self._queue.get()
+            try:
+                self.create(reservation_id)
+            except Exception as e:
+                print(f"Error en la cola de Mercado Pago ({reservation_id}): {e}")
+            finally:
+                # Only now, so a retry while the call is in flight doesn't create a second preference
+                with self._lock:
+                    self._queued.discard(reservation_id)
+
+
+def notification_key(topic, resource_id):
+    """(topic, id) of a notification; merchant orders may come as a resource URL"""
+    return topic, str(resource_id).rstrip('/').split('/')[-1]
+
+
+def check_notification(sdk, topic, resource_id):
+    """Ask the API about a notified resource; return (external_reference to confirm or None, final).
+
+    final is False while the payment can still be approved later, so a
+    repeated notification for it is looked at again.
+    """
+    if topic == 'payment':
+        payment = sdk.payment().get(resource_id)["response"] or {}
+        if 'status' not in payment:
+            raise ValueError(f"MP error: {payment.get('message', payment)}")
+        approved = payment['status'] == 'approved'
+        final = payment['status'] not in ('pending', 'in_process', 'authorized')
+        return (payment.get('external_reference') if approved else None), final
+    order = sdk.merchant_order().get(resource_id)["response"] or {}
+    if 'total_amount' not in order:
+        raise ValueError(f"MP error: {order.get('message', order)}")
+    paid = sum(p.get('total_paid_amount', 0) for p in order.get('payments', []) if p.get('status') == 'approved')
+    if order.get('payments') and paid >= order['total_amount']:
+        return order.get('external_reference'), True
+    return None, order.get('status') == 'closed'
+
+
+def approved_references(sdk, since):
+    """external_reference of every payment approved since the given datetime (UTC)"""
+    begin = since.strftime('%Y-%m-%dT%H:%M:%S.000-00:00')
+    references = set()
+    for page in range(SWEEP_MAX_PAGES):
+        result = sdk.payment().search({
+            "status": "approved",
+            "range": "date_created", "begin_date": begin, "end_date": "NOW",
+            "sort": "date_created", "criteria": "desc",
+            "limit": SWEEP_PAGE_SIZE, "offset": page * SWEEP_PAGE_SIZE,
+        })["response"] or {}
+        if 'results' not in result:
+            raise ValueError(f"MP error: {result.get('message', result)}")
+        references.update(p['external_reference'] for p in result['results'] if p.get('external_reference'))
+        if len(result['results']) < SWEEP_PAGE_SIZE:
+            break
+    return references
+
+
+class PaymentSync:
+    """Background worker confirming paid reservations.
+
+    notify(topic, resource_id) records a webhook notification; repeats of
+    one already queued or settled are skipped, so MP's redundant payment
+    and merchant_order deliveries cost one API call in total. Every
+    SWEEP_INTERVAL seconds the pending_payment reservations are reconciled
+    against one bulk payments search. confirm(reservation_id) must confirm
+    a pending_payment reservation and return True if it did.
+    """
+
+    def __init__(self, connect, sdk, confirm):
+        self.connect = connect
+        self.sdk = sdk
+        self.confirm = confirm
+        self._cond = threading.Condition()
+        self._thread = None
+        self._next_sweep = 0
+
+    def start(self):
+        """Start the worker (once), requeuing notifications interrupted by a crash"""
+        with self._cond:
+            if self._thread:
+                return
+            conn = self.connect()
+            conn.execute("UPDATE mp_notifications SET status = 'pending' WHERE status = 'processing'")
+            conn.commit()
+            self._next_sweep = time.time() + SWEEP_FIRST_DELAY
+            self._thread = threading.Thread(target=self._work, name="mp-sync", daemon=True)
+            self._thread.start()
+
+    def notify(self, topic, resource_id):
+        """Record a notification; False if it's a repeat that needs no work"""
+        topic, resource_id = notification_key(topic, resource_id)
+        conn = self.connect()
+        # A repeat only reopens a notification whose payment wasn't settled yet
+        cursor = conn.execute('''
+            INSERT INTO mp_notifications (topic, resource_id) VALUES (?, ?)
+            ON CONFLICT (topic, resource_id) DO UPDATE
+            SET status = 'pending', attempts = 0, available_at = 0
+            WHERE status = 'waiting'
+        ''', (topic, resource_id))
+        conn.commit()
+        if cursor.rowcount:
+            self.start()
+            with self._cond:
+                self._cond.notify()
+        return bool(cursor.rowcount)
+
+    def _claim(self, conn):
+        row = conn.execute('''
+            SELECT topic, resource_id, attempts FROM mp_notifications
+            WHERE status = 'pending' AND available_at <= ?
+            ORDER BY received_at LIMIT 1
+        ''', (time.time(),)).fetchone()
+        if not row:
+            return None
+        # Only one process wins the row
+        claimed = conn.execute(
+            "UPDATE mp_notifications SET status = 'processing' WHERE topic = ? AND resource_id = ? AND status = 'pending'",
+            (row['topic'], row['resource_id'])
+        ).rowcount
+        conn.commit()
+        return row if claimed else self._claim(conn)
+
+    def _process(self, conn, row):
+        try:
+            reference, final = check_notification(self.sdk, row['topic'], row['resource_id'])
+            if reference and self.confirm(reference):
+                print(f"MP: reserva {reference} confirmada ({row['topic']} {row['resource_id']})", flush=True)
+            conn.execute('''
+                UPDATE mp_notifications SET status = ?, reservation_id = ?, error = NULL, processed_at = CURRENT_TIMESTAMP
+                WHERE topic = ? AND resource_id = ?
+            ''', ('done' if final or reference else 'waiting', reference, row['topic'], row['resource_id']))
+        except Exception as e:
+            print(f"MP: error procesando {row['topic']} {row['resource_id']}: {e}", flush=True)
+            final = row['attempts'] + 1 >= NOTIFICATION_MAX_ATTEMPTS
+            conn.execute('''
+                UPDATE mp_notifications SET status = ?, attempts = attempts + 1, available_at = ?, error = ?
+                WHERE topic = ? AND resource_id = ?
+            ''', (
+                'failed' if final else 'pending', time.time() + NOTIFICATION_RETRY_DELAY * 2 ** row['attempts'],
+                str(e)[:500], row['topic'], row['resource_id']
+            ))
+        conn.commit()
+
+    def sweep(self):
+        """Confirm pending_payment reservations with an approved payment; return how many"""
+        conn = self.connect()
+        since = datetime.now(timezone.utc) - timedelta(days=SWEEP_WINDOW_DAYS)
+        pending = {row['id'] for row in conn.execute(
+            "SELECT id FROM reservations WHERE status = 'pending_payment' AND created_at >= ?",
+            (since.strftime('%Y-%m-%d %H:%M:%S'),)
+        )}
+        conn.execute(
+            "DELETE FROM mp_notifications WHERE status IN ('done', 'waiting', 'failed') AND received_at < datetime('now', ?)",
+            (f'-{NOTIFICATION_RETENTION_DAYS} days',)
+        )
+        conn.commit()
+        if not pending:
+            return 0
+        confirmed = [ref for ref in approved_references(self.sdk, since) & pending if self.confirm(ref)]
+        for reference in confirmed:
+            print(f"MP: reserva {reference} confirmada por conciliación", flush=True)
+        return len(confirmed)
+
+    def _work(self):
+        while True:
+            if time.time() >= self._next_sweep:
+                self._next_sweep = time.time() + SWEEP_INTERVAL
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print(f"MP: error en la conciliación de pagos: {e}", flush=True)
+            try:
+                conn = self.connect()
+                row = self._claim(conn)
+            except Exception as e:
+                print(f"MP: error leyendo notificaciones: {e}", flush=True)
+                row = None
+            if row is None:
+                with self._cond:
+                    self._cond.wait(max(0, min(NOTIFICATION_RETRY_DELAY, self._next_sweep - time.time())))
+                continue
+            self._process(conn, row)
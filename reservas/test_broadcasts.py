@@ -0,0 +1,45 @@
+import sys
+
+from broadcasts import wa_phone
+
+# (as the customer typed it, WhatsApp number)
+WA_PHONE_CASES = [
+    ("3515575810", "5493515575810"),
+    ("0351 557-5810", "5493515575810"),
+    ("351 15 5575810", "5493515575810"),
+    ("0351 15-557-5810", "5493515575810"),
+    ("(0351) 155575810", "5493515575810"),
+    ("+54 351 5575810", "5493515575810"),
+    ("+54 9 351 5575810", "5493515575810"),
+    ("+54 351 15 5575810", "5493515575810"),
+    ("0054 9 351 5575810", "5493515575810"),
+    ("543515575810", "5493515575810"),
+    # 2-digit (Buenos Aires) and 4-digit area codes
+    ("11 15 4567-8901", "5491145678901"),
+    ("011 4567-8901", "5491145678901"),
+    ("+54 11 4567 8901", "5491145678901"),
+    ("3541 15 575810", "5493541575810"),
+    ("03541-575810", "5493541575810"),
+    ("+54 9 3541 575810", "5493541575810"),
+    # Area code ending in 1 followed by 15
+    ("0221 15 4123456", "5492214123456"),
+    ("", ""),
+    (None, ""),
+]
+
+def test_wa_phone():
+    print("--- Testing WhatsApp phone normalization ---")
+    ok = True
+    for phone, expected in WA_PHONE_CASES:
+        got = wa_phone(phone)
+        if got != expected:
+            print(f"❌ {phone!r}: expected {expected}, got {got}")
+            ok = False
+        else:
+            print(f"✅ {phone!r} -> {got}")
+    return ok
+
+if __name__ == "__main__":
+    if not test_wa_phone():
+        sys.exit(1)
+    print("\n🎉 ALL TESTS PASSED!")
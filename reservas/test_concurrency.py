@@ -0,0 +1,90 @@
+import requests
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_URL = "http://127.0.0.1:5001"
+
+# Load test parameters
+STOCK = 5
+PARALLEL_BOOKINGS = 200
+WORKERS = 50
+TEST_DATE = "2099-12-24"
+
+def login():
+    session = requests.Session()
+    resp = session.post(f"{BASE_URL}/admin/login", json={"username": "admin", "password": "bicisi2024"})
+    if resp.status_code != 200:
+        print(f"❌ Login failed: {resp.status_code}")
+        sys.exit(1)
+    return session
+
+def book(category_id, n):
+    """Fire one public booking for the contended slot"""
+    payload = {
+        "items": [{"category_id": category_id, "quantity": 1}],
+        "rental_type": "hours",
+        "start_date": TEST_DATE,
+        "end_date": TEST_DATE,
+        "start_hour": 10,
+        "end_hour": 12,
+        "customer_name": f"Load Test {n}",
+        "customer_phone": f"000{n}",
+        "customer_dni": "1",
+        "payment_method": "transfer",  # transfer bookings are confirmed right away
+    }
+    try:
+        resp = requests.post(f"{BASE_URL}/api/reservations", json=payload, timeout=60)
+        return resp.status_code, resp.json()
+    except Exception as e:
+        return None, {"error": str(e)}
+
+def test_no_overbooking(admin):
+    print(f"--- Firing {PARALLEL_BOOKINGS} parallel bookings at one slot (stock {STOCK}) ---")
+
+    # Dedicated category so the test doesn't depend on existing stock
+    resp = admin.post(f"{BASE_URL}/api/admin/categories", json={
+        "name": "Load Test Bike", "description": "", "stock": STOCK,
+        "price_full_day": 1, "price_half_day": 1, "price_per_hour": 1,
+    })
+    category_id = resp.json()["id"]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        results = list(pool.map(lambda n: book(category_id, n), range(PARALLEL_BOOKINGS)))
+    elapsed = time.perf_counter() - started
+
+    booked = [data["reservation_id"] for status, data in results if status == 200]
+    rejected = [data for status, data in results if status == 400]
+    errors = [(status, data) for status, data in results if status not in (200, 400)]
+
+    print(f"Booked: {len(booked)}  Rejected (no stock): {len(rejected)}  Errors: {len(errors)}")
+    print(f"Throughput: {PARALLEL_BOOKINGS / elapsed:.1f} bookings/s ({elapsed:.2f}s total)")
+
+    slots = requests.post(f"{BASE_URL}/api/available-slots", json={
+        "date": TEST_DATE, "category_id": category_id, "quantity": 1
+    }).json()["slots"]
+    remaining = min(slot["remaining"] for slot in slots if 9 <= slot["hour"] < 13)
+
+    try:
+        if errors:
+            print(f"❌ Unexpected errors: {errors[:3]}")
+            return False
+        if len(booked) > STOCK:
+            print(f"❌ Overbooked! {len(booked)} bookings for a stock of {STOCK}")
+            return False
+        if len(booked) != STOCK or remaining != 0:
+            print(f"❌ Expected exactly {STOCK} bookings and 0 remaining, got {len(booked)} / {remaining}")
+            return False
+        print("✅ Stock never exceeded under contention")
+        return True
+    finally:
+        for reservation_id in booked:
+            admin.delete(f"{BASE_URL}/api/admin/reservations/{reservation_id}")
+        admin.delete(f"{BASE_URL}/api/admin/categories/{category_id}")
+
+if __name__ == "__main__":
+    admin = login()
+    if not test_no_overbooking(admin):
+        sys.exit(1)
+    print("\n🎉 ALL TESTS PASSED!")
@@ -0,0 +1,58 @@
+import json
+import os
+import sys
+
+from intents import IntentRouter, build_router
+
+DEFAULT_MESSAGES_PATH = os.path.join(os.path.dirname(__file__), 'data', 'default_messages.json')
+
+# (keywords by intent in priority order, message, expected intent)
+OVERLAP_CASES = [
+    # The lower-priority keyword starts first and swallows the higher-priority one
+    ([('menu', ['bici']), ('disponibilidad', ['hay bicis'])], "hay bicis para mañana?", 'menu'),
+    ([('pago', ['seña']), ('reservar', ['reservar con seña'])], "quiero reservar con seña", 'pago'),
+    # Both start at the same position; priority still decides, not length
+    ([('eco', ['eco']), ('full', ['eco full'])], "eco full", 'eco'),
+    ([('full', ['eco full']), ('eco', ['eco'])], "eco full", 'full'),
+    # Sharing only a suffix/prefix
+    ([('ubicacion', ['donde']), ('menu', ['buen dia'])], "buen dia, donde estan?", 'ubicacion'),
+    ([('menu', ['hola'])], "sin coincidencias", None),
+]
+
+def test_priority_wins_over_overlaps():
+    print("--- Testing overlapping keywords ---")
+    ok = True
+    for keywords, text, expected in OVERLAP_CASES:
+        router = IntentRouter([(intent, None, words) for intent, words in keywords])
+        got = router.route(text)
+        if got != expected:
+            print(f"❌ {text!r} with {keywords}: expected {expected}, got {got}")
+            ok = False
+        else:
+            print(f"✅ {text!r} -> {got}")
+    return ok
+
+def test_default_keywords():
+    print("\n--- Testing default keywords ---")
+    with open(DEFAULT_MESSAGES_PATH, 'r', encoding='utf-8') as f:
+        router = build_router(json.load(f))
+    ok = True
+    for text, expected in (
+        ("Hola! hay bicis el sábado?", 'menu'),
+        ("hay bicis el sábado?", 'disponibilidad'),
+        ("¿Dónde están? quiero reservar", 'reservar'),
+        ("me pasás el CBU", 'pago'),
+    ):
+        got = router.route(text)
+        if got != expected:
+            print(f"❌ {text!r}: expected {expected}, got {got}")
+            ok = False
+        else:
+            print(f"✅ {text!r} -> {got}")
+    return ok
+
+if __name__ == "__main__":
+    results = [test_priority_wins_over_overlaps(), test_default_keywords()]
+    if not all(results):
+        sys.exit(1)
+    print("\n🎉 ALL TESTS PASSED!")
@@ -0,0 +1,197 @@
+import os
+import sqlite3
+import sys
+import tempfile
+
+import app
+from migrations import MIGRATIONS
+
+# Hot queries and the index each one must keep using
+HOT_QUERIES = [
+    (
+        "hourly occupancy lookup",
+        "SELECT hour, qty FROM occupancy WHERE category_id = ? AND date = ?",
+        ["PRIMARY KEY"],
+    ),
+    (
+        "batch availability range",
+        '''
+        SELECT category_id, date, hour, qty FROM occupancy
+        WHERE category_id IN (?, ?) AND date BETWEEN ? AND ?
+        ''',
+        ["PRIMARY KEY"],
+    ),
+    (
+        "max usage over a booking",
+        '''
+        SELECT MAX(qty) FROM occupancy
+        WHERE category_id = ? AND date BETWEEN ? AND ?
+        AND (date > ? OR hour >= ?)
+        AND (date < ? OR hour < ?)
+        ''',
+        ["PRIMARY KEY (category_id=? AND date>? AND date<?)"],
+    ),
+    (
+        "month calendar",
+        '''
+        SELECT date, MAX(qty) AS peak, SUM(qty > ?) AS full_hours
+        FROM occupancy
+        WHERE category_id = ? AND date BETWEEN ? AND ?
+        GROUP BY date
+        ''',
+        ["PRIMARY KEY"],
+    ),
+    (
+        "reservation items of a reservation",
+        "SELECT category_id, quantity FROM reservation_items WHERE reservation_id = ?",
+        ["COVERING INDEX idx_reservation_items_reservation"],
+    ),
+    (
+        "cash override on transfer booking",
+        '''
+        UPDATE reservations
+        SET status = 'overridden', overridden_by = ?, overridden_at = ?
+        WHERE payment_method = 'cash'
+        AND status = 'pending'
+        AND start_date = ?
+        ''',
+        ["idx_reservations_status_dates (status=? AND start_date=?)"],
+    ),
+    (
+        "reservations of a category",
+        "SELECT reservation_id, quantity FROM reservation_items WHERE category_id = ?",
+        ["COVERING INDEX idx_reservation_items_category"],
+    ),
+    (
+        "admin list page",
+        '''
+        SELECT r.id FROM reservations r
+        WHERE r.status != 'pending_payment' AND (r.created_at, r.id) < (?, ?)
+        ORDER BY r.created_at DESC, r.id DESC LIMIT ?
+        ''',
+        ["idx_reservations_created"],
+    ),
+    (
+        "admin list page by status",
+        '''
+        SELECT r.id FROM reservations r
+        WHERE r.status != 'pending_payment' AND r.status = ? AND (r.created_at, r.id) < (?, ?)
+        ORDER BY r.created_at DESC, r.id DESC LIMIT ?
+        ''',
+        ["idx_reservations_status_created"],
+    ),
+    (
+        "WhatsApp inbox claim",
+        '''
+        SELECT seq, sender, payload, status, attempts, available_at FROM wa_inbox
+        WHERE status IN ('pending', 'processing')
+        ORDER BY seq
+        LIMIT ?
+        ''',
+        ["idx_wa_inbox_status"],
+    ),
+    (
+        "reminder recipients of a date",
+        '''
+        SELECT id, customer_name, customer_phone, start_date, start_hour
+        FROM reservations
+        WHERE status = 'confirmed' AND start_date = ?
+        ''',
+        ["idx_reservations_status_dates (status=? AND start_date=?)"],
+    ),
+    (
+        "latest reservation of a WhatsApp sender",
+        "SELECT id, dni_photo FROM reservations WHERE wa_phone = ? ORDER BY created_at DESC LIMIT 1",
+        ["idx_reservations_wa_phone (wa_phone=?)"],
+    ),
+    (
+        "WhatsApp media claim",
+        "SELECT * FROM wa_media WHERE status = 'pending' AND available_at <= ? ORDER BY created_at LIMIT 1",
+        ["idx_wa_media_status"],
+    ),
+    (
+        "Mercado Pago notification claim",
+        '''
+        SELECT topic, resource_id, attempts FROM mp_notifications
+        WHERE status = 'pending' AND available_at <= ?
+        ORDER BY received_at LIMIT 1
+        ''',
+        ["idx_mp_notifications_status"],
+    ),
+    (
+        "expired upload sessions",
+        "SELECT id FROM uploads WHERE created_at < datetime('now', ?)",
+        ["idx_uploads_created"],
+    ),
+    (
+        "payment reconciliation sweep",
+        "SELECT id FROM reservations WHERE status = 'pending_payment' AND created_at >= ?",
+        ["idx_reservations_status_created (status=? AND created_at>?)"],
+    ),
+]
+
+def fresh_db():
+    app.DB_PATH = os.path.join(tempfile.mkdtemp(), 'test.db')
+    app.init_db()
+    return sqlite3.connect(app.DB_PATH)
+
+def test_migrations_recorded_and_idempotent():
+    print("--- Testing migration runner ---")
+    conn = fresh_db()
+    versions = [row[0] for row in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+    expected = [version for version, _, _ in MIGRATIONS]
+    if versions != expected:
+        print(f"❌ Expected versions {expected}, got {versions}")
+        return False
+
+    # Running again must be a no-op
+    app.init_db()
+    count = conn.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0]
+    if count != len(MIGRATIONS):
+        print(f"❌ Migrations re-applied: {count} rows in schema_version")
+        return False
+    print(f"✅ {len(MIGRATIONS)} migrations applied once")
+    return True
+
+def test_hot_queries_use_indexes():
+    print("\n--- Testing query plans ---")
+    conn = fresh_db()
+    ok = True
+    for name, sql, expected in HOT_QUERIES:
+        plan = " | ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, [None] * sql.count('?')))
+        missing = [index for index in expected if index not in plan]
+        if missing or "SCAN reservations" in plan or "SCAN r " in plan:
+            print(f"❌ {name}: expected {missing or expected} in plan: {plan}")
+            ok = False
+        else:
+            print(f"✅ {name}: {plan}")
+    return ok
+
+def test_daily_stats_follow_writes():
+    print("\n--- Testing daily_stats rollup ---")
+    conn = fresh_db()
+    for i in range(30):
+        conn.execute('''
+            INSERT INTO reservations (id, customer_name, customer_phone, rental_type, start_date, payment_method, total, status)
+            VALUES (?, 'x', '1', 'hours', ?, 'cash', ?, ?)
+        ''', (f"r{i}", f"2099-01-0{i % 3 + 1}", i * 100, ['pending', 'confirmed', 'pending_payment'][i % 3]))
+    conn.execute("UPDATE reservations SET status = 'confirmed' WHERE status = 'pending' AND total > 1000")
+    conn.execute("UPDATE reservations SET start_date = '2099-02-01', total = total + 1 WHERE id IN ('r1', 'r4')")
+    conn.execute("DELETE FROM reservations WHERE id IN ('r2', 'r7', 'r9')")
+    conn.commit()
+    
+    rollup = conn.execute("SELECT date, status, reservations, revenue FROM daily_stats ORDER BY 1, 2").fetchall()
+    expected = conn.execute('''
+        SELECT start_date, status, COUNT(*), SUM(total) FROM reservations GROUP BY 1, 2 ORDER BY 1, 2
+    ''').fetchall()
+    if rollup != expected:
+        print(f"❌ daily_stats drifted:\n  {rollup}\n  expected {expected}")
+        return False
+    print(f"✅ daily_stats matches a full recount ({len(rollup)} rows)")
+    return True
+
+if __name__ == "__main__":
+    results = [test_migrations_recorded_and_idempotent(), test_hot_queries_use_indexes(), test_daily_stats_follow_writes()]
+    if not all(results):
+        sys.exit(1)
+    print("\n🎉 ALL TESTS PASSED!")
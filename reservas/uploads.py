@@ -0,0 +1,68 @@
+"""On-disk side of resumable chunked uploads.
+
+Each upload session writes into data/uploads/<id>.part. Chunks are written
+at their offset straight from the request stream, so a retried chunk simply
+overwrites the same bytes and nothing is ever buffered whole in memory.
+"""
+import hashlib
+import os
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), 'data', 'uploads')
+
+# Suggested chunk size for clients, and the read size when streaming
+CHUNK_SIZE = 512 * 1024
+STREAM_BLOCK = 64 * 1024
+
+# Largest file accepted through a resumable upload
+MAX_UPLOAD_SIZE = 16 * 1024 * 1024
+
+
+class ChunkError(Exception):
+    """A chunk doesn't fit the declared upload size"""
+
+
+def part_path(upload_id):
+    """Path of an upload's partial file"""
+    return os.path.join(UPLOAD_DIR, f"{upload_id}.part")
+
+
+def create_part(upload_id):
+    """Create the empty partial file of a new upload"""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    open(part_path(upload_id), 'wb').close()
+
+
+def write_chunk(upload_id, offset, stream, size):
+    """Copy stream into the partial file at offset; return bytes written.
+
+    Raises ChunkError if the chunk would run past the declared size.
+    """
+    written = 0
+    with open(part_path(upload_id), 'r+b') as f:
+        f.seek(offset)
+        while True:
+            block = stream.read(STREAM_BLOCK)
+            if not block:
+                break
+            if offset + written + len(block) > size:
+                raise ChunkError("chunk exceeds declared size")
+            f.write(block)
+            written += len(block)
+    return written
+
+
+def file_sha256(path):
+    """Hex SHA-256 of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(STREAM_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def remove_part(upload_id):
+    """Delete an upload's partial file if it's still there"""
+    try:
+        os.remove(part_path(upload_id))
+    except FileNotFoundError:
+        pass
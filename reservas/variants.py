@@ -0,0 +1,111 @@
+"""Resized copies of stored images, kept in a size-bounded on-disk LRU cache.
+
+/media/<name>?w=<width> serves a WebP scaled down to one of VARIANT_WIDTHS.
+Variants are derived data: they are built on first request, and the least
+recently used ones are deleted once the cache grows past its byte budget.
+"""
+from collections import OrderedDict
+import os
+import threading
+import uuid
+
+VARIANT_DIR = os.path.join(os.path.dirname(__file__), 'data', 'variants')
+
+# Widths a request is snapped to, so the cache holds few files per image
+VARIANT_WIDTHS = (320, 640, 960, 1280)
+
+# Disk budget for all variants
+VARIANT_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def snap_width(width):
+    """Smallest VARIANT_WIDTHS entry covering width (the largest one past it)"""
+    for candidate in VARIANT_WIDTHS:
+        if width <= candidate:
+            return candidate
+    return VARIANT_WIDTHS[-1]
+
+
+def srcset(url):
+    """srcset attribute value with every variant width of a /media/ URL"""
+    return ', '.join(f"{url}?w={width} {width}w" for width in VARIANT_WIDTHS)
+
+
+class VariantCache:
+    """Variant files under directory, evicted least recently used first.
+
+    The recency index is rebuilt from file mtimes on first use and kept in
+    memory; hits bump the mtime so the order survives restarts. Each
+    process keeps its own index, so with several workers the budget is
+    enforced approximately.
+    """
+
+    def __init__(self, directory=None, max_bytes=VARIANT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = None
+        self._total = 0
+
+    def _dir(self):
+        return self.directory or VARIANT_DIR
+
+    def path(self, name, width):
+        """On-disk path of a blob's variant"""
+        return os.path.join(self._dir(), f"{name.split('.')[0]}-{width}.webp")
+
+    def _load_index(self):
+        """Scan existing variants, oldest first"""
+        entries = []
+        os.makedirs(self._dir(), exist_ok=True)
+        for entry in os.scandir(self._dir()):
+            if entry.name.endswith('.webp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        entries.sort()
+        self._index = OrderedDict((path, size) for _, path, size in entries)
+        self._total = sum(self._index.values())
+
+    def get(self, name, width, build):
+        """Path of the variant, calling build() for its bytes on a miss"""
+        path = self.path(name, width)
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            if path in self._index and os.path.exists(path):
+                self._index.move_to_end(path)
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                return path
+        data = build()
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            # Another thread or worker wrote the same variant (Windows keeps it locked)
+            os.remove(tmp)
+            if not os.path.exists(path):
+                raise
+        with self._lock:
+            self._total += len(data) - self._index.pop(path, 0)
+            self._index[path] = len(data)
+            self._evict(keep=path)
+        return path
+
+    def _evict(self, keep):
+        """Delete least recently used variants until under budget"""
+        while self._total > self.max_bytes and len(self._index) > 1:
+            path, size = next(iter(self._index.items()))
+            if path == keep:
+                break
+            del self._index[path]
+            self._total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                # Gone already, or being served right now (Windows); the next scan sees it
+                pass
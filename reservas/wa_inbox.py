@@ -0,0 +1,186 @@
+"""Durable inbound WhatsApp queue (the wa_inbox table).
+
+The webhook only stores each message, keyed by its WhatsApp message id, and
+answers 200 right away; Meta's redeliveries hit the UNIQUE id and are
+dropped. Worker threads then run the bot handler: messages from the same
+sender are handled one at a time and in arrival order, different senders in
+parallel. Messages left 'processing' by a crash are picked up again on start.
+
+A failing message is retried only if the handler hadn't answered yet (it
+calls replied() once a reply is queued), so a retry never repeats a reply.
+"""
+import json
+import threading
+import time
+
+# Handler threads, tries per message, and retry delay base in seconds
+INBOX_WORKERS = 4
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 5
+
+# Idle workers re-check the table this often (new messages wake them sooner)
+POLL_INTERVAL = 2.0
+
+# Handled messages are kept this long so late redeliveries are still recognised
+KEEP_DAYS = 7
+
+# Oldest pending messages looked at per claim
+CLAIM_WINDOW = 100
+
+# The table, for databases that don't run the reservations migrations (webhook.py)
+INBOX_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS wa_inbox (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id TEXT NOT NULL UNIQUE,
+        sender TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at REAL NOT NULL DEFAULT 0,
+        received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_wa_inbox_status ON wa_inbox (status, seq);
+'''
+
+
+def create_inbox_table(conn):
+    """Create the wa_inbox table if missing"""
+    conn.executescript(INBOX_SCHEMA)
+
+
+class Inbox:
+    """Stores webhook messages and feeds them to handler(sender, msg).
+
+    connect() must return a sqlite3 connection usable from the calling
+    thread (the app's get_db). Claims are conditional updates, so a second
+    process draining the same database can't take a message twice; start()
+    requeues 'processing' rows, so only one process should call it.
+    """
+
+    def __init__(self, connect, handler, workers=INBOX_WORKERS):
+        self.connect = connect
+        self.handler = handler
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._busy = set()
+        self._threads = []
+        self._local = threading.local()
+
+    def add(self, messages):
+        """Store webhook messages; return how many were new"""
+        conn = self.connect()
+        before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO wa_inbox (message_id, sender, payload) VALUES (?, ?, ?)",
+            [(msg["id"], msg["from"], json.dumps(msg)) for msg in messages]
+        )
+        conn.commit()
+        added = conn.total_changes - before
+        if added:
+            self.start()
+            with self._cond:
+                self._cond.notify_all()
+        return added
+
+    def start(self):
+        """Start the workers (once), recovering messages interrupted by a crash"""
+        if len(self._threads) >= self.workers:
+            return
+        with self._cond:
+            if self._threads:
+                return
+            conn = self.connect()
+            conn.execute("UPDATE wa_inbox SET status = 'pending' WHERE status = 'processing'")
+            conn.execute(
+                "DELETE FROM wa_inbox WHERE status != 'pending' AND received_at < datetime('now', ?)",
+                (f'-{KEEP_DAYS} days',)
+            )
+            conn.commit()
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"wa-inbox-{n}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def _claim(self, conn):
+        """Mark the oldest handleable message 'processing' and return its row, or None"""
+        # Select and mark under the lock, so no two workers can pick the same row
+        with self._cond:
+            rows = conn.execute('''
+                SELECT seq, sender, payload, status, attempts, available_at FROM wa_inbox
+                WHERE status IN ('pending', 'processing')
+                ORDER BY seq
+                LIMIT ?
+            ''', (CLAIM_WINDOW,)).fetchall()
+            now = time.time()
+            seen = set()
+            for row in rows:
+                sender = row['sender']
+                if sender in seen:
+                    continue
+                # Only a sender's oldest unfinished message may run, and only if nobody (here or in
+                # another process) is handling it already
+                seen.add(sender)
+                if row['status'] != 'pending' or sender in self._busy or row['available_at'] > now:
+                    continue
+                # Only if still pending: another process may drain the same database
+                claimed = conn.execute(
+                    "UPDATE wa_inbox SET status = 'processing' WHERE seq = ? AND status = 'pending'",
+                    (row['seq'],)
+                ).rowcount
+                conn.commit()
+                if claimed:
+                    self._busy.add(sender)
+                    return row
+            return None
+
+    def replied(self):
+        """Note that the message being handled in this thread got a reply out"""
+        self._local.replied = True
+
+    def _finish(self, conn, row, error, replied):
+        """Record the outcome; failures before any reply retry later, up to MAX_ATTEMPTS"""
+        if error is None:
+            conn.execute("UPDATE wa_inbox SET status = 'done' WHERE seq = ?", (row['seq'],))
+        elif not replied and row['attempts'] + 1 < MAX_ATTEMPTS:
+            conn.execute(
+                "UPDATE wa_inbox SET status = 'pending', attempts = attempts + 1, available_at = ? WHERE seq = ?",
+                (time.time() + RETRY_DELAY * 2 ** row['attempts'], row['seq'])
+            )
+        else:
+            conn.execute("UPDATE wa_inbox SET status = 'failed', attempts = attempts + 1 WHERE seq = ?", (row['seq'],))
+        conn.commit()
+        with self._cond:
+            self._busy.discard(row['sender'])
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            try:
+                conn = self.connect()
+                row = self._claim(conn)
+            except Exception as e:
+                print(f"Error leyendo la cola de WhatsApp: {e}")
+                row = None
+            if row is None:
+                with self._cond:
+                    self._cond.wait(POLL_INTERVAL)
+                continue
+            error = None
+            self._local.replied = False
+            try:
+                msg = json.loads(row['payload'])
+                self.handler(row['sender'], msg)
+            except Exception as e:
+                error = e
+                print(f"Error procesando mensaje de {row['sender']}: {e}")
+            try:
+                self._finish(conn, row, error, self._local.replied)
+            except Exception as e:
+                print(f"Error actualizando la cola de WhatsApp: {e}")
+                with self._cond:
+                    self._busy.discard(row['sender'])
+
+    def stats(self):
+        """Message counts by status"""
+        rows = self.connect().execute("SELECT status, COUNT(*) FROM wa_inbox GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
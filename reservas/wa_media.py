@@ -0,0 +1,154 @@
+"""Photos and documents customers send to the WhatsApp bot.
+
+The bot only records the media id in the wa_media table; background
+workers then download the file from the Graph API (streamed to disk, never
+held whole in memory), store it and link it to the sender's reservation.
+Rows double as the job queue and the attachment list of a reservation.
+"""
+import threading
+import time
+
+# Download workers, tries per file, retry delay base in seconds, and the largest file accepted
+MEDIA_WORKERS = 2
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 30
+MAX_MEDIA_BYTES = 16 * 1024 * 1024
+
+# Streaming block and HTTP timeout (connect, read) in seconds
+DOWNLOAD_BLOCK = 64 * 1024
+DOWNLOAD_TIMEOUT = (5, 30)
+
+# Idle workers re-check the table this often
+POLL_INTERVAL = 5.0
+
+# WhatsApp message types handled, and the media kinds they can be
+MEDIA_TYPES = ('image', 'document')
+KIND_DNI = 'dni'
+KIND_RECEIPT = 'receipt'
+
+
+class MediaError(Exception):
+    """The media can't be downloaded or isn't a file we keep"""
+
+
+def media_kind(caption):
+    """'dni' when the caption mentions the DNI, else a payment receipt"""
+    return KIND_DNI if 'dni' in (caption or '').lower() else KIND_RECEIPT
+
+
+def download_media(session, graph_url, media_id, path, max_bytes=MAX_MEDIA_BYTES):
+    """Stream a WhatsApp media file to path; return its mime type.
+
+    Resolves the media id to its temporary URL first, then copies the body
+    in blocks. Raises MediaError past max_bytes or on a malformed answer;
+    network and HTTP errors propagate so the download is retried.
+    """
+    try:
+        meta = session.get(f"{graph_url}/{media_id}", timeout=DOWNLOAD_TIMEOUT)
+        meta.raise_for_status()
+        info = meta.json()
+        if int(info.get('file_size') or 0) > max_bytes:
+            raise MediaError(f"file too large: {info['file_size']} bytes")
+        with session.get(info['url'], stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            written = 0
+            with open(path, 'wb') as f:
+                for block in response.iter_content(DOWNLOAD_BLOCK):
+                    written += len(block)
+                    if written > max_bytes:
+                        raise MediaError("file too large")
+                    f.write(block)
+    except (ValueError, KeyError) as e:
+        raise MediaError(str(e))
+    return info.get('mime_type', '')
+
+
+class MediaQueue:
+    """Drains pending wa_media rows through process(row) in worker threads.
+
+    process returns a dict of columns to store on success (url, thumb_url,
+    reservation_id) and raises on failure; failures are retried up to
+    MAX_ATTEMPTS times with growing delays (MediaError gives up at once).
+    """
+
+    def __init__(self, connect, process, workers=MEDIA_WORKERS):
+        self.connect = connect
+        self.process = process
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def add(self, media_id, sender, kind, mime_type):
+        """Record a media message; False if it was already known"""
+        conn = self.connect()
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO wa_media (media_id, sender, kind, mime_type) VALUES (?, ?, ?, ?)",
+            (media_id, sender, kind, mime_type)
+        )
+        conn.commit()
+        if cursor.rowcount:
+            self.start()
+            with self._cond:
+                self._cond.notify()
+        return bool(cursor.rowcount)
+
+    def start(self):
+        """Start the workers (once), requeuing downloads interrupted by a crash"""
+        if len(self._threads) >= self.workers:
+            return
+        with self._cond:
+            if self._threads:
+                return
+            conn = self.connect()
+            conn.execute("UPDATE wa_media SET status = 'pending' WHERE status = 'processing'")
+            conn.commit()
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"wa-media-{n}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def _claim(self, conn):
+        row = conn.execute(
+            "SELECT * FROM wa_media WHERE status = 'pending' AND available_at <= ? ORDER BY created_at LIMIT 1",
+            (time.time(),)
+        ).fetchone()
+        if not row:
+            return None
+        # Only one worker wins the row
+        claimed = conn.execute(
+            "UPDATE wa_media SET status = 'processing' WHERE media_id = ? AND status = 'pending'",
+            (row['media_id'],)
+        ).rowcount
+        conn.commit()
+        return row if claimed else self._claim(conn)
+
+    def _work(self):
+        while True:
+            try:
+                conn = self.connect()
+                row = self._claim(conn)
+            except Exception as e:
+                print(f"Error leyendo la cola de archivos de WhatsApp: {e}")
+                row = None
+            if row is None:
+                with self._cond:
+                    self._cond.wait(POLL_INTERVAL)
+                continue
+            try:
+                result = self.process(row)
+                columns = ', '.join(f"{column} = ?" for column in result)
+                conn.execute(
+                    f"UPDATE wa_media SET status = 'done', error = NULL, {columns} WHERE media_id = ?",
+                    (*result.values(), row['media_id'])
+                )
+            except Exception as e:
+                print(f"Error descargando archivo {row['media_id']} de {row['sender']}: {e}")
+                final = isinstance(e, MediaError) or row['attempts'] + 1 >= MAX_ATTEMPTS
+                conn.execute('''
+                    UPDATE wa_media SET status = ?, attempts = attempts + 1, available_at = ?, error = ?
+                    WHERE media_id = ?
+                ''', (
+                    'failed' if final else 'pending', time.time() + RETRY_DELAY * 2 ** row['attempts'],
+                    str(e)[:500], row['media_id']
+                ))
+            conn.commit()
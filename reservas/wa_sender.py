@@ -0,0 +1,194 @@
+"""Outbound WhatsApp Cloud API queue.
+
+send() only enqueues, so webhook handlers return right away. A few daemon
+threads post the messages over one pooled requests.Session (keep-alive, no
+TLS handshake per message). Messages to the same number go out in order and
+at most one per PER_NUMBER_INTERVAL; 429s, 5xx and network errors are
+retried with exponential backoff (or the server's Retry-After).
+
+The queue lives in memory: messages still pending when the process exits
+are lost, like the old fire-and-forget requests.post.
+"""
+from collections import deque
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Background senders and the most messages waiting at once
+SENDER_WORKERS = 4
+MAX_PENDING = 1000
+
+# Seconds between two messages to the same number
+PER_NUMBER_INTERVAL = 1.0
+
+# Attempts per message, and backoff base/cap in seconds
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+HTTP_TIMEOUT = 10
+
+
+class WhatsAppSender:
+    """Per-recipient FIFO queues drained by a small thread pool.
+
+    A recipient with pending messages sits in a heap keyed by the time its
+    next message may go out; a worker takes it, sends the head message and
+    puts it back if more are waiting. callback(ok, detail), if given to
+    send(), runs on the worker once the message is delivered or given up.
+    """
+
+    def __init__(self, url, token, workers=SENDER_WORKERS, max_pending=MAX_PENDING,
+                 min_interval=PER_NUMBER_INTERVAL, max_attempts=MAX_ATTEMPTS, session=None):
+        self.url = url
+        self.workers = workers
+        self.max_pending = max_pending
+        self.min_interval = min_interval
+        self.max_attempts = max_attempts
+        self.session = session or self._make_session(token, workers)
+        self._cond = threading.Condition()
+        self._pending = {}   # to -> deque of [payload, attempts, callback, queued_at]
+        self._ready = []     # heap of (due, seq, to) for recipients not being sent to
+        self._last_sent = {}
+        self._seq = itertools.count()
+        self._size = 0
+        self._threads = []
+        self.metrics = {
+            "queued": 0, "sent": 0, "retried": 0, "failed": 0, "dropped": 0,
+            "latency_ms_total": 0.0, "attempt_ms_total": 0.0,
+        }
+
+    @staticmethod
+    def _make_session(token, workers):
+        session = requests.Session()
+        session.headers.update({"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _ensure_workers(self):
+        if len(self._threads) < self.workers:
+            with self._cond:
+                while len(self._threads) < self.workers:
+                    thread = threading.Thread(target=self._work, name=f"wa-sender-{len(self._threads)}", daemon=True)
+                    self._threads.append(thread)
+                    thread.start()
+
+    def _due(self, to, not_before=0):
+        """Earliest time the next message to this number may go out"""
+        return max(not_before, self._last_sent.get(to, 0) + self.min_interval, time.monotonic())
+
+    def send(self, to, data, callback=None):
+        """Queue a message; False if the queue is full and it was dropped"""
+        payload = {"messaging_product": "whatsapp", "to": to, "recipient_type": "individual"}
+        payload.update(data)
+        with self._cond:
+            if self._size >= self.max_pending:
+                self.metrics["dropped"] += 1
+                print(f"Cola de WhatsApp llena, mensaje a {to} descartado")
+                return False
+            queue = self._pending.get(to)
+            if queue is None:
+                # Not queued nor being sent to: schedule it
+                queue = self._pending[to] = deque()
+                heapq.heappush(self._ready, (self._due(to), next(self._seq), to))
+                self._cond.notify()
+            queue.append([payload, 0, callback, time.monotonic()])
+            self._size += 1
+            self.metrics["queued"] += 1
+            if len(self._last_sent) > self.max_pending:
+                cutoff = time.monotonic() - self.min_interval
+                self._last_sent = {k: v for k, v in self._last_sent.items() if v > cutoff}
+        self._ensure_workers()
+        return True
+
+    def stats(self):
+        """Counters plus the current queue depth.
+
+        avg_latency_ms is end to end, from send() until the message was
+        delivered or given up (queueing, pacing and retries included);
+        avg_attempt_ms is the duration of a single API call.
+        """
+        with self._cond:
+            stats = dict(self.metrics, pending=self._size, recipients=len(self._pending))
+        delivered = stats["sent"] + stats["failed"]
+        attempts = delivered + stats["retried"]
+        stats["avg_latency_ms"] = round(stats.pop("latency_ms_total") / delivered, 1) if delivered else 0
+        stats["avg_attempt_ms"] = round(stats.pop("attempt_ms_total") / attempts, 1) if attempts else 0
+        return stats
+
+    def _next(self):
+        """Block until a recipient is due; return (to, item)"""
+        with self._cond:
+            while True:
+                if not self._ready:
+                    self._cond.wait()
+                    continue
+                delay = self._ready[0][0] - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                _, _, to = heapq.heappop(self._ready)
+                return to, self._pending[to][0]
+
+    def _post(self, payload):
+        """(ok, retry_after or None if final, detail)"""
+        try:
+            response = self.session.post(self.url, json=payload, timeout=HTTP_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            return False, 0, str(e)
+        if response.ok:
+            return True, None, response.text
+        if response.status_code == 429 or response.status_code >= 500:
+            try:
+                retry_after = float(response.headers.get('Retry-After', 0))
+            except ValueError:
+                retry_after = 0
+            return False, retry_after, response.text
+        return False, None, response.text
+
+    def _work(self):
+        while True:
+            to, item = self._next()
+            payload, attempts, callback, queued_at = item
+            started = time.monotonic()
+            ok, retry_after, detail = self._post(payload)
+            finished = time.monotonic()
+            not_before = 0
+            done = True
+            with self._cond:
+                queue = self._pending[to]
+                self._last_sent[to] = finished
+                self.metrics["attempt_ms_total"] += (finished - started) * 1000
+                if ok:
+                    self.metrics["sent"] += 1
+                elif retry_after is not None and attempts + 1 < self.max_attempts:
+                    # Keep it at the head so later messages don't overtake it
+                    item[1] += 1
+                    backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempts) * random.uniform(0.8, 1.2)
+                    not_before = finished + max(retry_after, backoff)
+                    self.metrics["retried"] += 1
+                    done = False
+                else:
+                    self.metrics["failed"] += 1
+                    print(f"Error enviando mensaje a {to}: {detail}")
+                if done:
+                    queue.popleft()
+                    self._size -= 1
+                    self.metrics["latency_ms_total"] += (finished - queued_at) * 1000
+                if queue:
+                    heapq.heappush(self._ready, (self._due(to, not_before), next(self._seq), to))
+                    self._cond.notify()
+                else:
+                    del self._pending[to]
+            if done and callback:
+                try:
+                    callback(ok, detail)
+                except Exception as e:
+                    print(f"Error en callback de WhatsApp: {e}")
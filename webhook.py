@@ -1,6 +1,31 @@
 from flask import Flask, request, jsonify
-import requests
 import json
+import os
+import sqlite3
+import sys
+import threading
+
+# Shared outbound queue from the reservations app
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reservas'))
+from wa_sender import WhatsAppSender
+from wa_inbox import Inbox, create_inbox_table
+from cache import VersionedCache
+from intents import (
+    PAYLOAD_MENU, PAYLOAD_PLANES, PAYLOAD_RESERVAR, PAYLOAD_UBICACION,
+    PAYLOAD_ECO, PAYLOAD_FULL, PAYLOAD_PAGO, PAYLOAD_DISPONIBILIDAD, build_router
+)
+
+# Cola de mensajes entrantes (tabla wa_inbox)
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.db')
+_thread_db = threading.local()
+
+def get_db():
+    conn = getattr(_thread_db, 'conn', None)
+    if conn is None:
+        conn = _thread_db.conn = sqlite3.connect(DB_PATH, timeout=5)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+    return conn
 
 app = Flask(__name__)
 
@@ -10,35 +35,22 @@ PHONE_ID = "1056602097527404"
 VERIFY_TOKEN = "javier"
 VERSION = "v19.0"
 
-# Payloads de botones
-PAYLOAD_MENU = "MENU_PRINCIPAL"
-PAYLOAD_PLANES = "VER_PLANES"
-PAYLOAD_RESERVAR = "COMO_RESERVAR"
-PAYLOAD_UBICACION = "VER_UBICACION"
-PAYLOAD_ECO = "DETALLE_ECO"
-PAYLOAD_FULL = "DETALLE_FULL"
-PAYLOAD_PAGO = "DATOS_PAGO"
+# Palabras clave (kw_*) de los mensajes por defecto; se recompilan si cambia el archivo
+MESSAGES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reservas', 'data', 'default_messages.json')
+
+def load_router(_):
+    with open(MESSAGES_PATH, 'r', encoding='utf-8') as f:
+        return build_router(json.load(f))
+
+router_cache = VersionedCache(lambda _: os.path.getmtime(MESSAGES_PATH), load_router, check_interval=5)
+
+# Los mensajes salen por una cola en segundo plano (ver reservas/wa_sender.py)
+sender_queue = WhatsAppSender(f"https://graph.facebook.com/{VERSION}/{PHONE_ID}/messages", TOKEN)
 
 def send_whatsapp_message(to, data):
-    url = f"https://graph.facebook.com/{VERSION}/{PHONE_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {TOKEN}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to,
-        "recipient_type": "individual",
-    }
-    payload.update(data)
-    
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"Error enviando mensaje: {e}")
-        if response:
-             print(f"Detalle error: {response.text}")
+    if sender_queue.send(to, data):
+        # Ya salió una respuesta: el inbox no debe reintentar este mensaje
+        inbox.replied()
 
 def send_text(to, text):
     data = {
@@ -76,7 +88,7 @@ def handle_incoming_message(sender, message_body, message_type):
     payload = ""
     
     if message_type == "text":
-        msg_text = message_body["text"]["body"].lower().strip()
+        msg_text = message_body["text"]["body"]
         print(f"📩 {sender} escribió: {msg_text}")
     elif message_type == "interactive":
         type_interactive = message_body["interactive"]["type"]
@@ -86,9 +98,11 @@ def handle_incoming_message(sender, message_body, message_type):
             msg_text = title
             print(f"🔘 {sender} tocó botón: {title} (ID: {payload})")
 
+    intent = router_cache.get(None).route(msg_text, payload)
+
     # Flujo de conversación
     # 1. Saludo / Inicio
-    if payload == PAYLOAD_MENU or any(x in msg_text for x in ["hola", "buen dia", "buenas", "inicio", "menu"]):
+    if intent == 'menu':
         welcome_text = (
             "¡Hola! 👋 Gracias por tu interés en *BiciSí*, Servicio de Alquiler de Bicicletas en Villa Carlos Paz 🚲✨\n\n"
             "⏰ *Horarios:* Todos los días de 9:00 a 19:00 hs.\n"
@@ -104,7 +118,7 @@ def handle_incoming_message(sender, message_body, message_type):
         return
 
     # 2. Ver Planes (Eco vs Full)
-    if payload == PAYLOAD_PLANES or "planes" in msg_text or "precio" in msg_text:
+    if intent == 'planes':
         text = (
             "Tenemos dos modalidades principales:\n\n"
             "🔵 *Modo ECO*: Bicis de Aluminio o Acero. Se retiran y devuelven en nuestra Central. Sin cobertura de asistencia.\n\n"
@@ -119,7 +133,7 @@ def handle_incoming_message(sender, message_body, message_type):
         return
 
     # 3. Detalle Eco
-    if payload == PAYLOAD_ECO:
+    if intent == 'eco':
         text = (
             "*Modo ECO* 🌿\n\n"
             "👉 Ideal si vienes a buscar la bici.\n"
@@ -135,7 +149,7 @@ def handle_incoming_message(sender, message_body, message_type):
         return
 
     # 4. Detalle Full
-    if payload == PAYLOAD_FULL:
+    if intent == 'full':
         text = (
             "*Modo FULL* 🚀\n\n"
             "👉 ¡Relájate, nosotros nos encargamos!\n"
@@ -150,8 +164,22 @@ def handle_incoming_message(sender, message_body, message_type):
         send_buttons(sender, text, buttons)
         return
 
-    # 5. Cómo Reservar
-    if payload == PAYLOAD_RESERVAR or "reservar" in msg_text:
+    # 5. Disponibilidad: este bot no ve el stock, el calendario de la reserva online sí
+    if intent == 'disponibilidad':
+        text = (
+            "📅 *Disponibilidad*\n\n"
+            "Elegí la fecha y la cantidad de bicis en la reserva online y te mostramos qué hay libre:\n"
+            "👉 http://localhost:5000/reserva"
+        )
+        buttons = [
+            (PAYLOAD_RESERVAR, "Cómo Reservar 📝"),
+            (PAYLOAD_MENU, "Volver al Menú")
+        ]
+        send_buttons(sender, text, buttons)
+        return
+
+    # 6. Cómo Reservar
+    if intent == 'reservar':
         # 1. Enviar Link de Reserva
         link_text = (
             "📝 *Reserva Online*\n\n"
@@ -171,8 +199,8 @@ def handle_incoming_message(sender, message_body, message_type):
         send_buttons(sender, menu_text, buttons)
         return
 
-    # 6. Datos de Pago
-    if payload == PAYLOAD_PAGO or "cbu" in msg_text or "alias" in msg_text or "pago" in msg_text:
+    # 7. Datos de Pago
+    if intent == 'pago':
         text = (
             "🏦 *Datos Bancarios para la Seña:*\n\n"
             "🔹 *Banco:* Francés BBVA\n"
@@ -185,8 +213,8 @@ def handle_incoming_message(sender, message_body, message_type):
         send_text(sender, text)
         return
 
-    # 7. Ubicación
-    if payload == PAYLOAD_UBICACION or "ubicación" in msg_text or "donde estan" in msg_text:
+    # 8. Ubicación
+    if intent == 'ubicacion':
         text = (
             "📍 *Nuestra Ubicación Central:*\n\n"
             "Estamos listos para recibirte. \nhttps://maps.app.goo.gl/PseNUb16SX2tSZjS9\n"
@@ -216,32 +244,36 @@ def verify():
         return challenge, 200
     return "Forbidden", 403
 
+# Los mensajes se guardan primero y los responden workers en segundo plano
+inbox = Inbox(get_db, lambda sender, msg: handle_incoming_message(sender, msg, msg["type"]))
+
 @app.route("/webhook", methods=["POST"])
 def receive():
-    data = request.get_json()
-    # print(f"Recibido: {data}") # Log raw eliminado para limpieza
-
+    data = request.get_json(silent=True) or {}
 
+    messages = []
     try:
         # Verifica si es un mensaje de WhatsApp válido
         if data.get("object") == "whatsapp_business_account":
             for entry in data.get("entry", []):
                 for change in entry.get("changes", []):
-                    value = change.get("value", {})
-                    if "messages" in value:
-                        for msg in value["messages"]:
-                            sender = msg["from"]
-                            msg_type = msg["type"]
-                            
-                            # Evita responder a estados o mensajes viejos si es necesario
-                            # Aquí procesamos texto e interactivos
-                            handle_incoming_message(sender, msg, msg_type)
-
+                    messages.extend(change.get("value", {}).get("messages", []))
+    except (AttributeError, TypeError) as e:
+        # Formato inesperado: reintentar no sirve, respondemos 200 igual
+        print(f"Webhook con formato inesperado: {e}")
         return jsonify(status="ok"), 200
 
-    except Exception as e:
-        print(f"Error en webhook: {e}")
-        return jsonify(status="error"), 400
+    messages = [msg for msg in messages if isinstance(msg, dict) and msg.get("id") and msg.get("from")]
+    if messages:
+        try:
+            # Los reenvíos de Meta tienen el mismo id y se descartan
+            inbox.add(messages)
+        except sqlite3.Error as e:
+            # No se guardó: que Meta lo reenvíe
+            print(f"Error guardando mensajes: {e}")
+            return jsonify(status="error"), 500
+
+    return jsonify(status="ok"), 200
 
     from flask import send_from_directory
 
@@ -256,4 +288,7 @@ def bicisi_static(path):
     return send_from_directory('bicisi-web', path)
 
 if __name__ == "__main__":
+    # bot.db solo tiene la cola de entrada
+    create_inbox_table(get_db())
+    inbox.start()
     app.run(host="0.0.0.0", port=5001)